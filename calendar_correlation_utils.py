@@ -0,0 +1,176 @@
+# ~*~ coding: utf8 ~*~
+"""Autocorrelations conditioned on the calendar time of the first point.
+
+The correlation functions allow the daily cycle of the correlations
+to vary with season, but a pooled ACF averages that away.  These
+functions restrict the pairs at each lag to those whose first point
+falls in a given category (a month, an hour of day, or both) and
+find the ACF of each category.
+
+Missing data is handled as in :mod:`correlation_utils`: each site is
+demeaned using all its non-missing values and each lag is divided by
+the number of pairs at that lag.  The pairs for category c at lag k
+are counted as the cross-correlation of a start mask (valid and in c)
+with an end mask (valid), so one real FFT of each category's start
+arrays and one of the site's end arrays give every lag at once.  The
+end arrays of all sites are transformed together, as are the start
+arrays of each block of (site, category) pairs.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+import pandas as pd
+import scipy.fft
+
+from correlation_utils import AutocorrelationArrays
+
+MONTHS_PER_YEAR = 12
+HOURS_PER_DAY = 24
+SERIES_PER_BLOCK = HOURS_PER_DAY
+
+
+def get_conditional_autocorrelation_arrays(
+        data, categories, n_categories, have_data=None, max_lag=None,
+        series_per_block=SERIES_PER_BLOCK,
+):
+    """Find ACFs using only pairs whose first point is in each category.
+
+    Parameters
+    ----------
+    data: np.ndarray[N_sites, N_times]
+        Must be regularly spaced in time.  Missing values may be NaN.
+    categories: np.ndarray[N_times] of int
+        The category of each time, from 0 to n_categories - 1.
+        Negative values are not used as first points.
+    n_categories: int
+    have_data: np.ndarray[N_sites, N_times] of bool, optional
+    max_lag: int, optional
+        Defaults to N_times - 1.
+    series_per_block: int
+        How many (site, category) pairs to transform at once, to bound
+        memory use.
+
+    Returns
+    -------
+    AutocorrelationArrays
+        acf and acovf are float32 arrays of shape
+        [N_sites, n_categories, max_lag + 1], NaN where there are no
+        pairs; pair_counts is int32 of the same shape.  The acf is
+        relative to the lag-zero autocovariance of the category.
+    """
+    data = np.atleast_2d(data)
+    finite_data = np.isfinite(data)
+    if have_data is None:
+        have_data = finite_data
+    else:
+        have_data = np.atleast_2d(have_data) & finite_data
+    categories = np.asarray(categories)
+    n_sites, n_times = data.shape
+    if max_lag is None:
+        max_lag = n_times - 1
+    n_lags = min(max_lag, n_times - 1) + 1
+    fft_len = scipy.fft.next_fast_len(n_times + n_lags - 1, real=True)
+
+    acovf_result = np.full(
+        (n_sites, n_categories, n_lags), np.nan, dtype=np.float32
+    )
+    acf_result = np.full_like(acovf_result, np.nan)
+    pair_count_result = np.zeros(
+        (n_sites, n_categories, n_lags), dtype=np.int32
+    )
+
+    n_valid = have_data.sum(axis=1)
+    site_data = np.where(have_data, data, 0).astype(np.float64)
+    site_data -= (
+        site_data.sum(axis=1) / np.maximum(n_valid, 1)
+    )[:, np.newaxis]
+    site_data[~have_data] = 0
+    # The end masks are the same for every category
+    end_mask_spectra, end_data_spectra = scipy.fft.rfft(
+        np.stack([have_data.astype(np.float64), site_data]),
+        fft_len,
+        axis=-1,
+    )
+
+    series_sites, series_categories = np.divmod(
+        np.arange(n_sites * n_categories), n_categories
+    )
+    for block_start in range(0, n_sites * n_categories, series_per_block):
+        block = slice(block_start, block_start + series_per_block)
+        block_sites = series_sites[block]
+        block_categories = series_categories[block]
+        start_mask = (
+            (categories[np.newaxis, :] == block_categories[:, np.newaxis]) &
+            have_data[block_sites]
+        ).astype(np.float64)
+        start_mask_spectra, start_data_spectra = scipy.fft.rfft(
+            np.stack([start_mask, start_mask * site_data[block_sites]]),
+            fft_len,
+            axis=-1,
+        ).conj()
+        lag_sums = scipy.fft.irfft(
+            np.stack([
+                start_mask_spectra * end_mask_spectra[block_sites],
+                start_data_spectra * end_data_spectra[block_sites],
+            ]),
+            fft_len,
+            axis=-1,
+        )[..., :n_lags]
+        del start_mask_spectra, start_data_spectra
+
+        block_pairs = np.round(lag_sums[0])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            block_acovf = lag_sums[1] / block_pairs
+            block_acf = block_acovf / block_acovf[:, :1]
+        block_acovf[block_pairs == 0] = np.nan
+        block_acf[block_pairs == 0] = np.nan
+
+        acovf_result[block_sites, block_categories] = block_acovf
+        acf_result[block_sites, block_categories] = block_acf
+        pair_count_result[block_sites, block_categories] = block_pairs
+
+    return AutocorrelationArrays(acf_result, acovf_result, pair_count_result)
+
+
+def get_calendar_autocorrelation_arrays(
+        data, time_index, have_data=None, max_lag=None,
+        by_month=True, by_hour=True,
+):
+    """Find ACFs conditioned on the month and/or hour of the first point.
+
+    Parameters
+    ----------
+    data: np.ndarray[N_sites, N_times]
+        Must be regularly spaced in time.  Missing values may be NaN.
+    time_index: pd.DatetimeIndex
+        The time of each value in data.
+    have_data: np.ndarray[N_sites, N_times] of bool, optional
+    max_lag: int, optional
+    by_month, by_hour: bool
+        Which calendar fields to condition on.
+
+    Returns
+    -------
+    AutocorrelationArrays
+        Each array has shape [N_sites, 12, 24, max_lag + 1], with the
+        month and hour axes dropped if not conditioned on.  Month 0 is
+        January.
+    """
+    time_index = pd.DatetimeIndex(time_index)
+    categories = np.zeros(len(time_index), dtype=np.int64)
+    category_shape = []
+    if by_month:
+        categories = categories * MONTHS_PER_YEAR + (time_index.month - 1)
+        category_shape.append(MONTHS_PER_YEAR)
+    if by_hour:
+        categories = categories * HOURS_PER_DAY + time_index.hour
+        category_shape.append(HOURS_PER_DAY)
+    n_categories = int(np.prod(category_shape))
+    result = get_conditional_autocorrelation_arrays(
+        data, categories, n_categories, have_data, max_lag
+    )
+    n_sites = result.acf.shape[0]
+    return AutocorrelationArrays(*[
+        array.reshape((n_sites,) + tuple(category_shape) + (-1,))
+        for array in result
+    ])
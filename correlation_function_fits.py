@@ -9,14 +9,20 @@ from __future__ import print_function, division
 from enum import Enum
 from math import pi
 import collections
+import functools
 import itertools
 import operator
 import pprint
+import re
 
 import numpy as np
 import matplotlib.pyplot as plt
 import numexpr as ne
 import pandas as pd
+import sympy
+from sympy.printing.str import StrPrinter
+
+from lag_grids import LagGrid
 
 HOURS_PER_DAY=24
 DAYS_PER_DAY=1
@@ -39,9 +45,66 @@ GLOBAL_DICT = dict(
     TWO_PI_OVER_YEAR=2 * pi / DAYS_PER_YEAR,
     FOUR_PI_OVER_YEAR=4 * pi / DAYS_PER_YEAR,
 )
+# numexpr calls single precision "float" and double precision
+# "np.float64"
+NUMEXPR_TYPES = {
+    np.dtype(np.float32): float,
+    np.dtype(np.float64): np.float64,
+}
 
 TOPK = 5
 
+# The parts of the correlation function that do not depend on the forms
+RESID_EC_EXPRESSION = (
+    "resid_coef * exp(-tdata / (resid_timescale * DAYS_PER_FORTNIGHT)) + "
+    "ec_coef * exp(-tdata / ec_timescale * HOURS_PER_DAY)"
+)
+RESID_EC_PARAMETERS = (
+    "resid_coef", "resid_timescale", "ec_coef", "ec_timescale",
+)
+
+
+class KernelPrinter(StrPrinter):
+    """Print sympy expressions in the syntax of the expression strings.
+
+    The same strings work in numexpr, Cython, and numba: fractions are
+    written as decimals so integer division never comes up, and
+    remainders use ``%``.
+    """
+
+    def _print_Rational(self, expr):
+        return repr(float(expr))
+
+    def _print_Mod(self, expr):
+        return "(({0:s}) % ({1:s}))".format(
+            self._print(expr.args[0]), self._print(expr.args[1])
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def parse_expression(expression):
+    """Turn an expression string into a sympy expression.
+
+    Every name except the functions is a real symbol.  ``where`` stays
+    an unevaluated function, which is enough since no parameter
+    appears in its arguments.
+
+    Parameters
+    ----------
+    expression: str
+
+    Returns
+    -------
+    sympy.Expr
+    """
+    namespace = {
+        name: sympy.Symbol(name, real=True)
+        for name in re.findall(r"\b[A-Za-z_]\w*\b", expression)
+        if name not in ("exp", "cos", "sin", "where")
+    }
+    namespace["where"] = sympy.Function("where")
+    return sympy.sympify(expression, locals=namespace, rational=True)
+
 
 class CorrelationPart(Enum):
     """The parts of a correlation function."""
@@ -117,12 +180,23 @@ class PartForm(Enum):
         """
         return self.name.lower().replace("o", "0")
 
-    def get_parameters(self, part):
+    def get_parameters(self, part, linear=None):
         """Get the parameters added by including this form in that part.
 
+        The overall coefficient of a main part enters the correlation
+        function linearly once the other parameters are fixed, as do
+        its products with the cosine weights of a main part.  The
+        cosine weights themselves are counted as linear, with the
+        understanding that they are found from those products.
+        Everything in a modulation multiplies the daily part, so none
+        of it is linear.
+
         Parameters
         ----------
         part: CorrelationPart
+        linear: bool, optional
+            True for only the linear parameters, False for only the
+            rest, None for all of them.
 
         Returns
         -------
@@ -130,13 +204,20 @@ class PartForm(Enum):
         """
         result = []
         if not part.is_modulation() and self is not PartForm.NONE:
-            result.extend(("{0:s}_coef", "{0:s}_timescale"))
+            result.extend((("{0:s}_coef", True), ("{0:s}_timescale", False)))
         if self == PartForm.COSINE:
-            result.extend(("{0:s}_coef1", "{0:s}_coef2"))
+            result.extend((
+                ("{0:s}_coef1", not part.is_modulation()),
+                ("{0:s}_coef2", not part.is_modulation()),
+            ))
         elif self == PartForm.PERIODIC:
-            result.append("{0:s}_width")
+            result.append(("{0:s}_width", False))
         part_name_lower = part.name.lower()
-        return [coef.format(part_name_lower) for coef in result]
+        return [
+            coef.format(part_name_lower)
+            for coef, is_linear in result
+            if linear is None or is_linear == linear
+        ]
 
     def get_expression(self, part):
         """Get the expression for this form in that part.
@@ -184,8 +265,25 @@ class PartForm(Enum):
             time=part.get_period(),
         )
 
+    def get_symbolic_expression(self, part):
+        """Get the expression for this form in that part as a sympy tree.
+
+        Parameters
+        ----------
+        part: CorrelationPart
+
+        Returns
+        -------
+        sympy.Expr
+        """
+        return parse_expression(self.get_expression(part))
+
     def get_derivative(self, part):
-        """Get the expression for this form in that part.
+        """Get the derivatives of the expression for this form in that part.
+
+        Found by differentiating :meth:`get_symbolic_expression`, so
+        there is one for each parameter, in the order of
+        :meth:`get_parameters`.
 
         Parameters
         ----------
@@ -194,74 +292,270 @@ class PartForm(Enum):
         Returns
         -------
         expression: list of str
+            Each in parentheses, so they can be multiplied by other
+            expressions.
         """
-        if self == PartForm.NONE:
-            if part.is_modulation():
-                return []
-            return []
-        if part == CorrelationPart.DAILY:
-            prefix = "{0:s}_coef * exp(-tdata / ({0:s}_timescale * DAYS_PER_FORTNIGHT))"
-            prefix_parts = [
-                "exp(-tdata / ({0:s}_timescale * DAYS_PER_FORTNIGHT))",
-                "{0:s}_coef * exp(-tdata / ({0:s}_timescale * DAYS_PER_FORTNIGHT)) * "
-                "tdata / (DAYS_PER_FORTNIGHT * {0:s}_timescale ** 2)",
-            ]
-        elif part == CorrelationPart.ANNUAL:
-            prefix = "{0:s}_coef * exp(-tdata / ({0:s}_timescale * DAYS_PER_DECADE))"
-            prefix_parts = [
-                "exp(-tdata / ({0:s}_timescale * DAYS_PER_DECADE))",
-                "{0:s}_coef * exp(-tdata / ({0:s}_timescale * DAYS_PER_DECADE)) * "
-                "tdata / (DAYS_PER_DECADE * {0:s}_timescale ** 2)",
-            ]
-        if self == PartForm.COSINE:
-            main = (
-                "((1 - {0:s}_coef1 - {0:s}_coef2) + "
-                "{0:s}_coef1 * cos(TWO_PI_OVER_{time:s} * tdata) + "
-                "{0:s}_coef2 * cos(FOUR_PI_OVER_{time:s} * tdata))"
-            )
-            main_parts = [
-                "(-1 + cos(TWO_PI_OVER_{time:s} * tdata))",
-                "(-1 + cos(FOUR_PI_OVER_{time:s} * tdata))",
-            ]
-        elif self == PartForm.PERIODIC:
-            main = (
-                "exp(-(sin(PI_OVER_{time:s} * tdata) / {0:s}_width) ** 2)"
-            )
-            main_parts = [
-                "exp(-(sin(PI_OVER_{time:s} * tdata) / {0:s}_width) ** 2) * "
-                "2 * sin(PI_OVER_{time:s} * tdata) ** 2 / {0:s}_width ** 3",
-            ]
-        elif self == PartForm.GEOSTAT:
-            main = (
-                "where(((tdata / DAYS_PER_{time:s}) % 1) < 0.125, 1 - 8 * ((tdata / DAYS_PER_{time:s}) % 1), "
-                "where(((tdata / DAYS_PER_{time:s}) % 1) > 0.875, 8 * ((tdata / DAYS_PER_{time:s}) % 1 - 0.875), 0))"
+        return differentiate_expression(
+            self.get_expression(part), tuple(self.get_parameters(part))
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def differentiate_expression(expression, parameters):
+    """Find the derivatives of an expression.
+
+    Parameters
+    ----------
+    expression: str
+    parameters: tuple of str
+
+    Returns
+    -------
+    list of str
+        The derivatives with respect to each parameter, each in
+        parentheses.
+    """
+    symbolic_expression = parse_expression(expression)
+    printer = KernelPrinter()
+    return [
+        "({0:s})".format(printer.doprint(
+            sympy.diff(symbolic_expression, sympy.Symbol(param, real=True))
+        ))
+        for param in parameters
+    ]
+
+
+# The calls that are worth computing only once
+EXPENSIVE_FUNCTIONS = (sympy.exp, sympy.cos, sympy.sin, sympy.Mod)
+
+CommonSubexpressions = collections.namedtuple(
+    "CommonSubexpressions",
+    ["basis", "invariant", "decay", "per_lag", "reduced"],
+)
+
+
+def eliminate_common_subexpressions(expressions, prefix="cse",
+                                    only_expensive=False,
+                                    hoist_invariant=True,
+                                    cache_lag_functions=False,
+                                    name_decays=False):
+    """Find the subexpressions the expressions share.
+
+    Each gets a name and is only written out once.  Comparisons stay
+    where they are used, since the kernels keep every name in a
+    floating-point variable.
+
+    Parameters
+    ----------
+    expressions: list of str
+    prefix: str
+        The start of the names of the subexpressions.
+    only_expensive: bool
+        Only name subexpressions that call one of EXPENSIVE_FUNCTIONS,
+        putting the rest back where they were.
+    hoist_invariant: bool
+        Name the pieces that do not depend on tdata separately, even if
+        they only appear once, so they can be computed once instead of
+        at each lag.  If False, leave them where they are.
+    cache_lag_functions: bool
+        Name the function calls that depend only on tdata and the
+        constants separately, so they can be computed once for each set
+        of lags and looked up after that.  See :mod:`lag_grids`.
+    name_decays: bool
+        Name each ``exp(rate * tdata)`` whose rate does not change
+        from lag to lag, so on evenly spaced lags the kernels can find
+        it from the one at the lag before.
+
+    Returns
+    -------
+    CommonSubexpressions
+        basis has (name, expression) pairs for the functions of the
+        lags, written with only tdata and the constants.  decay has
+        (name, rate) pairs for the exponentials, whose rates may use
+        the invariant names.  invariant and per_lag are lists of
+        (name, expression) pairs, each of which may use the names
+        before it.  reduced has the expressions, using those names.
+    """
+    tdata = sympy.Symbol("tdata", real=True)
+    parsed = [parse_expression(expression) for expression in expressions]
+    # The names whose values change from lag to lag
+    lag_symbols = {tdata}
+    basis = []
+    if cache_lag_functions:
+        basis_names = {}
+        basis_symbols = sympy.numbered_symbols(prefix + "_basis", real=True)
+        lag_only_symbols = {tdata} | {
+            sympy.Symbol(name, real=True) for name in GLOBAL_DICT
+        }
+
+        def is_lag_function(expression):
+            return (
+                tdata in expression.free_symbols and
+                expression.free_symbols <= lag_only_symbols and
+                bool(expression.atoms(sympy.Function)) and
+                not isinstance(expression, sympy.logic.boolalg.Boolean)
             )
-            main_parts = []
 
-        if not part.is_modulation():
-            # The exponential die-off is only for the main
-            # correlations.  Including it also on the modulation would
-            # introduce problems with how to tell the two apart.
-            prefix_parts = [
-                "{piece:s} * {main:s}".format(piece=piece, main=main)
-                for piece in prefix_parts
-            ]
-            main_parts = [
-                "{prefix:s} * {piece:s}".format(prefix=prefix, piece=piece)
-                for piece in main_parts
-            ]
-            main = "{0:s} * {1:s}".format(prefix, main)
-            # Put everything in the same list.  Make sure it's in the
-            # same order as the reported parameter list.
-            main_parts = prefix_parts + main_parts
+        def name_lag_function(expression):
+            if expression not in basis_names:
+                basis_names[expression] = next(basis_symbols)
+                lag_symbols.add(basis_names[expression])
+                basis.append((basis_names[expression], expression))
+            return basis_names[expression]
+
+        def hoist_lag_functions(expression):
+            if expression.is_Atom:
+                return expression
+            if is_lag_function(expression):
+                return name_lag_function(expression)
+            if expression.is_Add or expression.is_Mul:
+                # Keep the functions in a sum or product together
+                lag_args = [
+                    arg for arg in expression.args if is_lag_function(arg)
+                ]
+                args = [
+                    hoist_lag_functions(arg) for arg in expression.args
+                    if not is_lag_function(arg)
+                ]
+                if lag_args:
+                    args.append(
+                        name_lag_function(expression.func(*lag_args))
+                    )
+                return expression.func(*args)
+            return expression.func(*[
+                hoist_lag_functions(arg) for arg in expression.args
+            ])
+
+        parsed = [hoist_lag_functions(expression) for expression in parsed]
+    invariant = []
+    if hoist_invariant:
+        # Name the pieces that depend only on the parameters first, so
+        # cse keeps them whole
+        invariant_names = {}
+        invariant_symbols = sympy.numbered_symbols(
+            prefix + "_invariant", real=True
+        )
 
-        return [
-            piece.format(
-                part.name.lower(),
-                time=part.get_period(),
+        def is_invariant(expression):
+            return (
+                not expression.free_symbols & lag_symbols and
+                not expression.atoms(sympy.Function) and
+                not isinstance(expression, sympy.logic.boolalg.Boolean)
             )
-            for piece in main_parts
-        ]
+
+        def name_invariant(expression):
+            if expression.is_Atom:
+                return expression
+            if expression not in invariant_names:
+                invariant_names[expression] = next(invariant_symbols)
+                invariant.append((invariant_names[expression], expression))
+            return invariant_names[expression]
+
+        def hoist(expression):
+            if expression.is_Atom:
+                return expression
+            if is_invariant(expression):
+                return name_invariant(expression)
+            if expression.is_Add or expression.is_Mul:
+                # Keep the parameters in a sum or product together
+                invariant_args = [
+                    arg for arg in expression.args if is_invariant(arg)
+                ]
+                args = [
+                    hoist(arg) for arg in expression.args
+                    if not is_invariant(arg)
+                ]
+                if invariant_args:
+                    args.append(
+                        name_invariant(expression.func(*invariant_args))
+                    )
+                return expression.func(*args)
+            return expression.func(*[hoist(arg) for arg in expression.args])
+
+        parsed = [hoist(expression) for expression in parsed]
+    decay = []
+    if name_decays:
+        decay_names = {}
+        decay_symbols = sympy.numbered_symbols(prefix + "_decay", real=True)
+
+        def name_decay(expression):
+            if expression.is_Atom:
+                return expression
+            if isinstance(expression, sympy.exp):
+                rate, lag = expression.args[0].as_independent(
+                    tdata, as_Add=False
+                )
+                if (
+                        lag == tdata and
+                        not rate.free_symbols & lag_symbols and
+                        not rate.atoms(sympy.Function)
+                ):
+                    if expression not in decay_names:
+                        decay_names[expression] = next(decay_symbols)
+                        decay.append((decay_names[expression], rate))
+                    return decay_names[expression]
+            return expression.func(*[
+                name_decay(arg) for arg in expression.args
+            ])
+
+        parsed = [name_decay(expression) for expression in parsed]
+        lag_symbols.update(name for name, _ in decay)
+    replacements, reduced = sympy.cse(
+        parsed, symbols=sympy.numbered_symbols(prefix, real=True),
+    )
+    lag_dependent = set(lag_symbols)
+    put_back = {}
+    per_lag = []
+    for name, value in replacements:
+        value = value.xreplace(put_back)
+        depends_on_lag = bool(value.free_symbols & lag_dependent)
+        if (
+                isinstance(value, sympy.logic.boolalg.Boolean) or
+                (only_expensive and not value.has(*EXPENSIVE_FUNCTIONS)) or
+                (not depends_on_lag and not hoist_invariant) or
+                # The kernels only set up the functions inside the loop
+                (not depends_on_lag and value.atoms(sympy.Function))
+        ):
+            put_back[name] = value
+        elif depends_on_lag:
+            lag_dependent.add(name)
+            per_lag.append((name, value))
+        else:
+            invariant.append((name, value))
+    printer = KernelPrinter()
+    return CommonSubexpressions(
+        [(str(name), printer.doprint(value)) for name, value in basis],
+        [(str(name), printer.doprint(value)) for name, value in invariant],
+        [(str(name), printer.doprint(rate)) for name, rate in decay],
+        [(str(name), printer.doprint(value)) for name, value in per_lag],
+        [printer.doprint(expression.xreplace(put_back))
+         for expression in reduced],
+    )
+
+
+def count_operations(expressions):
+    """Count the operations needed to evaluate the expressions.
+
+    Parameters
+    ----------
+    expressions: list of str
+
+    Returns
+    -------
+    n_operations: int
+        All operations, including function calls.
+    n_expensive: int
+        Only calls to EXPENSIVE_FUNCTIONS.
+    """
+    parsed = [parse_expression(expression) for expression in expressions]
+    return (
+        sum(sympy.count_ops(expression) for expression in parsed),
+        sum(
+            expression.count(function)
+            for expression in parsed
+            for function in EXPENSIVE_FUNCTIONS
+        ),
+    )
 
 
 def is_valid_combination(part_daily, part_day_mod, part_annual):
@@ -306,17 +600,93 @@ def get_full_expression(part_daily, part_day_mod, part_annual):
     -------
     expression: str
     """
-    return (
-        "{0:s} * {1:s} + {2:s} + "
-        "resid_coef * exp(-tdata / (resid_timescale * DAYS_PER_FORTNIGHT)) + "
-        "ec_coef * exp(-tdata / ec_timescale * HOURS_PER_DAY)"
-    ).format(
+    return "{0:s} * {1:s} + {2:s} + {3:s}".format(
         part_daily.get_expression(CorrelationPart.DAILY),
         part_day_mod.get_expression(CorrelationPart.DAILY_MODULATION),
         part_annual.get_expression(CorrelationPart.ANNUAL),
+        RESID_EC_EXPRESSION,
     )
 
-def get_full_parameter_list(part_daily, part_day_mod, part_annual):
+
+def get_full_derivative(part_daily, part_day_mod, part_annual):
+    """Get the derivatives of the full expression with the given parts.
+
+    Put together from :meth:`PartForm.get_derivative` the same way the
+    generated kernels do it.
+
+    Parameters
+    ----------
+    part_daily: PartForm
+    part_day_mod: PartForm
+    part_annual: PartForm
+
+    Returns
+    -------
+    list of str
+        One for each parameter in :func:`get_full_parameter_list`.
+    """
+    daily_expression = part_daily.get_expression(CorrelationPart.DAILY)
+    day_mod_expression = part_day_mod.get_expression(
+        CorrelationPart.DAILY_MODULATION
+    )
+    result = [
+        "{0:s} * ({1:s})".format(piece, day_mod_expression)
+        for piece in part_daily.get_derivative(CorrelationPart.DAILY)
+    ]
+    result.extend(
+        "({0:s}) * {1:s}".format(daily_expression, piece)
+        for piece in part_day_mod.get_derivative(
+            CorrelationPart.DAILY_MODULATION
+        )
+    )
+    result.extend(part_annual.get_derivative(CorrelationPart.ANNUAL))
+    result.extend(
+        differentiate_expression(RESID_EC_EXPRESSION, RESID_EC_PARAMETERS)
+    )
+    return result
+
+def get_loop_expressions(part_daily, part_day_mod, part_annual):
+    """Get what the loop kernels compute at each lag.
+
+    The daily, daily modulation, and annual parts and their
+    derivatives, with their common subexpressions named.  The functions
+    of the lags alone are in the basis, for the kernels to look up
+    from a :class:`lag_grids.LagGrid`, and the exponential decays are
+    named so the kernels can find them by recurrence on evenly spaced
+    lags.
+
+    Parameters
+    ----------
+    part_daily: PartForm
+    part_day_mod: PartForm
+    part_annual: PartForm
+
+    Returns
+    -------
+    subexpressions: CommonSubexpressions
+        The reduced expressions are the three parts, then the
+        derivatives of each part in turn.
+    expressions: list of str
+        The same expressions without any names, for comparison.
+    """
+    parts = list(zip(
+        (part_daily, part_day_mod, part_annual),
+        (CorrelationPart.DAILY, CorrelationPart.DAILY_MODULATION,
+         CorrelationPart.ANNUAL),
+    ))
+    expressions = [form.get_expression(part) for form, part in parts]
+    for form, part in parts:
+        expressions.extend(form.get_derivative(part))
+    return (
+        eliminate_common_subexpressions(
+            expressions, cache_lag_functions=True, name_decays=True
+        ),
+        expressions,
+    )
+
+
+def get_full_parameter_list(part_daily, part_day_mod, part_annual,
+                            linear=None):
     """Get the full parameter list for the given expression.
 
     Parameters
@@ -324,6 +694,9 @@ def get_full_parameter_list(part_daily, part_day_mod, part_annual):
     part_daily: PartForm
     part_day_mod: PartForm
     part_annual: PartForm
+    linear: bool, optional
+        True for only the linear parameters, False for only the rest,
+        None for all of them.  See :meth:`PartForm.get_parameters`.
 
     Returns
     -------
@@ -336,11 +709,86 @@ def get_full_parameter_list(part_daily, part_day_mod, part_annual):
             (CorrelationPart.DAILY, CorrelationPart.DAILY_MODULATION,
              CorrelationPart.ANNUAL),
         )
-        for param in form.get_parameters(time)
+        for param in form.get_parameters(time, linear)
     ]
-    result.extend(["resid_coef", "resid_timescale", "ec_coef", "ec_timescale"])
+    result.extend(
+        param
+        for param, is_linear in (
+            ("resid_coef", True), ("resid_timescale", False),
+            ("ec_coef", True), ("ec_timescale", False),
+        )
+        if linear is None or is_linear == linear
+    )
     return result
 
+
+def check_derivatives(part_daily, part_day_mod, part_annual, tdata=None,
+                      rtol=1e-5):
+    """Compare the derivatives with central finite differences.
+
+    Parameters
+    ----------
+    part_daily: PartForm
+    part_day_mod: PartForm
+    part_annual: PartForm
+    tdata: np.ndarray[N], optional
+        The lags, in days.  Defaults to two years of lags.
+    rtol: float
+        The largest allowed difference, relative to the largest
+        derivative.
+
+    Raises
+    ------
+    ValueError
+        If any derivative is off by more than rtol.
+    """
+    if tdata is None:
+        tdata = np.linspace(0, 2 * DAYS_PER_YEAR, 4001)
+    tdata = np.asarray(tdata, dtype=np.float64)
+    parameter_list = get_full_parameter_list(
+        part_daily, part_day_mod, part_annual
+    )
+    parameters = dict(zip(
+        parameter_list, np.linspace(0.5, 1.5, len(parameter_list))
+    ))
+    expression = get_full_expression(part_daily, part_day_mod, part_annual)
+    bad_parameters = []
+    for param, derivative in zip(
+            parameter_list,
+            get_full_derivative(part_daily, part_day_mod, part_annual)
+    ):
+        step = 1e-6 * parameters[param]
+        differences = []
+        for sign in (1, -1):
+            local_dict = parameters.copy()
+            local_dict[param] += sign * step
+            local_dict["tdata"] = tdata
+            differences.append(ne.evaluate(
+                expression, local_dict=local_dict, global_dict=GLOBAL_DICT
+            ))
+        finite_difference = (differences[0] - differences[1]) / (2 * step)
+        local_dict = parameters.copy()
+        local_dict["tdata"] = tdata
+        exact = np.broadcast_to(
+            ne.evaluate(
+                derivative, local_dict=local_dict, global_dict=GLOBAL_DICT
+            ),
+            tdata.shape,
+        )
+        scale = max(np.max(np.abs(exact)), np.finfo(np.float64).tiny)
+        if np.max(np.abs(exact - finite_difference)) > rtol * scale:
+            bad_parameters.append(param)
+    if bad_parameters:
+        raise ValueError(
+            "Derivatives of d{0:s}_dm{1:s}_a{2:s} disagree with finite "
+            "differences for {3!s:s}".format(
+                part_daily.get_short_name(),
+                part_day_mod.get_short_name(),
+                part_annual.get_short_name(),
+                bad_parameters,
+            )
+        )
+
 def get_weighted_fit_expression(part_daily, part_day_mod, part_annual):
     """Get the full expression with the given parts.
 
@@ -371,6 +819,170 @@ def get_weighted_fit_expression(part_daily, part_day_mod, part_annual):
         .format(get_full_expression(part_daily, part_day_mod, part_annual))
     )
 
+def substitute_constants(expression, constants=GLOBAL_DICT):
+    """Write the values of the constants into an expression.
+
+    Parameters
+    ----------
+    expression: str
+    constants: dict
+
+    Returns
+    -------
+    str
+    """
+    return re.sub(
+        r"\b(?:{0:s})\b".format("|".join(constants)),
+        lambda match: repr(float(constants[match.group(0)])),
+        expression,
+    )
+
+
+def get_numexpr_program(expression, array_names, parameter_names,
+                        array_type=np.float64):
+    """Compile an expression to a numexpr program.
+
+    The constants from GLOBAL_DICT are written into the expression, so
+    the program only takes the arrays, then the float64 parameters, in
+    order.  Compiling once avoids parsing the expression on each call.
+
+    Parameters
+    ----------
+    expression: str
+    array_names: list of str
+    parameter_names: list of str
+    array_type: type or list of type
+        The type of the arrays, or of each array.  Numexpr calls single
+        precision ``float`` and double precision ``np.float64``.
+
+    Returns
+    -------
+    numexpr.NumExpr
+    """
+    if not isinstance(array_type, (list, tuple)):
+        array_type = [array_type] * len(array_names)
+    return ne.NumExpr(
+        substitute_constants(expression),
+        signature=(
+            list(zip(array_names, array_type)) +
+            [(name, np.float64) for name in parameter_names]
+        ),
+    )
+
+
+def get_numexpr_programs(expression, array_names, parameter_names,
+                         steps=()):
+    """Compile an expression for each type of array the kernels take.
+
+    This is what the generated ``*_fit_ne`` and ``*_curve_ne`` kernels
+    run.  Each program takes only the arrays and parameters it uses.
+
+    Parameters
+    ----------
+    expression: str
+    array_names: list of str
+    parameter_names: list of str
+    steps: list of (str, str)
+        (name, expression) pairs for the common subexpressions, each
+        worked out into a float64 array before anything uses it.
+
+    Returns
+    -------
+    dict
+        For each type in NUMEXPR_TYPES, a list of (program, array index,
+        parameter index) for the steps, and the same for the
+        expression, for :func:`run_numexpr_programs`.
+    """
+    steps = tuple(steps)
+    result = {}
+    for dtype, array_type in NUMEXPR_TYPES.items():
+        names = list(array_names)
+        types = [array_type] * len(names)
+        programs = []
+        for step_name, step in steps + ((None, expression),):
+            used = set(re.findall(r"\b[A-Za-z_]\w*\b", step))
+            array_index = [
+                i for i, name in enumerate(names) if name in used
+            ]
+            parameter_index = [
+                i for i, name in enumerate(parameter_names) if name in used
+            ]
+            programs.append((
+                get_numexpr_program(
+                    step,
+                    [names[i] for i in array_index],
+                    [parameter_names[i] for i in parameter_index],
+                    [types[i] for i in array_index],
+                ),
+                array_index,
+                parameter_index,
+            ))
+            names.append(step_name)
+            types.append(np.float64)
+        result[dtype] = programs[:len(steps)], programs[len(steps)]
+    return result
+
+
+def get_numexpr_type(*arrays):
+    """Find the type the numexpr programs work in for these arrays.
+
+    Parameters
+    ----------
+    arrays: list of np.ndarray
+        Any of them may be a :class:`lag_grids.LagGrid` instead.
+
+    Returns
+    -------
+    np.dtype
+        A key of NUMEXPR_TYPES: float64 unless all the arrays are
+        single precision.
+    """
+    dtype = np.result_type(*[
+        array.lags if isinstance(array, LagGrid) else np.asarray(array)
+        for array in arrays
+    ])
+    if dtype not in NUMEXPR_TYPES:
+        dtype = np.dtype(np.float64)
+    return dtype
+
+
+def run_numexpr_programs(programs, arrays, parameters, out=None):
+    """Run the programs for the type of the arrays.
+
+    Parameters
+    ----------
+    programs: dict
+        From :func:`get_numexpr_programs`.
+    arrays: list of np.ndarray
+        Any of them may be a :class:`lag_grids.LagGrid` instead.
+    parameters: list of float
+    out: np.ndarray, optional
+
+    Returns
+    -------
+    np.ndarray
+        The value of the expression, in out if given.
+    """
+    arrays = [
+        array.lags if isinstance(array, LagGrid) else np.asarray(array)
+        for array in arrays
+    ]
+    dtype = get_numexpr_type(*arrays)
+    arrays = [np.asarray(array, dtype=dtype) for array in arrays]
+    steps, (program, array_index, parameter_index) = programs[dtype]
+    for step_program, step_array_index, step_parameter_index in steps:
+        arrays.append(step_program(
+            *[arrays[i] for i in step_array_index],
+            *[parameters[i] for i in step_parameter_index],
+            ex_uses_vml=ne.use_vml,
+        ))
+    return program(
+        *[arrays[i] for i in array_index],
+        *[parameters[i] for i in parameter_index],
+        out=out,
+        casting="same_kind",
+        ex_uses_vml=ne.use_vml,
+    )
 
 if __name__ == "__main__":
     print("Reading coefficient data", flush=True)
@@ -411,6 +1023,16 @@ if __name__ == "__main__":
     # In units of days
     tower_lags = tower_lags.astype(np.float32) / HOURS_PER_DAY
 
+    fit_programs = {
+        forms: get_numexpr_program(
+            get_weighted_fit_expression(*forms),
+            ("tdata", "empirical_correlogram", "num_pairs"),
+            get_full_parameter_list(*forms),
+        )
+        for forms in itertools.product(PartForm, PartForm, PartForm)
+        if is_valid_combination(*forms)
+    }
+
     topk_fits = {}
     topk_counts = collections.Counter()
     np.set_printoptions(formatter={"float": "{0:11.0f}".format})
@@ -421,12 +1043,14 @@ if __name__ == "__main__":
         tdata = tdata[num_pairs > 0]
         num_pairs = num_pairs[num_pairs > 0]
         empirical_correlogram = corr_data.loc[num_pairs.index, tower]
+        # The parameters are float64, so numexpr would do the sums in
+        # float64 anyway
+        tower_arrays = [
+            np.asarray(array, dtype=np.float64)
+            for array in (tdata, empirical_correlogram, num_pairs)
+        ]
         fit_quality = {}
-        for form_daily, form_day_mod, form_annual in itertools.product(
-                PartForm, PartForm, PartForm
-        ):
-            if not is_valid_combination(form_daily, form_day_mod, form_annual):
-                continue
+        for form_daily, form_day_mod, form_annual in fit_programs:
             try:
                 tower_coefficients = dict(coef_data.loc[
                     (
@@ -450,14 +1074,17 @@ if __name__ == "__main__":
                 tower_coefficients[newname + "_timescale"] = (
                     tower_coefficients[oldname]
                 )
-            local_dict = tower_coefficients.copy()
-            local_dict["num_pairs"] = num_pairs
-            local_dict["tdata"] = tdata
-            local_dict["empirical_correlogram"] = empirical_correlogram
-            fit_quality[form_daily, form_day_mod, form_annual] = ne.evaluate(
-                get_weighted_fit_expression(form_daily, form_day_mod, form_annual),
-                local_dict=local_dict,
-                global_dict=GLOBAL_DICT
+            fit_quality[form_daily, form_day_mod, form_annual] = fit_programs[
+                form_daily, form_day_mod, form_annual
+            ](
+                *tower_arrays,
+                *[
+                    tower_coefficients[param]
+                    for param in get_full_parameter_list(
+                        form_daily, form_day_mod, form_annual
+                    )
+                ],
+                ex_uses_vml=ne.use_vml
             )
         sorted_fits = sorted(
             list(fit_quality.keys()),
@@ -0,0 +1,54 @@
+# ~*~ coding: utf8 ~*~
+"""Pick the build of the generated correlation-function kernels.
+
+"cython" uses the extension modules built by
+``make_correlation_function_fit_deriv.py``, gathered in
+flux_correlation_function_fits.  "numba" uses
+:mod:`numba_correlation_function_fits`, which compiles the same
+kernels at first use and needs no build step.  The kernels are looked
+up here by name, as in
+``getattr(correlation_function_kernels, "d0_dm0_a0_curve_loop")``.
+
+The backend comes from the CORRELATION_KERNEL_BACKEND environment
+variable, so worker processes use the same one as their parent.
+"""
+from __future__ import print_function, division
+
+import importlib
+import os
+
+KERNEL_MODULES = {
+    "cython": "flux_correlation_function_fits",
+    "numba": "numba_correlation_function_fits",
+}
+KERNEL_BACKEND = os.environ.get("CORRELATION_KERNEL_BACKEND", "cython")
+
+
+def get_kernel_module(backend=None):
+    """Get the module with the kernels.
+
+    Parameters
+    ----------
+    backend: str, optional
+        A key of KERNEL_MODULES.  Defaults to KERNEL_BACKEND.
+
+    Returns
+    -------
+    module
+    """
+    if backend is None:
+        backend = KERNEL_BACKEND
+    try:
+        module_name = KERNEL_MODULES[backend]
+    except KeyError:
+        raise ValueError(
+            "Unknown kernel backend {0!r:s}; choose one of {1!r:s}".format(
+                backend, sorted(KERNEL_MODULES)
+            )
+        )
+    return importlib.import_module(module_name)
+
+
+def __getattr__(name):
+    """Find a kernel in the current backend."""
+    return getattr(get_kernel_module(), name)
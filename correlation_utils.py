@@ -2,9 +2,33 @@
 """Utilities for correlations."""
 from __future__ import print_function, division
 
+import collections
+import itertools
+
 import numpy as np
 import pandas as pd
-from statsmodels.tsa.stattools import acovf, acf
+import scipy.fft
+
+AutocorrelationArrays = collections.namedtuple(
+    "AutocorrelationArrays", ["acf", "acovf", "pair_counts"]
+)
+LagSums = collections.namedtuple(
+    "LagSums",
+    [
+        "pair_counts", "sum_products",
+        "sum_first", "sum_second",
+        "sum_squares_first", "sum_squares_second",
+    ],
+)
+LagSums.__doc__ = """Sums over all pairs of valid points at each lag.
+
+For lag k, "first" refers to x[t] and "second" to x[t + k], summed
+over all t where both are present.  The last axis is the lag axis.
+"""
+
+# The direct method costs about N * K multiply-adds per sum; the FFT
+# method costs about this many times N log2(N) for all sums together.
+FFT_COST_FACTOR = 3
 
 
 def count_pairs(col):
@@ -18,23 +42,235 @@ def count_pairs(col):
     -------
     n_pairs: np.ndarray
     """
-    have_data = ~col.isnull()
+    have_data = ~col.isnull().values
     n_data = len(col)
-    embedded = np.zeros(2 * n_data - 1)
-    embedded[:n_data] = have_data
-    spectrum = np.fft.fft(embedded)
+    fft_len = scipy.fft.next_fast_len(2 * n_data - 1, real=True)
+    spectrum = scipy.fft.rfft(have_data.astype(np.float64), fft_len)
     pair_count = np.round(
-        np.fft.ifft(spectrum.conj() * spectrum, n_data).real
-    ).astype(int)
+        scipy.fft.irfft(spectrum.real ** 2 + spectrum.imag ** 2, fft_len)
+    )[:n_data].astype(int)
     return pair_count
 
 
-def get_autocorrelation_stats(column):
+def _lag_sums_direct(data, mask, n_lags):
+    """Find the lag sums with one dot product per lag.
+
+    Parameters
+    ----------
+    data: np.ndarray[..., N]
+        Zero where mask is zero.
+    mask: np.ndarray[..., N]
+    n_lags: int
+
+    Returns
+    -------
+    LagSums
+    """
+    n_times = data.shape[-1]
+    squares = data ** 2
+    result = LagSums(
+        *[np.empty(data.shape[:-1] + (n_lags,)) for _ in LagSums._fields]
+    )
+    for lag in range(n_lags):
+        first = slice(None, n_times - lag)
+        second = slice(lag, None)
+        result.pair_counts[..., lag] = np.sum(
+            mask[..., first] * mask[..., second], axis=-1
+        )
+        result.sum_products[..., lag] = np.sum(
+            data[..., first] * data[..., second], axis=-1
+        )
+        result.sum_first[..., lag] = np.sum(
+            data[..., first] * mask[..., second], axis=-1
+        )
+        result.sum_second[..., lag] = np.sum(
+            mask[..., first] * data[..., second], axis=-1
+        )
+        result.sum_squares_first[..., lag] = np.sum(
+            squares[..., first] * mask[..., second], axis=-1
+        )
+        result.sum_squares_second[..., lag] = np.sum(
+            mask[..., first] * squares[..., second], axis=-1
+        )
+    return result
+
+
+def _lag_sums_fft(data, mask, n_lags):
+    """Find the lag sums from one shared set of real FFTs.
+
+    Three forward transforms (mask, data, squared data) and four
+    inverse transforms give all six sums: the cross-correlations of
+    data and squared data with the mask give the sums over the first
+    point at positive lags and over the second point at negative lags.
+
+    Parameters
+    ----------
+    data: np.ndarray[..., N]
+        Zero where mask is zero.
+    mask: np.ndarray[..., N]
+    n_lags: int
+
+    Returns
+    -------
+    LagSums
+    """
+    n_times = data.shape[-1]
+    # Enough zero-padding that the circular correlation from the FFT
+    # matches the linear correlation out to n_lags - 1 in both
+    # directions
+    fft_len = scipy.fft.next_fast_len(n_times + n_lags - 1, real=True)
+    mask_spectrum, data_spectrum, squares_spectrum = scipy.fft.rfft(
+        np.stack([mask, data, data ** 2]), fft_len, axis=-1
+    )
+    mask_spectrum_conj = mask_spectrum.conj()
+    correlations = scipy.fft.irfft(
+        np.stack([
+            mask_spectrum_conj * mask_spectrum,
+            data_spectrum.conj() * data_spectrum,
+            data_spectrum.conj() * mask_spectrum,
+            squares_spectrum.conj() * mask_spectrum,
+        ]),
+        fft_len,
+        axis=-1,
+    )
+    # Index fft_len - k holds lag -k
+    negative_lags = (-np.arange(n_lags)) % fft_len
+    return LagSums(
+        pair_counts=np.round(correlations[0, ..., :n_lags]),
+        sum_products=correlations[1, ..., :n_lags],
+        sum_first=correlations[2, ..., :n_lags],
+        sum_second=np.take(correlations[2], negative_lags, axis=-1),
+        sum_squares_first=correlations[3, ..., :n_lags],
+        sum_squares_second=np.take(correlations[3], negative_lags, axis=-1),
+    )
+
+
+def get_lag_sums(data, have_data=None, max_lag=None, method="auto"):
+    """Find the per-lag sums needed for ACFs and variograms.
+
+    Parameters
+    ----------
+    data: np.ndarray[..., N]
+        Must be regularly spaced along the last axis.  Missing values
+        may be NaN.
+    have_data: np.ndarray[..., N] of bool, optional
+        Which values to use.  Non-finite values of data are always
+        treated as missing.
+    max_lag: int, optional
+        The largest lag to compute.  Defaults to N - 1.
+    method: {"auto", "fft", "direct"}
+        The direct method is O(N * max_lag) and is faster for small
+        max_lag.  "auto" picks whichever should be faster.
+
+    Returns
+    -------
+    LagSums
+        Each sum is a float64 array of shape [..., max_lag + 1].
+    """
+    data = np.asarray(data, dtype=np.float64)
+    mask = np.isfinite(data)
+    if have_data is not None:
+        mask &= have_data
+    n_times = data.shape[-1]
+    if max_lag is None:
+        max_lag = n_times - 1
+    n_lags = min(max_lag, n_times - 1) + 1
+    data = np.where(mask, data, 0)
+    mask = mask.astype(np.float64)
+    if method == "auto":
+        fft_len = scipy.fft.next_fast_len(n_times + n_lags - 1, real=True)
+        if n_times * n_lags < FFT_COST_FACTOR * fft_len * np.log2(fft_len):
+            method = "direct"
+        else:
+            method = "fft"
+    if method == "direct":
+        return _lag_sums_direct(data, mask, n_lags)
+    if method == "fft":
+        return _lag_sums_fft(data, mask, n_lags)
+    raise ValueError("Unknown method: {method!r}".format(method=method))
+
+
+def autocorrelation_from_lag_sums(lag_sums):
+    """Find the conservative missing-data ACF and autocovariance.
+
+    This matches ``acovf(x, missing="conservative", adjusted=True)``
+    from statsmodels: the series is demeaned using all non-missing
+    values and each lag is divided by the number of pairs at that
+    lag.
+
+    Parameters
+    ----------
+    lag_sums: LagSums
+
+    Returns
+    -------
+    AutocorrelationArrays
+    """
+    pair_counts = lag_sums.pair_counts
+    n_valid = pair_counts[..., :1]
+    mean = lag_sums.sum_first[..., :1] / np.maximum(n_valid, 1)
+    # sum((x[t] - mean) * (x[t + k] - mean)) over pairs
+    centered_products = (
+        lag_sums.sum_products -
+        mean * (lag_sums.sum_first + lag_sums.sum_second) +
+        mean ** 2 * pair_counts
+    )
+    acovf_result = centered_products / np.maximum(pair_counts, 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        acf_result = acovf_result / acovf_result[..., :1]
+    return AutocorrelationArrays(
+        acf_result.astype(np.float32),
+        acovf_result.astype(np.float32),
+        pair_counts.astype(np.int32),
+    )
+
+
+def get_autocorrelation_arrays(
+        data, have_data=None, max_lag=None, method="auto"
+):
+    """Get ACF, autocovariance, and pair counts for data.
+
+    Single-pass replacement for statsmodels' acovf and acf with
+    ``missing="conservative"`` and :func:`count_pairs`.
+
+    Parameters
+    ----------
+    data: np.ndarray[..., N]
+        Must be regularly spaced along the last axis.  Missing values
+        may be NaN.
+    have_data: np.ndarray[..., N] of bool, optional
+    max_lag: int, optional
+        Defaults to N - 1.
+    method: {"auto", "fft", "direct"}
+
+    Returns
+    -------
+    AutocorrelationArrays
+        acf and acovf are float32, pair_counts is int32.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    mask = np.isfinite(data)
+    if have_data is not None:
+        mask &= have_data
+    # Removing the mean first avoids cancellation in the lag sums.
+    # The remaining correction in autocorrelation_from_lag_sums is
+    # then tiny.
+    n_valid = np.sum(mask, axis=-1, keepdims=True)
+    mean = np.sum(
+        np.where(mask, data, 0), axis=-1, keepdims=True
+    ) / np.maximum(n_valid, 1)
+    lag_sums = get_lag_sums(data - mean, mask, max_lag, method)
+    return autocorrelation_from_lag_sums(lag_sums)
+
+
+def get_autocorrelation_stats(column, max_lag=None):
     """Get ACF and pair counts for column.
 
     Parameters
     ----------
     column: pd.Series
+    max_lag: int, optional
+        The largest lag to find, in multiples of the series frequency.
 
     Returns
     -------
@@ -44,18 +280,551 @@ def get_autocorrelation_stats(column):
     # missing values.  I should look into that.
     column = column.dropna().resample(column.index.freq).mean()
     time_index = column.index
-    n_lags = len(column.index)
+    acf_arrays = get_autocorrelation_arrays(column.values, max_lag=max_lag)
+    n_lags = len(acf_arrays.acf)
     timedelta_index = pd.timedelta_range(
         start=0, freq=time_index.freq, periods=n_lags
     )
     result = pd.DataFrame(
-        index=timedelta_index, columns=["acf", "acovf", "pair_counts"]
-    )
-    result.loc[:, "acovf"] = acovf(
-        column, missing="conservative", unbiased=True, fft=True,
-    ).astype(np.float32)
-    result.loc[:, "acf"] = acf(
-        column, missing="conservative", nlags=n_lags, adjusted=True, fft=True
-    ).astype(np.float32)
-    result.loc[:, "pair_counts"] = count_pairs(column)
+        {
+            "acf": acf_arrays.acf,
+            "acovf": acf_arrays.acovf,
+            "pair_counts": acf_arrays.pair_counts,
+        },
+        index=timedelta_index,
+    )
     return result
+
+
+def get_autocorrelation_stats_batched(
+        data, have_data=None, max_lag=None, sites_per_block=None,
+        method="auto",
+):
+    """Get ACF, autocovariance, and pair counts for many sites at once.
+
+    :func:`get_autocorrelation_arrays` for blocks of sites, with the
+    lags past the end of each site's record blanked out as
+    :func:`get_autocorrelation_stats` does by trimming the series.
+
+    Parameters
+    ----------
+    data: np.ndarray[N_sites, N_times]
+        Must be regularly spaced in time.  Missing values may be NaN.
+    have_data: np.ndarray[N_sites, N_times] of bool, optional
+        Which values to use.  Non-finite values of data are always
+        treated as missing.
+    max_lag: int, optional
+        The largest lag to return.  Defaults to N_times - 1.
+    sites_per_block: int, optional
+        How many sites to transform at once, to bound memory use.
+        Defaults to all sites.
+    method: {"auto", "fft", "direct"}
+        Passed on to :func:`get_lag_sums`.
+
+    Returns
+    -------
+    AutocorrelationArrays
+        Tuple of acf and acovf, float32 arrays of shape
+        [N_sites, max_lag + 1], and pair_counts, an int32 array of the
+        same shape.  The acf and acovf are NaN at lags longer than the
+        record for that site.
+    """
+    data = np.atleast_2d(data)
+    finite_data = np.isfinite(data)
+    if have_data is None:
+        have_data = finite_data
+    else:
+        have_data = np.atleast_2d(have_data) & finite_data
+    n_sites, n_times = data.shape
+    if max_lag is None:
+        max_lag = n_times - 1
+    n_lags = min(max_lag, n_times - 1) + 1
+    if sites_per_block is None:
+        sites_per_block = max(n_sites, 1)
+    lags = np.arange(n_lags)
+
+    acf_result = np.empty((n_sites, n_lags), dtype=np.float32)
+    acovf_result = np.empty((n_sites, n_lags), dtype=np.float32)
+    pair_count_result = np.empty((n_sites, n_lags), dtype=np.int32)
+
+    for start in range(0, n_sites, sites_per_block):
+        block = slice(start, start + sites_per_block)
+        block_mask = have_data[block]
+        block_arrays = get_autocorrelation_arrays(
+            data[block], block_mask, max_lag, method
+        )
+        # Only report lags within each site's record, as statsmodels
+        # does for the trimmed series.
+        first_valid = block_mask.argmax(axis=1)
+        last_valid = n_times - 1 - block_mask[:, ::-1].argmax(axis=1)
+        record_length = np.where(
+            block_mask.any(axis=1), last_valid - first_valid + 1, 0
+        )
+        outside_record = lags[np.newaxis, :] >= record_length[:, np.newaxis]
+        block_arrays.acf[outside_record] = np.nan
+        block_arrays.acovf[outside_record] = np.nan
+
+        acf_result[block] = block_arrays.acf
+        acovf_result[block] = block_arrays.acovf
+        pair_count_result[block] = block_arrays.pair_counts
+
+    return AutocorrelationArrays(acf_result, acovf_result, pair_count_result)
+
+
+class AutocorrelationAccumulator(object):
+    """Running per-lag sums for autocorrelations of growing records.
+
+    Appending a block of new data only transforms that block and the
+    ``max_lag`` values before it: the sums for the block joined to
+    the previous tail, minus the sums for the tail alone, are the
+    sums over the new pairs.  The ACF computed from the accumulated
+    sums matches :func:`get_autocorrelation_stats` on the whole
+    record.
+
+    Values are stored relative to a fixed offset per site, the mean
+    of the first data seen for that site, to avoid cancellation in
+    the sums as the record grows.
+
+    Parameters
+    ----------
+    max_lag: int
+    site_names: list of str
+    freq: str
+        Spacing of the data, for :meth:`get_autocorrelation_stats`.
+    """
+
+    def __init__(self, max_lag, site_names, freq="1H"):
+        self.max_lag = int(max_lag)
+        self.site_names = list(site_names)
+        self.freq = freq
+        n_sites = len(self.site_names)
+        n_lags = self.max_lag + 1
+        self.n_times = 0
+        self.offsets = np.full(n_sites, np.nan)
+        self.first_valid = np.full(n_sites, -1, dtype=np.int64)
+        self.last_valid = np.full(n_sites, -1, dtype=np.int64)
+        self.lag_sums = LagSums(
+            *[np.zeros((n_sites, n_lags)) for _ in LagSums._fields]
+        )
+        self.tail_data = np.zeros((n_sites, 0))
+        self.tail_mask = np.zeros((n_sites, 0))
+
+    def _get_lag_sums(self, data, mask, method):
+        """Find lag sums padded out to max_lag.
+
+        Parameters
+        ----------
+        data: np.ndarray[N_sites, N]
+            Zero where mask is zero.
+        mask: np.ndarray[N_sites, N]
+        method: str
+
+        Returns
+        -------
+        LagSums
+        """
+        n_lags = self.max_lag + 1
+        result = LagSums(
+            *[np.zeros((len(self.site_names), n_lags))
+              for _ in LagSums._fields]
+        )
+        if data.shape[-1] == 0:
+            return result
+        lag_sums = get_lag_sums(data, mask > 0, self.max_lag, method)
+        for total, part in zip(result, lag_sums):
+            total[:, :part.shape[-1]] = part
+        return result
+
+    def append(self, data, have_data=None, method="auto"):
+        """Add data following on directly from what is already here.
+
+        Parameters
+        ----------
+        data: np.ndarray[N_sites, N_new]
+            Regularly spaced at freq.  Missing values may be NaN.
+        have_data: np.ndarray[N_sites, N_new] of bool, optional
+        method: {"auto", "fft", "direct"}
+            Passed on to :func:`get_lag_sums`.
+        """
+        data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+        mask = np.isfinite(data)
+        if have_data is not None:
+            mask &= np.atleast_2d(have_data)
+        n_new = data.shape[-1]
+        if n_new == 0:
+            return
+        n_valid = mask.sum(axis=-1)
+
+        new_offsets = np.isnan(self.offsets) & (n_valid > 0)
+        self.offsets[new_offsets] = (
+            np.where(mask, data, 0).sum(axis=-1)[new_offsets] /
+            n_valid[new_offsets]
+        )
+        shifted_data = np.where(
+            mask, data - np.nan_to_num(self.offsets)[:, np.newaxis], 0
+        )
+
+        combined_data = np.concatenate([self.tail_data, shifted_data], axis=-1)
+        combined_mask = np.concatenate(
+            [self.tail_mask, mask.astype(np.float64)], axis=-1
+        )
+        combined_sums = self._get_lag_sums(combined_data, combined_mask, method)
+        tail_sums = self._get_lag_sums(self.tail_data, self.tail_mask, method)
+        for total, combined, tail in zip(
+                self.lag_sums, combined_sums, tail_sums
+        ):
+            total += combined - tail
+        # The pair counts are integers and should stay that way
+        np.round(self.lag_sums.pair_counts, out=self.lag_sums.pair_counts)
+
+        has_new = n_valid > 0
+        first_new = self.n_times + mask.argmax(axis=-1)
+        last_new = self.n_times + n_new - 1 - mask[:, ::-1].argmax(axis=-1)
+        self.first_valid = np.where(
+            (self.first_valid < 0) & has_new, first_new, self.first_valid
+        )
+        self.last_valid = np.where(has_new, last_new, self.last_valid)
+        self.n_times += n_new
+        self.tail_data = combined_data[:, -self.max_lag:].copy()
+        self.tail_mask = combined_mask[:, -self.max_lag:].copy()
+        if self.max_lag == 0:
+            self.tail_data = self.tail_data[:, :0]
+            self.tail_mask = self.tail_mask[:, :0]
+
+    def get_autocorrelation_arrays(self):
+        """Get ACF, autocovariance, and pair counts for every site.
+
+        Returns
+        -------
+        AutocorrelationArrays
+            As from :func:`get_autocorrelation_stats_batched`, with
+            max_lag + 1 lags and NaN past the end of each record.
+        """
+        acf_arrays = autocorrelation_from_lag_sums(self.lag_sums)
+        record_length = np.where(
+            self.first_valid >= 0, self.last_valid - self.first_valid + 1, 0
+        )
+        outside_record = (
+            np.arange(self.max_lag + 1)[np.newaxis, :] >=
+            record_length[:, np.newaxis]
+        )
+        acf_arrays.acf[outside_record] = np.nan
+        acf_arrays.acovf[outside_record] = np.nan
+        return acf_arrays
+
+    def get_autocorrelation_stats(self, site_name):
+        """Get ACF and pair counts for one site.
+
+        Parameters
+        ----------
+        site_name: str
+
+        Returns
+        -------
+        pd.DataFrame
+            The same as :func:`get_autocorrelation_stats` for the
+            whole record of that site.
+        """
+        site_index = self.site_names.index(site_name)
+        acf_arrays = autocorrelation_from_lag_sums(
+            LagSums(*[sums[site_index] for sums in self.lag_sums])
+        )
+        record_length = self.last_valid[site_index] - self.first_valid[
+            site_index
+        ] + 1
+        n_lags = min(self.max_lag + 1, record_length)
+        timedelta_index = pd.timedelta_range(
+            start=0, freq=self.freq, periods=n_lags
+        )
+        return pd.DataFrame(
+            {
+                "acf": acf_arrays.acf[:n_lags],
+                "acovf": acf_arrays.acovf[:n_lags],
+                "pair_counts": acf_arrays.pair_counts[:n_lags],
+            },
+            index=timedelta_index,
+        )
+
+    def save(self, file_name):
+        """Write the accumulator state to file_name.
+
+        Parameters
+        ----------
+        file_name: str
+            Should end in ``.npz``.
+        """
+        np.savez_compressed(
+            file_name,
+            max_lag=self.max_lag,
+            site_names=np.array(self.site_names, dtype=str),
+            freq=np.array(self.freq, dtype=str),
+            n_times=self.n_times,
+            offsets=self.offsets,
+            first_valid=self.first_valid,
+            last_valid=self.last_valid,
+            tail_data=self.tail_data,
+            tail_mask=self.tail_mask,
+            **self.lag_sums._asdict()
+        )
+
+    @classmethod
+    def load(cls, file_name):
+        """Read an accumulator written by :meth:`save`.
+
+        Parameters
+        ----------
+        file_name: str
+
+        Returns
+        -------
+        AutocorrelationAccumulator
+        """
+        with np.load(file_name) as state:
+            result = cls(
+                int(state["max_lag"]),
+                [str(name) for name in state["site_names"]],
+                str(state["freq"]),
+            )
+            result.n_times = int(state["n_times"])
+            result.offsets = state["offsets"]
+            result.first_valid = state["first_valid"]
+            result.last_valid = state["last_valid"]
+            result.tail_data = state["tail_data"]
+            result.tail_mask = state["tail_mask"]
+            result.lag_sums = LagSums(
+                *[state[name] for name in LagSums._fields]
+            )
+        return result
+
+
+def _cross_lag_sums_fft(first_data, first_mask, second_data, second_mask,
+                        n_lags):
+    """Find lag sums where the two points come from different series.
+
+    The sums are as in :class:`LagSums`, with x[t] taken from the
+    first series and x[t + k] from the second.
+
+    Parameters
+    ----------
+    first_data, first_mask: np.ndarray[N_first]
+        Data is zero where mask is zero.
+    second_data, second_mask: np.ndarray[N_second]
+    n_lags: int
+
+    Returns
+    -------
+    LagSums
+    """
+    fft_len = scipy.fft.next_fast_len(
+        max(len(first_data) + n_lags - 1, len(second_data)), real=True
+    )
+    first_mask_spectrum, first_spectrum, first_squares_spectrum = (
+        scipy.fft.rfft(
+            np.stack([first_mask, first_data, first_data ** 2]),
+            fft_len,
+            axis=-1,
+        ).conj()
+    )
+    second_mask_spectrum, second_spectrum, second_squares_spectrum = (
+        scipy.fft.rfft(
+            np.stack([second_mask, second_data, second_data ** 2]),
+            fft_len,
+            axis=-1,
+        )
+    )
+    correlations = scipy.fft.irfft(
+        np.stack([
+            first_mask_spectrum * second_mask_spectrum,
+            first_spectrum * second_spectrum,
+            first_spectrum * second_mask_spectrum,
+            first_mask_spectrum * second_spectrum,
+            first_squares_spectrum * second_mask_spectrum,
+            first_mask_spectrum * second_squares_spectrum,
+        ]),
+        fft_len,
+        axis=-1,
+    )[:, :n_lags]
+    correlations[0] = np.round(correlations[0])
+    return LagSums(*correlations)
+
+
+class WindowedAutocorrelation(object):
+    """Autocorrelations for any set of blocks of one series.
+
+    The series is cut into contiguous blocks.  The lag sums for pairs
+    within each block and for pairs between each pair of blocks are
+    found once; the ACF for any union of blocks, treating the rest of
+    the series as missing, then only needs those partial sums added
+    together.  This makes it cheap to hold out each block in turn.
+
+    Parameters
+    ----------
+    data: np.ndarray[N]
+        Regularly spaced.  Missing values may be NaN.
+    block_starts: sequence of int
+        The index of the first value in each block.  The last block
+        runs to the end of data.
+    have_data: np.ndarray[N] of bool, optional
+    max_lag: int, optional
+        Defaults to N - 1.
+    freq: str
+        Spacing of the data, for :meth:`get_autocorrelation_stats`.
+    """
+
+    def __init__(self, data, block_starts, have_data=None, max_lag=None,
+                 freq="1H"):
+        data = np.asarray(data, dtype=np.float64)
+        mask = np.isfinite(data)
+        if have_data is not None:
+            mask &= have_data
+        n_times = len(data)
+        if max_lag is None:
+            max_lag = n_times - 1
+        self.max_lag = min(max_lag, n_times - 1)
+        self.freq = freq
+        self.block_starts = np.asarray(block_starts, dtype=np.int64)
+        self.block_ends = np.append(self.block_starts[1:], n_times)
+        # Removing the overall mean first keeps the sums well
+        # conditioned; autocorrelation_from_lag_sums removes the mean
+        # of each union exactly.
+        mean = np.sum(np.where(mask, data, 0)) / max(np.sum(mask), 1)
+        data = np.where(mask, data - mean, 0)
+        mask = mask.astype(np.float64)
+
+        self.first_valid = []
+        self.last_valid = []
+        self.block_sums = []
+        for start, end in zip(self.block_starts, self.block_ends):
+            valid = np.nonzero(mask[start:end])[0]
+            if len(valid) > 0:
+                self.first_valid.append(start + valid[0])
+                self.last_valid.append(start + valid[-1])
+            else:
+                self.first_valid.append(-1)
+                self.last_valid.append(-1)
+            self.block_sums.append(get_lag_sums(
+                data[start:end], mask[start:end] > 0, self.max_lag
+            ))
+
+        # Pairs with the first point in block i and the second in
+        # block j only occur for lags from lag_start to lag_start +
+        # n_lags - 1.  Shifting the second block back by lag_start
+        # keeps the transforms only as long as that window.
+        self.pair_sums = {}
+        for i, (first_start, first_end) in enumerate(
+                zip(self.block_starts, self.block_ends)
+        ):
+            first_len = first_end - first_start
+            for j in range(i + 1, len(self.block_starts)):
+                second_start = self.block_starts[j]
+                second_end = self.block_ends[j]
+                lag_start = second_start - first_end + 1
+                lag_end = min(self.max_lag, second_end - 1 - first_start)
+                if lag_end < lag_start:
+                    continue
+                n_lags = lag_end - lag_start + 1
+                n_second = min(second_end - second_start, n_lags)
+                second_data = np.zeros(first_len + n_lags - 1)
+                second_mask = np.zeros(first_len + n_lags - 1)
+                second = slice(first_len - 1, first_len - 1 + n_second)
+                second_data[second] = data[
+                    second_start:second_start + n_second
+                ]
+                second_mask[second] = mask[
+                    second_start:second_start + n_second
+                ]
+                self.pair_sums[i, j] = (lag_start, _cross_lag_sums_fft(
+                    data[first_start:first_end], mask[first_start:first_end],
+                    second_data, second_mask, n_lags,
+                ))
+
+    def get_lag_sums(self, blocks):
+        """Find the lag sums for a union of blocks.
+
+        Parameters
+        ----------
+        blocks: sequence of int
+
+        Returns
+        -------
+        LagSums
+            Each sum has max_lag + 1 lags.
+        """
+        blocks = sorted(set(blocks))
+        n_lags = self.max_lag + 1
+        result = LagSums(*[np.zeros(n_lags) for _ in LagSums._fields])
+        for block in blocks:
+            for total, part in zip(result, self.block_sums[block]):
+                total[:len(part)] += part
+        for i, j in itertools.combinations(blocks, 2):
+            if (i, j) not in self.pair_sums:
+                continue
+            lag_start, pair_sums = self.pair_sums[i, j]
+            for total, part in zip(result, pair_sums):
+                total[lag_start:lag_start + len(part)] += part
+        return result
+
+    def _get_record_length(self, blocks):
+        """Find the time from the first to the last valid value.
+
+        Parameters
+        ----------
+        blocks: sequence of int
+
+        Returns
+        -------
+        int
+        """
+        first_valid = [
+            self.first_valid[block] for block in blocks
+            if self.first_valid[block] >= 0
+        ]
+        if not first_valid:
+            return 0
+        last_valid = max(self.last_valid[block] for block in blocks)
+        return last_valid - min(first_valid) + 1
+
+    def get_autocorrelation_arrays(self, blocks):
+        """Get ACF, autocovariance, and pair counts for a union of blocks.
+
+        Parameters
+        ----------
+        blocks: sequence of int
+
+        Returns
+        -------
+        AutocorrelationArrays
+            With max_lag + 1 lags and NaN past the end of the record.
+        """
+        acf_arrays = autocorrelation_from_lag_sums(self.get_lag_sums(blocks))
+        record_length = self._get_record_length(blocks)
+        acf_arrays.acf[record_length:] = np.nan
+        acf_arrays.acovf[record_length:] = np.nan
+        return acf_arrays
+
+    def get_autocorrelation_stats(self, blocks):
+        """Get ACF and pair counts for a union of blocks.
+
+        Parameters
+        ----------
+        blocks: sequence of int
+
+        Returns
+        -------
+        pd.DataFrame
+            The same as :func:`get_autocorrelation_stats` on the
+            series with everything outside those blocks missing.
+        """
+        acf_arrays = autocorrelation_from_lag_sums(self.get_lag_sums(blocks))
+        n_lags = min(self.max_lag + 1, self._get_record_length(blocks))
+        timedelta_index = pd.timedelta_range(
+            start=0, freq=self.freq, periods=n_lags
+        )
+        return pd.DataFrame(
+            {
+                "acf": acf_arrays.acf[:n_lags],
+                "acovf": acf_arrays.acovf[:n_lags],
+                "pair_counts": acf_arrays.pair_counts[:n_lags],
+            },
+            index=timedelta_index,
+        )
@@ -0,0 +1,259 @@
+# ~*~ coding: utf8 ~*~
+"""Compress empirical correlograms into lag bins for fitting.
+
+The fits minimize ``sum(num_pairs * (acf - f(lag)) ** 2)`` over tens
+of thousands of hourly lags, most of them at lags of years where the
+correlation functions change slowly.  Within a bin, that sum depends
+on the parameters only through the pair-weighted sums of f, f * lag,
+and f ** 2, so for f close to linear across the bin a handful of
+weighted points with the same moments gives nearly the same
+objective.  The part of the sum that does not depend on f is kept as
+``residual_sum_squares`` so the full objective can be recovered.
+
+Bins only ever combine lags at the same time of day, so the daily
+cycle is represented exactly.  Lags shorter than a month are kept
+as-is; past that, bins span more days as the lag grows, up to a
+limit that keeps the annual cycle nearly linear across each bin.
+"""
+from __future__ import print_function, division
+
+import collections
+
+import numpy as np
+
+HOURS_PER_DAY = 24
+DAYS_PER_YEAR = 365.2425
+
+# Keep every lag shorter than this, in days
+FINE_LAG_DAYS = 30
+# Width of a bin as a fraction of its lag
+RELATIVE_BIN_WIDTH = 0.05
+# Never let a bin cover more than this much of the annual cycle, in days
+MAX_BIN_WIDTH_DAYS = DAYS_PER_YEAR / 48
+
+CompressedCorrelogram = collections.namedtuple(
+    "CompressedCorrelogram",
+    ["lags", "acf", "pair_counts", "residual_sum_squares"],
+)
+CompressedCorrelogram.__doc__ = """A correlogram reduced to lag bins.
+
+The first three elements are in the order the generated ``*_fit_ne``
+and ``*_fit_loop`` kernels take them, so
+``fit_fn(params, *compressed[:3])`` works, and ``compressed.lags`` can
+be passed as tdata to the ``*_curve_*`` kernels.
+``residual_sum_squares`` is the within-bin scatter of the
+correlogram, which must be added to the compressed objective to
+approximate the full objective.
+"""
+
+
+def get_bin_edges(max_day, fine_lag_days=FINE_LAG_DAYS,
+                  relative_width=RELATIVE_BIN_WIDTH,
+                  max_width_days=MAX_BIN_WIDTH_DAYS):
+    """Get the edges of the day blocks used for lag bins.
+
+    Parameters
+    ----------
+    max_day: int
+        The last day that must be covered.
+    fine_lag_days: int
+        Blocks are one day wide before this.
+    relative_width: float
+        After that, blocks are about this fraction of their start.
+    max_width_days: float
+        Blocks are never wider than this.  Blocks always span an odd
+        number of days.
+
+    Returns
+    -------
+    np.ndarray of int
+        The first day of each block, plus one past the end.
+    """
+    edges = list(range(min(fine_lag_days, max_day + 1) + 1))
+    while edges[-1] <= max_day:
+        width = int(np.clip(
+            round(edges[-1] * relative_width), 1, max_width_days
+        ))
+        # An odd number of days puts the middle of the block on a
+        # whole day, so the points for the block stay inside it.
+        width -= 1 - width % 2
+        edges.append(edges[-1] + width)
+    return np.array(edges, dtype=np.int64)
+
+
+def compress_correlogram(lags, acf, pair_counts,
+                         steps_per_day=HOURS_PER_DAY,
+                         fine_lag_days=FINE_LAG_DAYS,
+                         relative_width=RELATIVE_BIN_WIDTH,
+                         max_width_days=MAX_BIN_WIDTH_DAYS):
+    """Reduce a correlogram to pair-count-weighted lag bins.
+
+    Each bin spanning more than one day becomes up to three points,
+    at the whole day nearest the bin centroid and a whole number of
+    days D to either side, all at the bin's time of day.  The weights
+    match the pair-weighted zeroth, first and second moments of lag
+    in the bin, and the correlogram values match the pair-weighted
+    sums of acf and acf times lag, so the objective is exact for any
+    function linear in lag across the bin.
+
+    Parameters
+    ----------
+    lags: np.ndarray[N]
+        Units are days; assumed to be multiples of 1 / steps_per_day.
+    acf: np.ndarray[N]
+    pair_counts: np.ndarray[N]
+    steps_per_day: int
+    fine_lag_days: int
+    relative_width: float
+    max_width_days: float
+
+    Returns
+    -------
+    CompressedCorrelogram
+    """
+    lags = np.asarray(lags, dtype=np.float64)
+    acf = np.asarray(acf, dtype=np.float64)
+    pair_counts = np.asarray(pair_counts, dtype=np.float64)
+    to_keep = (pair_counts > 0) & np.isfinite(acf)
+    lags = lags[to_keep]
+    acf = acf[to_keep]
+    pair_counts = pair_counts[to_keep]
+
+    steps = np.round(lags * steps_per_day).astype(np.int64)
+    day, phase = np.divmod(steps, steps_per_day)
+    edges = get_bin_edges(
+        day.max() if len(day) else 0,
+        fine_lag_days, relative_width, max_width_days,
+    )
+    block = np.searchsorted(edges, day, side="right") - 1
+    bin_keys, bin_index = np.unique(
+        block * steps_per_day + phase, return_inverse=True
+    )
+    n_bins = len(bin_keys)
+
+    def bin_sum(values):
+        """Sum values over each bin."""
+        return np.bincount(bin_index, values, n_bins)
+
+    # Moments about the whole day nearest the centroid
+    bin_pairs = bin_sum(pair_counts)
+    bin_day = np.round(bin_sum(pair_counts * day) / bin_pairs)
+    day_offset = day - bin_day[bin_index]
+    first_moment = bin_sum(pair_counts * day_offset)
+    second_moment = bin_sum(pair_counts * day_offset ** 2)
+    acf_sum = bin_sum(pair_counts * acf)
+    acf_offset_sum = bin_sum(pair_counts * acf * day_offset)
+
+    # Three points at -D, 0, +D days matching the lag moments
+    spacing = np.maximum(np.ceil(np.sqrt(second_moment / bin_pairs)), 1)
+    weight_plus = (
+        second_moment / spacing ** 2 + first_moment / spacing
+    ) / 2
+    weight_minus = (
+        second_moment / spacing ** 2 - first_moment / spacing
+    ) / 2
+    weight_center = bin_pairs - weight_plus - weight_minus
+    # Bins that all fall on one day, or where the moments cannot be
+    # matched with nonnegative weights, get a single point.
+    determinant = bin_pairs * second_moment - first_moment ** 2
+    single_point = (
+        (determinant <= 1e-6 * bin_pairs ** 2) |
+        (np.minimum(weight_plus, weight_minus) < 0)
+    )
+    determinant[single_point] = 1
+    # acf = intercept + slope * offset, with sums matching the bin
+    intercept = np.where(
+        single_point,
+        acf_sum / bin_pairs,
+        (acf_sum * second_moment - first_moment * acf_offset_sum) /
+        determinant,
+    )
+    slope = np.where(
+        single_point,
+        0,
+        (bin_pairs * acf_offset_sum - first_moment * acf_sum) /
+        determinant,
+    )
+    weight_plus[single_point] = 0
+    weight_minus[single_point] = 0
+    weight_center[single_point] = bin_pairs[single_point]
+
+    bin_phase = (bin_keys % steps_per_day) / steps_per_day
+    point_offsets = np.stack([-spacing, np.zeros(n_bins), spacing])
+    point_lags = (bin_day + bin_phase)[np.newaxis, :] + point_offsets
+    point_acf = intercept[np.newaxis, :] + slope * point_offsets
+    point_pairs = np.stack([weight_minus, weight_center, weight_plus])
+    # Keep lag order within each bin
+    point_lags = point_lags.T.reshape(-1)
+    point_acf = point_acf.T.reshape(-1)
+    point_pairs = point_pairs.T.reshape(-1)
+    used = point_pairs > 0
+    point_lags = point_lags[used]
+    point_acf = point_acf[used]
+    point_pairs = point_pairs[used]
+    sort_order = np.argsort(point_lags, kind="stable")
+
+    residual_sum_squares = max(
+        np.sum(pair_counts * acf ** 2) -
+        np.sum(point_pairs * point_acf ** 2),
+        0,
+    )
+    return CompressedCorrelogram(
+        np.ascontiguousarray(point_lags[sort_order], dtype=np.float32),
+        np.ascontiguousarray(point_acf[sort_order], dtype=np.float32),
+        np.ascontiguousarray(point_pairs[sort_order], dtype=np.float32),
+        residual_sum_squares,
+    )
+
+
+def _objective_value(result):
+    """Pull the objective out of a fit kernel result.
+
+    The ``*_fit_loop`` kernels also return the gradient.
+
+    Parameters
+    ----------
+    result: float or tuple
+
+    Returns
+    -------
+    float
+    """
+    if isinstance(result, tuple):
+        return float(result[0])
+    return float(result)
+
+
+def compression_error(fit_function, parameters, lags, acf, pair_counts,
+                      compressed):
+    """Compare the full and compressed weighted least-squares objectives.
+
+    Parameters
+    ----------
+    fit_function: callable
+        One of the generated ``*_fit_ne`` or ``*_fit_loop`` kernels.
+    parameters: np.ndarray
+    lags, acf, pair_counts: np.ndarray
+        The full problem.
+    compressed: CompressedCorrelogram
+
+    Returns
+    -------
+    full_objective: float
+    compressed_objective: float
+        Includes the within-bin residual sum of squares.
+    relative_error: float
+    """
+    full_objective = _objective_value(fit_function(
+        parameters,
+        np.ascontiguousarray(lags, dtype=np.float32),
+        np.ascontiguousarray(acf, dtype=np.float32),
+        np.ascontiguousarray(pair_counts, dtype=np.float32),
+    ))
+    compressed_objective = _objective_value(
+        fit_function(parameters, *compressed[:3])
+    ) + compressed.residual_sum_squares
+    relative_error = (
+        (compressed_objective - full_objective) / full_objective
+    )
+    return full_objective, compressed_objective, relative_error
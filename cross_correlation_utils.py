@@ -0,0 +1,210 @@
+# ~*~ coding: utf8 ~*~
+"""Lagged cross-correlations between every pair of towers.
+
+Missing data is handled the same conservative way as the
+autocorrelations in :mod:`correlation_utils`: each tower is demeaned
+using its non-missing values, missing values are set to zero, and the
+sum at each lag is divided by the number of pairs at that lag.  The
+cross-correlations are normalized by the lag-zero autocovariances of
+the two towers, so the diagonal matches the ACF.
+
+Towers are processed in blocks so only a block-by-block slab of the
+sites x sites x lags result is ever held in memory.  The spectra of
+every tower are found once up front and kept for all the blocks.  Each slab is
+written to a chunked netCDF file as soon as it is done.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+import scipy.fft
+import netCDF4
+
+SITES_PER_BLOCK = 8
+LAG_CHUNK_SIZE = 24 * 365
+
+
+def _prepare_block(data, have_data, fft_len):
+    """Demean a block of sites and find the spectra.
+
+    Parameters
+    ----------
+    data: np.ndarray[N_block, N_times]
+    have_data: np.ndarray[N_block, N_times] of bool
+    fft_len: int
+
+    Returns
+    -------
+    data_spectra: np.ndarray[N_block, fft_len // 2 + 1]
+    mask_spectra: np.ndarray[N_block, fft_len // 2 + 1]
+    variances: np.ndarray[N_block]
+        The conservative lag-zero autocovariance of each site.
+    """
+    n_valid = have_data.sum(axis=1)
+    block_data = np.where(have_data, data, 0).astype(np.float64)
+    block_data -= (
+        block_data.sum(axis=1) / np.maximum(n_valid, 1)
+    )[:, np.newaxis]
+    block_data[~have_data] = 0
+    variances = np.sum(block_data ** 2, axis=1) / np.maximum(n_valid, 1)
+    data_spectra, mask_spectra = scipy.fft.rfft(
+        np.stack([block_data, have_data.astype(np.float64)]),
+        fft_len,
+        axis=-1,
+    )
+    return data_spectra, mask_spectra, variances
+
+
+def get_cross_correlation_block(first_block, second_block, n_lags, fft_len):
+    """Find cross-covariances between two blocks of sites.
+
+    Parameters
+    ----------
+    first_block, second_block: tuple
+        Results of :func:`_prepare_block`.
+    n_lags: int
+    fft_len: int
+
+    Returns
+    -------
+    cross_covariance: np.ndarray[N_first, N_second, n_lags]
+        Element [a, b, k] is the covariance of first site a at time t
+        with second site b at time t + k.
+    cross_correlation: np.ndarray[N_first, N_second, n_lags]
+    pair_counts: np.ndarray[N_first, N_second, n_lags]
+
+    The covariance and correlation are NaN at lags with no pairs.
+    """
+    first_data, first_mask, first_var = first_block
+    second_data, second_mask, second_var = second_block
+    # sum_t a[t] b[t + k] comes from conj(A) * B
+    lag_sums = scipy.fft.irfft(
+        np.stack([
+            first_data.conj()[:, np.newaxis, :] * second_data[np.newaxis],
+            first_mask.conj()[:, np.newaxis, :] * second_mask[np.newaxis],
+        ]),
+        fft_len,
+        axis=-1,
+    )[..., :n_lags]
+    pair_counts = np.round(lag_sums[1])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # NaN where there are no pairs, as for the autocorrelations
+        cross_covariance = np.where(
+            pair_counts > 0, lag_sums[0] / pair_counts, np.nan
+        )
+        cross_correlation = cross_covariance / np.sqrt(
+            first_var[:, np.newaxis, np.newaxis] *
+            second_var[np.newaxis, :, np.newaxis]
+        )
+    return cross_covariance, cross_correlation, pair_counts
+
+
+def write_cross_correlation_store(
+        data, file_name, site_names=None, have_data=None, max_lag=None,
+        sites_per_block=SITES_PER_BLOCK, hours_per_step=1,
+        data_units="umol/m2/s",
+):
+    """Write lagged cross-correlations for all site pairs to a file.
+
+    Negative lags are not stored separately: the value for sites
+    (a, b) at lag -k is the value for (b, a) at lag k.
+
+    Parameters
+    ----------
+    data: np.ndarray[N_sites, N_times]
+        Regularly spaced in time.  Missing values may be NaN.
+    file_name: str
+        The netCDF file to create.
+    site_names: list of str, optional
+    have_data: np.ndarray[N_sites, N_times] of bool, optional
+    max_lag: int, optional
+        Defaults to N_times - 1.
+    sites_per_block: int
+        Memory use grows with the square of this.
+    hours_per_step: float
+        Time between successive values in data.
+    data_units: str
+    """
+    data = np.atleast_2d(data)
+    finite_data = np.isfinite(data)
+    if have_data is None:
+        have_data = finite_data
+    else:
+        have_data = np.atleast_2d(have_data) & finite_data
+    n_sites, n_times = data.shape
+    if max_lag is None:
+        max_lag = n_times - 1
+    n_lags = min(max_lag, n_times - 1) + 1
+    if site_names is None:
+        site_names = ["site{0:03d}".format(i) for i in range(n_sites)]
+    fft_len = scipy.fft.next_fast_len(n_times + n_lags - 1, real=True)
+    chunk_sites = min(sites_per_block, n_sites)
+    chunk_lags = min(LAG_CHUNK_SIZE, n_lags)
+
+    with netCDF4.Dataset(file_name, "w", format="NETCDF4") as store:
+        store.createDimension("site", n_sites)
+        store.createDimension("site_adjoint", n_sites)
+        store.createDimension("time_lag", n_lags)
+        for dim_name in ("site", "site_adjoint"):
+            site_var = store.createVariable(dim_name, str, (dim_name,))
+            site_var[:] = np.asarray(site_names, dtype=object)
+        lag_var = store.createVariable("time_lag", "f8", ("time_lag",))
+        lag_var[:] = np.arange(n_lags) * hours_per_step
+        lag_var.setncatts({"long_name": "time_difference", "units": "hours"})
+
+        dims = ("site", "site_adjoint", "time_lag")
+        chunksizes = (chunk_sites, chunk_sites, chunk_lags)
+        store_vars = (
+            store.createVariable(
+                "flux_error_cross_covariance", "f4", dims, zlib=True,
+                chunksizes=chunksizes, fill_value=np.float32(-9999),
+            ),
+            store.createVariable(
+                "flux_error_cross_correlation", "f4", dims, zlib=True,
+                chunksizes=chunksizes, fill_value=np.float32(-9999),
+            ),
+            store.createVariable(
+                "flux_error_n_pairs", "i4", dims, zlib=True,
+                chunksizes=chunksizes, fill_value=np.int32(-9999),
+            ),
+        )
+        store_vars[0].setncatts({
+            "long_name":
+            "ameriflux_minus_casa_surface_upward_carbon_dioxide_"
+            "flux_difference_cross_covariance",
+            "units": "({units:s})^2".format(units=data_units),
+            "description":
+            "covariance of site at time t with site_adjoint at time "
+            "t + time_lag",
+        })
+        store_vars[1].setncatts({
+            "long_name":
+            "ameriflux_minus_casa_surface_upward_carbon_dioxide_"
+            "flux_difference_cross_correlation",
+            "units": "1",
+        })
+        store_vars[2].setncatts({
+            "long_name":
+            "ameriflux_minus_casa_surface_upward_carbon_dioxide_"
+            "flux_difference_number_of_pairs_at_lag",
+            "units": "1",
+        })
+
+        # Each block is transformed once, and only the products and
+        # inverse transforms are done for each pair of blocks
+        block_slices = [
+            slice(start, start + sites_per_block)
+            for start in range(0, n_sites, sites_per_block)
+        ]
+        prepared_blocks = [
+            _prepare_block(data[block], have_data[block], fft_len)
+            for block in block_slices
+        ]
+        for first, first_block in zip(block_slices, prepared_blocks):
+            for second, second_block in zip(block_slices, prepared_blocks):
+                results = get_cross_correlation_block(
+                    first_block, second_block, n_lags, fft_len
+                )
+                for store_var, result in zip(store_vars, results):
+                    store_var[first, second, :] = result.astype(
+                        store_var.dtype
+                    )
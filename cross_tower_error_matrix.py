@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# ~*~ coding: utf8 ~*~
+"""Cross-validation error of every tower's fits against every tower.
+
+Each correlation function is fit to each tower's correlogram once,
+and the fitted curves are evaluated on the lag grid shared by all the
+towers.  The weighted error of a curve f against the correlogram c,
+with n pairs at each lag, is
+
+    sum(n (c - f) ** 2) = sum(n c ** 2) - 2 sum(n c f) + sum(n f ** 2),
+
+so with the curves of one function as the rows of F, the errors of
+every training tower against every validation tower are
+
+    sum(n c ** 2)[newaxis, :] - 2 F (n c)^T + F ** 2 n^T.
+
+That is two matrix products per function, where evaluating each pair
+directly would loop over all the towers squared.  Lags without pairs
+have n = 0 and drop out.  The output is the
+training_tower x validation_tower x correlation_function cube read by
+:mod:`cross_val_tower_plots`.
+"""
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import concurrent.futures
+import datetime
+import logging
+import multiprocessing
+
+import numpy as np
+import xarray
+
+import correlation_function_kernels
+from cross_val_tower_fits import (
+    CORRELATION_PARTS_LIST, LAG_BLOCK_SIZE, N_WORKERS, PARAMETER_NAMES,
+    fit_correlation_function, get_autocorrelation_data,
+    get_correlation_function_coords, get_function_short_name,
+    get_site_correlogram_matrices, get_sites_to_fit, prepare_fit_problem,
+    save_results,
+)
+from correlation_function_fits import get_full_parameter_list
+
+OUTPUT_FILE_NAME = "ameriflux-minus-casa-autocorrelation-function-fits.nc4"
+
+PARSER = argparse.ArgumentParser(
+    description=__doc__,
+)
+PARSER.add_argument(
+    "--workers",
+    type=int,
+    default=N_WORKERS,
+    help="Number of processes to use for the fits.",
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+# Per-process state for the fits
+_WORKER_STATE = dict()
+
+
+def _initialize_worker(acf_lags, kernel_threads=0):
+    """Set up the data needed for the fits in this process.
+
+    Parameters
+    ----------
+    acf_lags: np.ndarray[N_lags]
+        The shared lags of the tower correlograms, in days.
+    kernel_threads: int
+        The number of threads for the fit kernels, if positive.  Worker
+        processes use one, so they do not compete for the cores.
+    """
+    if kernel_threads > 0:
+        correlation_function_kernels.set_num_threads(kernel_threads)
+    _WORKER_STATE["acf_lags"] = acf_lags
+
+
+def get_sum_squares(weighted_acf, n_pairs):
+    """Find sum(n c ** 2) for each tower.
+
+    Parameters
+    ----------
+    weighted_acf, n_pairs: np.ndarray[N_towers, N_lags]
+        From :func:`cross_val_tower_fits.get_site_correlogram_matrices`.
+
+    Returns
+    -------
+    np.ndarray[N_towers] of float64
+    """
+    weighted_acf = weighted_acf.astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(
+            n_pairs > 0, weighted_acf * weighted_acf / n_pairs, 0
+        ).sum(axis=-1)
+
+
+def get_error_matrix(curves, weighted_acf, n_pairs, sum_squares,
+                     lag_block_size=LAG_BLOCK_SIZE):
+    """Find the error of every curve against every correlogram.
+
+    Parameters
+    ----------
+    curves: np.ndarray[N_curves, N_lags]
+        Rows of NaN give rows of NaN.
+    weighted_acf, n_pairs: np.ndarray[N_towers, N_lags]
+    sum_squares: np.ndarray[N_towers]
+        From :func:`get_sum_squares`.
+    lag_block_size: int
+        Lags per matrix product, which bounds the float64 temporaries.
+
+    Returns
+    -------
+    np.ndarray[N_curves, N_towers] of float64
+    """
+    error = np.tile(sum_squares, (len(curves), 1))
+    for block_start in range(0, curves.shape[1], lag_block_size):
+        block = slice(block_start, block_start + lag_block_size)
+        curve_block = curves[:, block].astype(np.float64)
+        error -= 2 * curve_block.dot(weighted_acf[:, block].T)
+        error += (curve_block * curve_block).dot(n_pairs[:, block].T)
+    return error
+
+
+def get_fitted_curves(combination, parameters, acf_lags):
+    """Evaluate one function's fitted curves on the shared lags.
+
+    Parameters
+    ----------
+    combination: Tuple[PartForm, PartForm, PartForm]
+    parameters: np.ndarray[N_towers, N_params]
+        Rows of NaN where the fit failed.
+    acf_lags: np.ndarray[N_lags]
+
+    Returns
+    -------
+    np.ndarray[N_towers, N_lags] of float32
+    """
+    curve_function = getattr(
+        correlation_function_kernels,
+        "{fun_name:s}_curve_ne".format(
+            fun_name=get_function_short_name(combination)
+        ),
+    )
+    curves = np.full((len(parameters), len(acf_lags)), np.nan,
+                     dtype=np.float32)
+    for tower_index, tower_params in enumerate(parameters):
+        if np.isfinite(tower_params).all():
+            curve_function(acf_lags, *tower_params, out=curves[tower_index])
+    return curves
+
+
+def fit_tower(task):
+    """Fit every correlation function to one tower's correlogram.
+
+    Must be called in a process set up by :func:`_initialize_worker`.
+
+    Parameters
+    ----------
+    task: Tuple[int, np.ndarray, np.ndarray]
+        The tower's index, acf, and pair counts.
+
+    Returns
+    -------
+    List[np.ndarray or None]
+        The parameters for each function in CORRELATION_PARTS_LIST,
+        or None where the fit failed.
+    """
+    tower_index, acf, n_pairs = task
+    _LOGGER.info("Tower %3d", tower_index)
+    fit_problem = prepare_fit_problem(_WORKER_STATE["acf_lags"], acf, n_pairs)
+    return [
+        fit_correlation_function(combination, *fit_problem)[0]
+        for combination in CORRELATION_PARTS_LIST
+    ]
+
+
+def get_cross_tower_errors(n_workers=N_WORKERS):
+    """Fit every function to every tower and score against every tower.
+
+    Parameters
+    ----------
+    n_workers: int
+        Number of processes for the fits.  One runs everything in
+        this process.
+
+    Returns
+    -------
+    xarray.Dataset
+    """
+    autocorrelation_data = get_autocorrelation_data()
+    sites = get_sites_to_fit(autocorrelation_data)
+    acf_lags, weighted_acf, n_pairs = get_site_correlogram_matrices(
+        autocorrelation_data, sites
+    )
+    autocorrelation_data.close()
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        acf = weighted_acf / n_pairs
+    tasks = [
+        (tower_index, acf[tower_index], n_pairs[tower_index])
+        for tower_index in range(len(sites))
+    ]
+    _LOGGER.info("Fitting %d functions to %d towers",
+                 len(CORRELATION_PARTS_LIST), len(sites))
+    if n_workers == 1:
+        _initialize_worker(acf_lags)
+        tower_fits = list(map(fit_tower, tasks))
+    else:
+        # Forked children inherit the numexpr thread pool and the
+        # netCDF library state, neither of which survives the fork.
+        with concurrent.futures.ProcessPoolExecutor(
+                n_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_initialize_worker,
+                initargs=(acf_lags, 1),
+        ) as executor:
+            tower_fits = list(executor.map(fit_tower, tasks))
+    del acf
+
+    parameters = np.full(
+        (len(CORRELATION_PARTS_LIST), len(sites), len(PARAMETER_NAMES)),
+        np.nan,
+        dtype=np.float32,
+    )
+    error = np.full(
+        (len(CORRELATION_PARTS_LIST), len(sites), len(sites)),
+        np.nan,
+        dtype=np.float32,
+    )
+    sum_squares = get_sum_squares(weighted_acf, n_pairs)
+    for function_index, combination in enumerate(CORRELATION_PARTS_LIST):
+        parameter_list = get_full_parameter_list(*combination)
+        param_index = [PARAMETER_NAMES.index(param)
+                       for param in parameter_list]
+        function_params = np.full(
+            (len(sites), len(parameter_list)), np.nan, dtype=np.float32
+        )
+        for tower_index, fits in enumerate(tower_fits):
+            if fits[function_index] is not None:
+                function_params[tower_index] = fits[function_index]
+        parameters[function_index][:, param_index] = function_params
+        error[function_index] = get_error_matrix(
+            get_fitted_curves(combination, function_params, acf_lags),
+            weighted_acf, n_pairs, sum_squares,
+        )
+        _LOGGER.info("Done cross-tower errors for %s", combination)
+
+    return xarray.Dataset(
+        {
+            "cross_validation_error": (
+                ("correlation_function", "training_tower",
+                 "validation_tower"),
+                error,
+                {
+                    "long_name":
+                    "flux_error_correlation_function_cross_validation_error",
+                    "comment": "lower is better",
+                    "units": "1",
+                    "valid_min": 0,
+                },
+            ),
+            "optimized_parameters": (
+                ("correlation_function", "training_tower", "parameter_name"),
+                parameters,
+                {
+                    "long_name":
+                    "flux_error_correlation_function_fitted_parameters",
+                },
+            ),
+        },
+        {
+            "training_tower": (("training_tower",), np.array(sites)),
+            "validation_tower": (("validation_tower",), np.array(sites)),
+            **get_correlation_function_coords(),
+        },
+    )
+
+
+if __name__ == "__main__":
+    ARGS = PARSER.parse_args()
+    print(datetime.datetime.now())
+    CROSS_TOWER_FIT_ERROR_DS = get_cross_tower_errors(ARGS.workers)
+    save_results(CROSS_TOWER_FIT_ERROR_DS, OUTPUT_FILE_NAME)
+    _LOGGER.info("Saved output")
@@ -5,13 +5,21 @@
 Uses correlations from one tower to fit the correlation functions,
 then measures the fit against the other towers' correlation data.
 
+The splits are drawn up front from a recorded seed, and each
+(split, function) fit is an independent task, so the fits can be
+spread over a pool of processes.  Results are placed by split and
+function, so the output does not depend on the number of workers.
 """
 from __future__ import division, print_function, unicode_literals
 
+import argparse
+import concurrent.futures
 import datetime
 import itertools
 import logging
-import random
+import multiprocessing
+import os
+import os.path
 
 import numpy as np
 import scipy.optimize
@@ -19,8 +27,18 @@ import pandas as pd
 import pint
 import xarray
 
-import flux_correlation_function_fits
-from correlation_utils import get_autocorrelation_stats
+import correlation_function_kernels
+from correlation_utils import get_autocorrelation_stats_batched
+from curve_fit_adapter import FusedCurveFunction
+from correlogram_compression import (
+    CompressedCorrelogram, compress_correlogram, compression_error,
+)
+from normal_equation_fits import fit_normal_equations
+from variable_projection_fits import fit_variable_projection
+from shard_utils import (
+    add_shard_arguments, find_partial_files, get_partial_file_name,
+    select_shard,
+)
 
 from correlation_function_fits import (
     CorrelationPart, PartForm,
@@ -28,8 +46,6 @@ from correlation_function_fits import (
     get_full_parameter_list,
 )
 
-print(datetime.datetime.now())
-
 CORRELATION_PARTS_LIST = [
     (day_part, dm_part, ann_part)
     for day_part, dm_part, ann_part in itertools.product(
@@ -54,16 +70,23 @@ N_SPLITS = 300
 N_TRAINING = 45
 N_HYPER_TRAIN = 30
 N_CROSS_VAL = 0  # or whatever's left
+# Recorded in the output so the splits can be reproduced
+SPLIT_SEED = 20201015
+N_WORKERS = os.cpu_count()
+
+# Fit to lag bins rather than every hourly lag.  This approximates
+# the full problem, so the fitted parameters change slightly.
+COMPRESS_CORRELOGRAMS = False
+# Correlogram solver: see normal_equation_fits.fit_normal_equations
+FIT_SOLVER = "curve_fit"
+# Lags per matrix product when combining tower correlograms
+LAG_BLOCK_SIZE = 4096
 
 UREG = pint.UnitRegistry()
 
-# Configure logging
-logging.basicConfig(
-    format=(
-        "%(asctime)s:%(levelname)7s:%(name)8s:"
-        "%(module)20s:%(funcName)15s:%(lineno)03s: %(message)s"
-    ),
-    level=logging.DEBUG,
+LOG_FORMAT = (
+    "%(asctime)s:%(levelname)7s:%(name)8s:"
+    "%(module)20s:%(funcName)15s:%(lineno)03s: %(message)s"
 )
 _LOGGER = logging.getLogger(__name__)
 
@@ -121,46 +144,87 @@ def timedelta_index_to_floats(index):
     return lag_times.astype(np.float32)
 
 
-def select_tower_subset(corr_data, towers):
-    """Combine tower autocorr data to make single series
+def get_site_correlogram_matrices(autocorrelation_data, sites):
+    """Get dense per-site correlograms for combining across towers.
 
     Parameters
     ----------
-    corr_data: xarray.Dataset
-    towers: List[str]
+    autocorrelation_data: xarray.Dataset
+    sites: List[str]
 
     Returns
     -------
-    corr_data: xarray.Dataset
-    acf_lags: np.ndarray
-    acf_weights: np.ndarray
+    acf_lags: np.ndarray[N_lags]
+        In days.
+    weighted_acf: np.ndarray[N_sites, N_lags]
+        acf * n_pairs, zero where a site has no pairs.
+    n_pairs: np.ndarray[N_sites, N_lags]
     """
-    corr_data_towers = corr_data.sel(site=towers)
-
-    n_pairs = corr_data_towers[
-        "flux_error_n_pairs"
-    ]
-    # # Make sure elements with no data are zero
-    # # All data should already be zero.
-    # corr_data_towers = corr_data_towers.where(n_pairs >= 1, 0)
-    n_pairs_tot = n_pairs.sum("site")
-    # 0.15.1 introduces a weighted() method that does the same thing,
-    # but it's only three and a half months old so far.
-    corr_data = (
-        corr_data_towers * n_pairs
-    ).sum(dim="site") / n_pairs_tot
-    corr_data["flux_error_n_pairs"] = n_pairs_tot
-    corr_data = corr_data.sel(
-        time_lag=n_pairs_tot >= 1,
-    ).dropna("time_lag")
-
+    corr_data = autocorrelation_data.sel(site=sites).transpose(
+        "site", "time_lag"
+    )
+    acf = corr_data["flux_error_autocorrelation"].values.astype(np.float32)
+    n_pairs = corr_data["flux_error_n_pairs"].values.astype(np.float32)
+    have_pairs = (n_pairs >= 1) & np.isfinite(acf)
+    n_pairs = np.where(have_pairs, n_pairs, 0).astype(np.float32)
+    weighted_acf = np.where(have_pairs, acf * n_pairs, 0).astype(np.float32)
     acf_lags = timedelta_index_to_floats(
-        pd.TimedeltaIndex(corr_data.coords["time_lag"])
+        pd.TimedeltaIndex(corr_data.indexes["time_lag"])
     )
-    acf_weights = 1. / np.sqrt(corr_data["flux_error_n_pairs"])
-    assert np.isfinite(acf_weights).all()
+    return acf_lags, weighted_acf, n_pairs
+
+
+def get_split_indicators(sites, split_towers):
+    """Mark the towers used in each split.
+
+    Parameters
+    ----------
+    sites: List[str]
+        The order of the columns.
+    split_towers: np.ndarray[N_splits, N_towers] of str
+        Empty strings are ignored.
+
+    Returns
+    -------
+    np.ndarray[N_splits, N_sites] of float32
+        One where the site is in the split, zero elsewhere.
+    """
+    site_index = {site: i for i, site in enumerate(sites)}
+    indicators = np.zeros((len(split_towers), len(sites)), dtype=np.float32)
+    for split, towers in enumerate(split_towers):
+        indicators[split, [site_index[tower] for tower in towers if tower]] = 1
+    return indicators
+
 
-    return corr_data, acf_lags, acf_weights
+def combine_split_correlograms(indicators, weighted_acf, n_pairs,
+                               lag_block_size=LAG_BLOCK_SIZE):
+    """Find the pair-weighted mean correlogram for every split at once.
+
+    Parameters
+    ----------
+    indicators: np.ndarray[N_splits, N_sites]
+        From :func:`get_split_indicators`.
+    weighted_acf, n_pairs: np.ndarray[N_sites, N_lags]
+        From :func:`get_site_correlogram_matrices`.
+    lag_block_size: int
+        Lags per matrix product, which bounds the temporary arrays.
+
+    Returns
+    -------
+    acf: np.ndarray[N_splits, N_lags]
+        NaN where the split has no pairs.
+    pair_counts: np.ndarray[N_splits, N_lags]
+    """
+    n_lags = weighted_acf.shape[1]
+    acf = np.empty((len(indicators), n_lags), dtype=np.float32)
+    pair_counts = np.empty_like(acf)
+    for block_start in range(0, n_lags, lag_block_size):
+        block = slice(block_start, block_start + lag_block_size)
+        acf[:, block] = indicators.dot(weighted_acf[:, block])
+        pair_counts[:, block] = indicators.dot(n_pairs[:, block])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        acf /= pair_counts
+    return acf, pair_counts
 
 
 ############################################################
@@ -233,265 +297,231 @@ for coef, val in PARAM_LOWER_BOUNDS.items():
 for coef, val in PARAM_UPPER_BOUNDS.items():
     PARAM_UPPER_BOUNDS[coef] = np.float32(val)
 
-############################################################
-# Read in data
-AMERIFLUX_MINUS_CASA_DATA = xarray.open_dataset(
-    "ameriflux-and-casa-matching-data-2.nc4",
-    chunks={"site": 30},
-)
+PARAMETER_NAMES = list(STARTING_PARAMS.keys())
 
-DATA_COUNTS = AMERIFLUX_MINUS_CASA_DATA["flux_difference"].count("time").load()
-SITES_TO_KEEP = [
-    site
-    for site in AMERIFLUX_MINUS_CASA_DATA.indexes["site"]
-    if (
-        DATA_COUNTS.sel(site=site) >
-        HOURS_PER_YEAR * N_YEARS_DATA * REQUIRED_DATA_FRAC
-    )
-]
-AMERIFLUX_MINUS_CASA_DATA = AMERIFLUX_MINUS_CASA_DATA.sel(
-    site=SITES_TO_KEEP
-).persist()
-
-TIME_LAG_INDEX = pd.timedelta_range(
-    start=0, freq="1H", periods=AMERIFLUX_MINUS_CASA_DATA.dims["time"]
+AMERIFLUX_MINUS_CASA_FILE_NAME = "ameriflux-and-casa-matching-data-2.nc4"
+AUTOCORRELATION_FILE_NAME = (
+    "ameriflux-minus-casa-autocorrelation-data-all-towers.nc4"
+)
+OUTPUT_FILE_NAME = (
+    "ameriflux-minus-casa-autocorrelation-function-multi-tower-fits"
+    "-300splits-run2.nc4"
 )
 
-# ############################################################
-# # Calculate the autocorrelation for each tower
-### Commented out because I already have this calculated and can just
-### read in the saved file.
-# AUTOCORRELATION_DATA = xarray.Dataset(
-#     {
-#         "flux_error_autocorrelation": (
-#             ("site", "time_lag"),
-#             np.empty(
-#                 (
-#                     AMERIFLUX_MINUS_CASA_DATA.dims["site"],
-#                     AMERIFLUX_MINUS_CASA_DATA.dims["time"],
-#                 ),
-#                 dtype=np.float32
-#             ),
-#             {
-#                 "long_name":
-#                 "ameriflux_minus_casa_surface_upward_carbon_dioxide_"
-#                 "flux_difference_autocorrelation",
-#                 "units": "1",
-#             },
-#         ),
-#         "flux_error_autocovariance": (
-#             ("site", "time_lag"),
-#             np.empty(
-#                 (
-#                     AMERIFLUX_MINUS_CASA_DATA.dims["site"],
-#                     AMERIFLUX_MINUS_CASA_DATA.dims["time"],
-#                 ),
-#                 dtype=np.float32
-#             ),
-#             {
-#                 "long_name":
-#                 "ameriflux_minus_casa_surface_upward_carbon_dioxide_"
-#                 "flux_difference_autocovariance",
-#                 "units": str(
-#                     UREG(
-#                         AMERIFLUX_MINUS_CASA_DATA[
-#                             "flux_difference"
-#                         ].attrs["units"]
-#                     ) ** 2
-#                 ),
-#             },
-#         ),
-#         "flux_error_n_pairs": (
-#             ("site", "time_lag"),
-#             np.empty(
-#                 (
-#                     AMERIFLUX_MINUS_CASA_DATA.dims["site"],
-#                     AMERIFLUX_MINUS_CASA_DATA.dims["time"],
-#                 ),
-#                 dtype=np.float32
-#             ),
-#             {
-#                 "long_name":
-#                 "ameriflux_minus_casa_surface_upward_carbon_dioxide_"
-#                 "flux_difference_number_of_pairs_at_lag",
-#                 "units": "1",
-#             },
-#         ),
-#     },
-#     {
-#         "site": (
-#             ("site",),
-#             AMERIFLUX_MINUS_CASA_DATA.coords["site"],
-#         ),
-#         "time_lag": (
-#             ("time_lag",),
-#             TIME_LAG_INDEX,
-#             {
-#                 "long_name": "time_difference",
-#             },
-#         )
-#     },
-# )
-
-# for site in AMERIFLUX_MINUS_CASA_DATA.indexes["site"]:
-#     correlation_data = get_autocorrelation_stats(
-#         AMERIFLUX_MINUS_CASA_DATA["flux_difference"]
-#         .sel(site=site)
-#         .to_series()
-#         .dropna()
-#         .resample("1H").first()
-#     )
-#     AUTOCORRELATION_DATA["flux_error_autocorrelation"].sel(
-#         site=site
-#     ).isel(
-#         time_lag=slice(None, len(correlation_data))
-#     ).values[:] = correlation_data["acf"]
-#     AUTOCORRELATION_DATA["flux_error_autocovariance"].sel(
-#         site=site
-#     ).isel(
-#         time_lag=slice(None, len(correlation_data))
-#     ).values[:] = correlation_data["acovf"]
-#     AUTOCORRELATION_DATA["flux_error_n_pairs"].sel(
-#         site=site
-#     ).isel(
-#         time_lag=slice(None, len(correlation_data))
-#     ).values[:] = correlation_data["pair_counts"]
-
-# encoding = {var: {"_FillValue": -9999, "zlib": True}
-#             for var in AUTOCORRELATION_DATA.data_vars}
-# encoding.update({var: {"_FillValue": None}
-#                  for var in AUTOCORRELATION_DATA.coords})
-
-# AUTOCORRELATION_DATA.to_netcdf(
-#     "ameriflux-minus-casa-autocorrelation-data-all-towers.nc4",
-#     format="NETCDF4_CLASSIC", encoding=encoding
-# )
-
-AUTOCORRELATION_DATA = xarray.open_dataset(
-    "ameriflux-minus-casa-autocorrelation-data-all-towers.nc4",
+PARSER = argparse.ArgumentParser(
+    description=__doc__,
 )
+PARSER.add_argument(
+    "--workers",
+    type=int,
+    default=N_WORKERS,
+    help="Number of processes to use for the fits.",
+)
+PARSER.add_argument(
+    "--seed",
+    type=int,
+    default=SPLIT_SEED,
+    help="Seed for choosing the training and validation towers.",
+)
+add_shard_arguments(PARSER)
 
-############################################################
-# Trim to just the useful bits for each tower
-AUTOCORRELATION_FOR_CURVE_FIT = dict()
-
-for tower in SITES_TO_KEEP:
-    corr_data = AUTOCORRELATION_DATA.sel(
-        site=tower
-    ).dropna("time_lag")
-    corr_data = corr_data.where(
-        corr_data["flux_error_n_pairs"] > 0,
-        drop=True,
+
+def get_autocorrelation_data():
+    """Read the tower autocorrelations.
+
+    The autocorrelations are calculated and saved first if the file
+    is not already present.
+
+    Returns
+    -------
+    xarray.Dataset
+    """
+    if os.path.exists(AUTOCORRELATION_FILE_NAME):
+        return xarray.open_dataset(AUTOCORRELATION_FILE_NAME)
+
+    ameriflux_minus_casa_data = xarray.open_dataset(
+        AMERIFLUX_MINUS_CASA_FILE_NAME,
+        chunks={"site": 30},
     )
-    if not has_enough_data(corr_data["flux_error_n_pairs"]):
-        continue
-    AUTOCORRELATION_FOR_CURVE_FIT[tower] = corr_data
 
-LIST_OF_SITES = list(AUTOCORRELATION_FOR_CURVE_FIT)
-random.shuffle(LIST_OF_SITES)
-SITES_TO_FIT = LIST_OF_SITES[:N_TRAINING + N_HYPER_TRAIN]
+    data_counts = ameriflux_minus_casa_data["flux_difference"].count(
+        "time"
+    ).load()
+    sites_to_keep = [
+        site
+        for site in ameriflux_minus_casa_data.indexes["site"]
+        if (
+            data_counts.sel(site=site) >
+            HOURS_PER_YEAR * N_YEARS_DATA * REQUIRED_DATA_FRAC
+        )
+    ]
+    ameriflux_minus_casa_data = ameriflux_minus_casa_data.sel(
+        site=sites_to_keep
+    ).persist()
 
-############################################################
-# Set up dataset for results
-CROSS_TOWER_FIT_ERROR_DS = xarray.Dataset(
-    {
-        "cross_validation_error": (
-            ("correlation_function", "splits"),
-            np.full(
-                (
-                    len(CORRELATION_PARTS_LIST),
-                    N_SPLITS,
-                ),
-                np.nan,
-                # I could probably get away with storing float16, but I
-                # don't think netcdf can handle that.
-                dtype=np.float32
-            ),
-            {
-                "long_name":
-                "flux_error_correlation_function_cross_validation_error",
-                "comment": "lower is better",
-                "units": "1",
-                "valid_min": 0,
-            },
-        ),
-        "optimized_parameters": (
-            ("correlation_function", "splits", "parameter_name"),
-            np.full(
-                (
-                    len(CORRELATION_PARTS_LIST),
-                    N_SPLITS,
-                    len(STARTING_PARAMS),
-                ),
-                np.nan,
-                dtype=np.float32,
+    time_lag_index = pd.timedelta_range(
+        start=0, freq="1H", periods=ameriflux_minus_casa_data.dims["time"]
+    )
+
+    # All towers in one batched FFT.  The time axis of the matched
+    # data is already hourly.
+    autocorrelation_arrays = get_autocorrelation_stats_batched(
+        ameriflux_minus_casa_data["flux_difference"].transpose(
+            "site", "time"
+        ).values.astype(np.float32),
+    )
+    autocorrelation_data = xarray.Dataset(
+        {
+            "flux_error_autocorrelation": (
+                ("site", "time_lag"),
+                autocorrelation_arrays.acf,
+                {
+                    "long_name":
+                    "ameriflux_minus_casa_surface_upward_carbon_dioxide_"
+                    "flux_difference_autocorrelation",
+                    "units": "1",
+                },
             ),
-            {
-                "long_name":
-                "flux_error_correlation_function_fitted_parameters",
-                "units": [
-                    "1",  #    daily_coef = 0.2,
-                    "1",  #    daily_coef1 = .7,
-                    "1",  #    daily_coef2 = .3,
-                    "1",  #    daily_width = .5,
-                    "fortnights",  #    daily_timescale = 60,
-                    "1",  #    dm_width = .8,
-                    "1",  #    dm_coef1 = .3,
-                    "1",  #    dm_coef2 = +.1,
-                    "1",  #    ann_coef1 = +.4,
-                    "1",  #    ann_coef2 = +.3,
-                    "1",  #    ann_coef = 0.1,
-                    "1",  #    ann_width = .3,
-                    "decades",  #    ann_timescale = 3.,
-                    "1",  #    resid_coef = 0.05,
-                    "fortnights",  #    resid_timescale = 2.,
-                    "1",  #    ec_coef = 0.7,
-                    "hours",  #    ec_timescale = 2.,
-                ],
-            },
-        ),
-        "optimized_parameters_estimated_covariance_matrix": (
-            ("correlation_function", "splits",
-             "parameter_name_adjoint", "parameter_name"),
-            np.full(
-                (
-                    len(CORRELATION_PARTS_LIST),
-                    N_SPLITS,
-                    len(STARTING_PARAMS),
-                    len(STARTING_PARAMS),
-                ),
-                np.nan,
-                dtype=np.float32,
+            "flux_error_autocovariance": (
+                ("site", "time_lag"),
+                autocorrelation_arrays.acovf,
+                {
+                    "long_name":
+                    "ameriflux_minus_casa_surface_upward_carbon_dioxide_"
+                    "flux_difference_autocovariance",
+                    "units": str(
+                        UREG(
+                            ameriflux_minus_casa_data[
+                                "flux_difference"
+                            ].attrs["units"]
+                        ) ** 2
+                    ),
+                },
             ),
-            {
-                "long_name":
-                "flux_error_correlation_function_fitted_parameters"
-                " covariance_matrix",
-            },
-        ),
-    },
-
-    {
-        "splits": (
-            ("splits",),
-            np.arange(N_SPLITS, dtype=np.float32),
-        ),
-        "training_towers": (
-            ("splits", "n_training"),
-            np.full(
-                (N_SPLITS, N_TRAINING),
-                "\0",
-                dtype="U6",
+            "flux_error_n_pairs": (
+                ("site", "time_lag"),
+                autocorrelation_arrays.pair_counts.astype(np.float32),
+                {
+                    "long_name":
+                    "ameriflux_minus_casa_surface_upward_carbon_dioxide_"
+                    "flux_difference_number_of_pairs_at_lag",
+                    "units": "1",
+                },
             ),
-        ),
-        "validation_towers": (
-            ("splits", "n_validation"),
-            np.full(
-                (N_SPLITS, N_HYPER_TRAIN),
-                "\0",
-                dtype="U6",
+        },
+        {
+            "site": (
+                ("site",),
+                ameriflux_minus_casa_data.coords["site"],
             ),
-        ),
+            "time_lag": (
+                ("time_lag",),
+                time_lag_index,
+                {
+                    "long_name": "time_difference",
+                },
+            )
+        },
+    )
+
+    encoding = {var: {"_FillValue": -9999, "zlib": True}
+                for var in autocorrelation_data.data_vars}
+    encoding.update({var: {"_FillValue": None}
+                     for var in autocorrelation_data.coords})
+
+    autocorrelation_data.to_netcdf(
+        AUTOCORRELATION_FILE_NAME,
+        format="NETCDF4_CLASSIC", encoding=encoding
+    )
+    return xarray.open_dataset(AUTOCORRELATION_FILE_NAME)
+
+
+def get_sites_to_fit(autocorrelation_data):
+    """Find the towers with enough data for the cross-validation.
+
+    Parameters
+    ----------
+    autocorrelation_data: xarray.Dataset
+
+    Returns
+    -------
+    List[str]
+    """
+    sites = []
+    for tower in autocorrelation_data.indexes["site"]:
+        corr_data = autocorrelation_data.sel(
+            site=tower
+        ).dropna("time_lag")
+        corr_data = corr_data.where(
+            corr_data["flux_error_n_pairs"] > 0,
+            drop=True,
+        )
+        if not has_enough_data(corr_data["flux_error_n_pairs"]):
+            continue
+        sites.append(tower)
+    return sites
+
+
+def generate_splits(sites, n_splits=N_SPLITS, seed=SPLIT_SEED):
+    """Choose the training and validation towers for each split.
+
+    Parameters
+    ----------
+    sites: List[str]
+    n_splits: int
+    seed: int
+        The same seed and sites always give the same splits.
+
+    Returns
+    -------
+    training_towers: np.ndarray[n_splits, N_TRAINING] of str
+    validation_towers: np.ndarray[n_splits, N_HYPER_TRAIN] of str
+        Each row is sorted.  Validation rows are padded with empty
+        strings if there are too few sites.
+    """
+    rng = np.random.default_rng(seed)
+    sites_to_fit = rng.permutation(np.sort(np.array(sites, dtype="U6")))[
+        :N_TRAINING + N_HYPER_TRAIN
+    ]
+    training_towers = np.full((n_splits, N_TRAINING), "", dtype="U6")
+    validation_towers = np.full((n_splits, N_HYPER_TRAIN), "", dtype="U6")
+    for split in range(n_splits):
+        shuffled = rng.permutation(sites_to_fit)
+        training_towers[split] = np.sort(shuffled[:N_TRAINING])
+        validation = np.sort(shuffled[N_TRAINING:])
+        validation_towers[split, :len(validation)] = validation
+    return training_towers, validation_towers
+
+
+def get_function_short_name(combination):
+    """Get the name of the generated functions for a combination.
+
+    Parameters
+    ----------
+    combination: Tuple[PartForm, PartForm, PartForm]
+
+    Returns
+    -------
+    str
+    """
+    return "_".join([
+        "{0:s}{1:s}".format(
+            part.get_short_name(),
+            form.get_short_name(),
+        )
+        for part, form in zip(CorrelationPart, combination)
+    ])
+
+
+def get_correlation_function_coords():
+    """Get coordinates describing the correlation functions.
+
+    Returns
+    -------
+    dict
+        Coordinates along correlation_function, plus parameter_name.
+    """
+    return {
         "correlation_function": (
             ("correlation_function",),
             [
@@ -616,190 +646,600 @@ CROSS_TOWER_FIT_ERROR_DS = xarray.Dataset(
             ("parameter_name",),
             np.array(list(STARTING_PARAMS.keys())),
         ),
-        "parameter_name_adjoint": (
-            ("parameter_name_adjoint",),
-            np.array(list(STARTING_PARAMS.keys())),
-        ),
-    },
-)
+    }
 
-############################################################
-# Actually do the cross-validation
-FUNCTION_PARAMS_AND_COV = []
-_LOGGER.info("Starting cross-validation")
-
-for i in range(N_SPLITS):
-    random.shuffle(SITES_TO_FIT)
-    training_towers = np.array(sorted(SITES_TO_FIT[:N_TRAINING]))
-    validation_towers = np.array(sorted(SITES_TO_FIT[N_TRAINING:]))
-    CROSS_TOWER_FIT_ERROR_DS["training_towers"].sel(
-        splits=i
-    ).values[:] = training_towers
-    CROSS_TOWER_FIT_ERROR_DS["validation_towers"].sel(
-        splits=i,
-        n_validation=slice(None, len(validation_towers)),
-    ).values[:] = validation_towers
-
-    _LOGGER.info("Split %3d: Training towers:\n%s", i, training_towers)
-    corr_data_train, acf_lags_train, acf_weights_train = select_tower_subset(
-        AUTOCORRELATION_DATA, training_towers
-    )
 
-    # Set up validation data as well
-    corr_data_validate, acf_lags_validate, acf_weights_validate = (
-        select_tower_subset(AUTOCORRELATION_DATA, validation_towers)
+def make_cross_validation_dataset(training_towers, validation_towers,
+                                  seed=SPLIT_SEED):
+    """Set up the dataset for the results.
+
+    Parameters
+    ----------
+    training_towers: np.ndarray[N_splits, N_TRAINING] of str
+    validation_towers: np.ndarray[N_splits, N_HYPER_TRAIN] of str
+    seed: int
+        The seed used to generate the splits.
+
+    Returns
+    -------
+    xarray.Dataset
+        The results are all NaN.
+    """
+    n_splits = training_towers.shape[0]
+    return xarray.Dataset(
+        {
+            "cross_validation_error": (
+                ("correlation_function", "splits"),
+                np.full(
+                    (
+                        len(CORRELATION_PARTS_LIST),
+                        n_splits,
+                    ),
+                    np.nan,
+                    # I could probably get away with storing float16, but I
+                    # don't think netcdf can handle that.
+                    dtype=np.float32
+                ),
+                {
+                    "long_name":
+                    "flux_error_correlation_function_cross_validation_error",
+                    "comment": "lower is better",
+                    "units": "1",
+                    "valid_min": 0,
+                },
+            ),
+            "optimized_parameters": (
+                ("correlation_function", "splits", "parameter_name"),
+                np.full(
+                    (
+                        len(CORRELATION_PARTS_LIST),
+                        n_splits,
+                        len(STARTING_PARAMS),
+                    ),
+                    np.nan,
+                    dtype=np.float32,
+                ),
+                {
+                    "long_name":
+                    "flux_error_correlation_function_fitted_parameters",
+                    "units": [
+                        "1",  #    daily_coef = 0.2,
+                        "1",  #    daily_coef1 = .7,
+                        "1",  #    daily_coef2 = .3,
+                        "1",  #    daily_width = .5,
+                        "fortnights",  #    daily_timescale = 60,
+                        "1",  #    dm_width = .8,
+                        "1",  #    dm_coef1 = .3,
+                        "1",  #    dm_coef2 = +.1,
+                        "1",  #    ann_coef1 = +.4,
+                        "1",  #    ann_coef2 = +.3,
+                        "1",  #    ann_coef = 0.1,
+                        "1",  #    ann_width = .3,
+                        "decades",  #    ann_timescale = 3.,
+                        "1",  #    resid_coef = 0.05,
+                        "fortnights",  #    resid_timescale = 2.,
+                        "1",  #    ec_coef = 0.7,
+                        "hours",  #    ec_timescale = 2.,
+                    ],
+                },
+            ),
+            "optimized_parameters_estimated_covariance_matrix": (
+                ("correlation_function", "splits",
+                 "parameter_name_adjoint", "parameter_name"),
+                np.full(
+                    (
+                        len(CORRELATION_PARTS_LIST),
+                        n_splits,
+                        len(STARTING_PARAMS),
+                        len(STARTING_PARAMS),
+                    ),
+                    np.nan,
+                    dtype=np.float32,
+                ),
+                {
+                    "long_name":
+                    "flux_error_correlation_function_fitted_parameters"
+                    " covariance_matrix",
+                },
+            ),
+        },
+
+        {
+            "splits": (
+                ("splits",),
+                np.arange(n_splits, dtype=np.float32),
+            ),
+            "training_towers": (
+                ("splits", "n_training"),
+                training_towers,
+            ),
+            "validation_towers": (
+                ("splits", "n_validation"),
+                validation_towers,
+            ),
+            **get_correlation_function_coords(),
+            "parameter_name_adjoint": (
+                ("parameter_name_adjoint",),
+                np.array(list(STARTING_PARAMS.keys())),
+            ),
+        },
+        {
+            "split_seed": seed,
+            "split_seed_comment":
+            "numpy.random.default_rng(split_seed) reproduces the splits",
+        },
     )
 
-    FUNCTION_PARAMS_AND_COV.append([])
 
-    for combination in CORRELATION_PARTS_LIST:
-        _LOGGER.info("Fitting function: %s", combination)
-        # Get function to optimize
-        func_short_name = "_".join([
-            "{0:s}{1:s}".format(
-                part.get_short_name(),
-                form.get_short_name(),
-            )
-            for part, form in zip(CorrelationPart, combination)
-        ])
-        curve_function = getattr(
-            flux_correlation_function_fits,
-            "{fun_name:s}_curve_ne".format(
-                fun_name=func_short_name
-            )
-        )
-        curve_and_derivative_function = getattr(
-            flux_correlation_function_fits,
-            "{fun_name:s}_curve_loop".format(fun_name=func_short_name),
-        )
-        mismatch_function = getattr(
-            flux_correlation_function_fits,
-            "{fun_name}_fit_ne".format(fun_name=func_short_name),
-        )
+def prepare_fit_problem(acf_lags, acf, n_pairs):
+    """Set up a correlogram for fitting.
 
-        def curve_deriv(tdata, *params):
-            """Find the derivative of the curve wrt. params.
-
-            Parameters
-            ----------
-            tdata: np.ndarray[N]
-            params: np.ndarray[M]
-
-            Returns
-            -------
-            deriv: np.ndarray[N, M]
-            """
-            return curve_and_derivative_function(tdata, *params)[1]
-        # Set up parameters
-        parameter_list = get_full_parameter_list(*combination)
-        starting_params = np.array(
-            [STARTING_PARAMS[param] for param in parameter_list],
-            dtype=np.float32,
-        )
-        lower_bounds = np.array(
-            [PARAM_LOWER_BOUNDS[param] for param in parameter_list],
-            dtype=np.float32,
-        )
-        upper_bounds = np.array(
-            [PARAM_UPPER_BOUNDS[param] for param in parameter_list],
-            dtype=np.float32,
-        )
-        correlation_function_long_name = (
-            "daily_{0.value:s}_daily_modulation_{1.value:s}_"
-            "annual_{2.value:s}".format(*combination)
+    Parameters
+    ----------
+    acf_lags: np.ndarray[N_lags]
+    acf, n_pairs: np.ndarray[N_lags]
+        Lags without pairs are dropped.
+
+    Returns
+    -------
+    fit_problem: CompressedCorrelogram
+    acf_weights: np.ndarray
+    full_correlogram: tuple of np.ndarray
+        The lags, acf and pair counts of the uncompressed correlogram.
+    """
+    keep = n_pairs >= 1
+    acf_lags = acf_lags[keep]
+    acf = acf[keep]
+    n_pairs = n_pairs[keep]
+
+    if COMPRESS_CORRELOGRAMS:
+        fit_problem = compress_correlogram(acf_lags, acf, n_pairs)
+        _LOGGER.info(
+            "Compressed %d lags to %d points",
+            len(acf_lags), len(fit_problem.lags),
         )
+    else:
+        fit_problem = CompressedCorrelogram(acf_lags, acf, n_pairs, 0.)
+    acf_weights = 1. / np.sqrt(fit_problem.pair_counts)
+    return fit_problem, acf_weights, (acf_lags, acf, n_pairs)
+
+
+def fit_correlation_function(combination, fit_problem, acf_weights,
+                             full_correlogram):
+    """Fit one correlation function to a correlogram.
+
+    Parameters
+    ----------
+    combination: Tuple[PartForm, PartForm, PartForm]
+    fit_problem, acf_weights, full_correlogram
+        From :func:`prepare_fit_problem`.
+
+    Returns
+    -------
+    opt_params: np.ndarray[N_params] or None
+        None if the fit failed.
+    param_cov: np.ndarray[N_params, N_params] or None
+    """
+    _LOGGER.info("Fitting function: %s", combination)
+    # Get function to optimize
+    func_short_name = get_function_short_name(combination)
+    mismatch_function = getattr(
+        correlation_function_kernels,
+        "{fun_name}_fit_ne".format(fun_name=func_short_name),
+    )
 
-        try:
+    # Set up parameters
+    parameter_list = get_full_parameter_list(*combination)
+    starting_params = np.array(
+        [STARTING_PARAMS[param] for param in parameter_list],
+        dtype=np.float32,
+    )
+    lower_bounds = np.array(
+        [PARAM_LOWER_BOUNDS[param] for param in parameter_list],
+        dtype=np.float32,
+    )
+    upper_bounds = np.array(
+        [PARAM_UPPER_BOUNDS[param] for param in parameter_list],
+        dtype=np.float32,
+    )
+
+    try:
+        if FIT_SOLVER == "variable-projection":
+            opt_params, param_cov, fit_info = fit_variable_projection(
+                getattr(
+                    correlation_function_kernels,
+                    "{fun_name:s}_curve_loop".format(
+                        fun_name=func_short_name
+                    ),
+                ),
+                getattr(
+                    correlation_function_kernels,
+                    "{fun_name:s}_normal_loop".format(
+                        fun_name=func_short_name
+                    ),
+                ),
+                combination,
+                fit_problem.lags,
+                fit_problem.acf,
+                fit_problem.pair_counts,
+                starting_params,
+                (lower_bounds, upper_bounds),
+                full_output=True,
+            )
+            _LOGGER.debug("Fit used %d kernel passes", fit_info["nfev"])
+        elif FIT_SOLVER == "normal-equations":
+            opt_params, param_cov, fit_info = fit_normal_equations(
+                getattr(
+                    correlation_function_kernels,
+                    "{fun_name:s}_normal_loop".format(
+                        fun_name=func_short_name
+                    ),
+                ),
+                fit_problem.lags,
+                fit_problem.acf,
+                fit_problem.pair_counts,
+                starting_params,
+                (lower_bounds, upper_bounds),
+                full_output=True,
+            )
+            _LOGGER.debug("Fit used %d kernel passes", fit_info["nfev"])
+        else:
+            # The model and Jacobian share one pass of the loop kernel
+            fused_curve = FusedCurveFunction.from_short_name(func_short_name)
             opt_params, param_cov = scipy.optimize.curve_fit(
-                curve_function,
-                acf_lags_train.astype(np.float32),
-                corr_data_train[
-                    "flux_error_autocorrelation"
-                ].astype(np.float32).values,
+                fused_curve.curve,
+                fit_problem.lags,
+                fit_problem.acf,
                 starting_params.astype(np.float32),
-                acf_weights_train.astype(np.float32),
+                acf_weights.astype(np.float32),
                 bounds=(
                     lower_bounds.astype(np.float32),
                     upper_bounds.astype(np.float32),
                 ),
-                jac=curve_deriv,
+                jac=fused_curve.jacobian,
             )
-        except (RuntimeError, ValueError) as err:
-            _LOGGER.error("Curve fit failed, next split")
-            _LOGGER.exception(err)
-            _LOGGER.debug("Lower bounds:\n%s", lower_bounds.astype(np.float32))
-            _LOGGER.debug("Upper bounds:\n%s", upper_bounds.astype(np.float32))
-            _LOGGER.debug("Starting params:\n%s", starting_params.astype(np.float32))
-            _LOGGER.debug("ACF weights:\n%s", acf_weights_train.astype(np.float32))
-            _LOGGER.debug("ACF lags:\n%s", acf_lags_train.astype(np.float32))
-            _LOGGER.debug(
-                "Corr data:\n%s",
-                corr_data_train["flux_error_autocorrelation"].astype(np.float32).values
-            )
-            continue
+            _LOGGER.debug("Fit used %r", fused_curve)
+    except (RuntimeError, ValueError) as err:
+        _LOGGER.error("Curve fit failed")
+        _LOGGER.exception(err)
+        _LOGGER.debug("Lower bounds:\n%s", lower_bounds.astype(np.float32))
+        _LOGGER.debug("Upper bounds:\n%s", upper_bounds.astype(np.float32))
+        _LOGGER.debug("Starting params:\n%s", starting_params.astype(np.float32))
+        _LOGGER.debug("ACF weights:\n%s", acf_weights.astype(np.float32))
+        _LOGGER.debug("ACF lags:\n%s", fit_problem.lags)
+        _LOGGER.debug("Corr data:\n%s", fit_problem.acf)
+        return None, None
 
-        FUNCTION_PARAMS_AND_COV[-1].append(
-            xarray.Dataset(
-                {
-                    "optimized_parameters": (
-                        ("parameter_name",),
-                        opt_params,
-                    ),
-                    "optimized_parameters_estimated_covariance_matrix": (
-                        ("parameter_name_adjoint", "parameter_name"),
-                        param_cov
-                    ),
-                },
-                {
-                    "parameter_name": (("parameter_name",), parameter_list),
-                    "parameter_name_adjoint": (
-                        ("parameter_name_adjoint",), parameter_list
-                    ),
-                    "training_towers": (("splits", "n_training",), training_towers.reshape(1, -1)),
-                    "correlation_function": (
-                        (), correlation_function_long_name
-                    ),
-                    "splits": (
-                        ("splits",), np.array([i], dtype="i2"),
-                    ),
-                },
-            )
+    if COMPRESS_CORRELOGRAMS:
+        full_error, compressed_error, relative_error = compression_error(
+            mismatch_function,
+            opt_params,
+            *full_correlogram,
+            fit_problem
+        )
+        _LOGGER.info(
+            "Training error: %.4g full, %.4g compressed, "
+            "%.2e relative difference",
+            full_error, compressed_error, relative_error,
         )
 
-        CROSS_TOWER_FIT_ERROR_DS["cross_validation_error"].sel(
-            correlation_function=(
-                correlation_function_long_name
-            ),
-            splits=i,
-        ).values[()] = mismatch_function(
-            opt_params,
-            acf_lags_validate,
-            corr_data_validate["flux_error_autocorrelation"].astype(
-                np.float32
-            ).values,
-            corr_data_validate["flux_error_n_pairs"].astype(
-                np.float32
-            ).values
+    return opt_params, param_cov
+
+
+############################################################
+# Per-process state for the fits
+_WORKER_STATE = dict()
+
+
+def _initialize_worker(acf_lags, kernel_threads=0, configure_logging=False):
+    """Set up the data needed for the fits in this process.
+
+    Parameters
+    ----------
+    acf_lags: np.ndarray[N_lags]
+        The lags of the split correlograms, in days.
+    kernel_threads: int
+        The number of threads for the fit kernels, if positive.  Worker
+        processes use one, so they do not compete for the cores.
+    configure_logging: bool
+        Log as the script does.  Spawned workers do not run the
+        ``__main__`` block that sets it up.
+    """
+    if configure_logging:
+        logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
+    if kernel_threads > 0:
+        correlation_function_kernels.set_num_threads(kernel_threads)
+    _WORKER_STATE.clear()
+    _WORKER_STATE["acf_lags"] = acf_lags
+
+
+def _get_split_fit_problem(split, split_correlograms):
+    """Set up the training and validation correlograms for a split.
+
+    The tasks for a split are handed out together, so only the most
+    recent split is kept.
+
+    Parameters
+    ----------
+    split: int
+    split_correlograms: tuple of np.ndarray
+        The acf and pair counts of the training towers, then of the
+        validation towers, at every lag.
+
+    Returns
+    -------
+    fit_problem_train: CompressedCorrelogram
+    acf_weights_train: np.ndarray
+    training_correlogram: tuple of np.ndarray
+        The lags, acf and pair counts of the uncompressed training
+        correlogram.
+    validation_correlogram: tuple of np.ndarray
+        The lags, acf and pair counts of the validation correlogram.
+    """
+    if _WORKER_STATE.get("split") == split:
+        return _WORKER_STATE["split_fit_problem"]
+
+    acf_lags = _WORKER_STATE["acf_lags"]
+    acf_train, n_pairs_train, acf_validate, n_pairs_validate = (
+        split_correlograms
+    )
+    _LOGGER.info("Split %3d", split)
+    fit_problem_train, acf_weights_train, training_correlogram = (
+        prepare_fit_problem(acf_lags, acf_train, n_pairs_train)
+    )
+
+    # Set up validation data as well
+    keep_validate = n_pairs_validate >= 1
+
+    _WORKER_STATE["split"] = split
+    _WORKER_STATE["split_fit_problem"] = (
+        fit_problem_train,
+        acf_weights_train,
+        training_correlogram,
+        (
+            acf_lags[keep_validate],
+            acf_validate[keep_validate],
+            n_pairs_validate[keep_validate],
+        ),
+    )
+    return _WORKER_STATE["split_fit_problem"]
+
+
+def fit_split_function(task):
+    """Fit one correlation function to the training towers of one split.
+
+    Must be called in a process set up by :func:`_initialize_worker`.
+
+    Parameters
+    ----------
+    task: Tuple[int, int, tuple]
+        The split, the index of the function in CORRELATION_PARTS_LIST,
+        and the correlograms of the split from
+        :func:`combine_split_correlograms`: training acf and pair
+        counts, then validation acf and pair counts.
+
+    Returns
+    -------
+    opt_params: np.ndarray[N_params] or None
+        None if the fit failed.
+    param_cov: np.ndarray[N_params, N_params] or None
+    validation_error: float
+    """
+    split, function_index, split_correlograms = task
+    combination = CORRELATION_PARTS_LIST[function_index]
+    fit_problem_train, acf_weights_train, training_correlogram, (
+        validation_correlogram
+    ) = _get_split_fit_problem(split, split_correlograms)
+
+    opt_params, param_cov = fit_correlation_function(
+        combination, fit_problem_train, acf_weights_train,
+        training_correlogram,
+    )
+    if opt_params is None:
+        return None, None, np.nan
+
+    mismatch_function = getattr(
+        correlation_function_kernels,
+        "{fun_name}_fit_ne".format(
+            fun_name=get_function_short_name(combination)
+        ),
+    )
+    validation_error = mismatch_function(opt_params, *validation_correlogram)
+    _LOGGER.info("Done fit and cross-validation")
+    return opt_params, param_cov, validation_error
+
+
+def merge_results(result_ds, tasks, results):
+    """Put the results of the fits into the dataset.
+
+    Parameters
+    ----------
+    result_ds: xarray.Dataset
+        From :func:`make_cross_validation_dataset`.  Modified in place.
+    tasks: Iterable[Tuple[int, int]]
+    results: Iterable[tuple]
+        From :func:`fit_split_function`, in the same order as tasks.
+    """
+    error = result_ds["cross_validation_error"].values
+    parameters = result_ds["optimized_parameters"].values
+    covariance = result_ds[
+        "optimized_parameters_estimated_covariance_matrix"
+    ].values
+    last_function = len(CORRELATION_PARTS_LIST) - 1
+
+    for (split, function_index), (opt_params, param_cov, validation_error) in (
+            zip(tasks, results)
+    ):
+        if opt_params is not None:
+            param_index = [
+                PARAMETER_NAMES.index(param)
+                for param in get_full_parameter_list(
+                    *CORRELATION_PARTS_LIST[function_index]
+                )
+            ]
+            parameters[function_index, split, param_index] = opt_params
+            covariance[function_index, split][
+                np.ix_(param_index, param_index)
+            ] = param_cov
+            error[function_index, split] = validation_error
+        if function_index == last_function:
+            _LOGGER.info("Done cross-validation loop %d", split)
+
+
+def run_cross_validation(n_workers=N_WORKERS, seed=SPLIT_SEED,
+                         n_splits=N_SPLITS, shard=None):
+    """Fit every function to every split and validate the fits.
+
+    Parameters
+    ----------
+    n_workers: int
+        Number of processes.  One runs everything in this process.
+    seed: int
+    n_splits: int
+    shard: shard_utils.Shard, optional
+        Do only this part of the (split, function) fits.  The other
+        results are left NaN.
+
+    Returns
+    -------
+    xarray.Dataset
+    """
+    autocorrelation_data = get_autocorrelation_data()
+    sites = get_sites_to_fit(autocorrelation_data)
+    acf_lags, weighted_acf, n_pairs = get_site_correlogram_matrices(
+        autocorrelation_data, sites
+    )
+    autocorrelation_data.close()
+    training_towers, validation_towers = generate_splits(
+        sites, n_splits, seed
+    )
+    result_ds = make_cross_validation_dataset(
+        training_towers, validation_towers, seed
+    )
+
+    # Split-major order, so each process gets every function for a
+    # split at once and combines the correlograms only once.
+    tasks = select_shard(
+        list(itertools.product(
+            range(n_splits), range(len(CORRELATION_PARTS_LIST))
+        )),
+        shard,
+    )
+
+    # Two matrix products each for the training and validation
+    # correlograms of every split in this shard.
+    shard_splits = sorted({split for split, _ in tasks})
+    _LOGGER.info("Combining tower correlograms for %d splits",
+                 len(shard_splits))
+    training_correlograms = combine_split_correlograms(
+        get_split_indicators(sites, training_towers[shard_splits]),
+        weighted_acf, n_pairs,
+    )
+    validation_correlograms = combine_split_correlograms(
+        get_split_indicators(sites, validation_towers[shard_splits]),
+        weighted_acf, n_pairs,
+    )
+    del weighted_acf, n_pairs
+    # The same tuple for every function of a split, so each chunk of
+    # tasks sends it to the workers only once.
+    split_correlograms = {
+        split: (
+            training_correlograms[0][i], training_correlograms[1][i],
+            validation_correlograms[0][i], validation_correlograms[1][i],
         )
-        _LOGGER.info("Done fit and cross-validation")
-    _LOGGER.info("Done cross-validation loop %d", i)
+        for i, split in enumerate(shard_splits)
+    }
+    fit_tasks = [
+        (split, function_index, split_correlograms[split])
+        for split, function_index in tasks
+    ]
 
-FUNCTION_PARAMS_AND_COV_DS = xarray.concat(
-    [xarray.concat(ds_list, dim="correlation_function")
-     for ds_list in FUNCTION_PARAMS_AND_COV],
-    dim="splits"
-)
-CROSS_TOWER_FIT_ERROR_DS = CROSS_TOWER_FIT_ERROR_DS.update(
-    FUNCTION_PARAMS_AND_COV_DS
-)
+    worker_args = (acf_lags,)
+    _LOGGER.info("Starting cross-validation")
+    if n_workers == 1:
+        _initialize_worker(*worker_args)
+        merge_results(result_ds, tasks, map(fit_split_function, fit_tasks))
+    else:
+        # Forked children inherit the numexpr thread pool and the
+        # netCDF library state, neither of which survives the fork.
+        with concurrent.futures.ProcessPoolExecutor(
+                n_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_initialize_worker,
+                initargs=worker_args + (1, True),
+        ) as executor:
+            merge_results(
+                result_ds,
+                tasks,
+                executor.map(
+                    fit_split_function, fit_tasks,
+                    chunksize=len(CORRELATION_PARTS_LIST),
+                ),
+            )
+    return result_ds
 
-encoding = {name: {"_FillValue": -9.999e9, "zlib": True}
-            for name in CROSS_TOWER_FIT_ERROR_DS.data_vars}
-encoding.update({name: {"_FillValue": None}
-                 for name in CROSS_TOWER_FIT_ERROR_DS.coords})
-CROSS_TOWER_FIT_ERROR_DS.to_netcdf(
-    "ameriflux-minus-casa-autocorrelation-function-multi-tower-fits"
-    "-300splits-run2.nc4",
-    format="NETCDF4", encoding=encoding
-)
-_LOGGER.info("Saved output")
+
+def save_results(result_ds, file_name):
+    """Save the cross-validation results.
+
+    Parameters
+    ----------
+    result_ds: xarray.Dataset
+    file_name: str
+    """
+    encoding = {name: {"_FillValue": -9.999e9, "zlib": True}
+                for name in result_ds.data_vars}
+    encoding.update({name: {"_FillValue": None}
+                     for name in result_ds.coords})
+    result_ds.to_netcdf(
+        file_name,
+        format="NETCDF4", encoding=encoding
+    )
+
+
+def merge_partial_results(file_name=OUTPUT_FILE_NAME):
+    """Combine the results saved by each shard.
+
+    Parameters
+    ----------
+    file_name: str
+        The name of the final output.
+
+    Returns
+    -------
+    xarray.Dataset
+    """
+    result_ds = None
+    for partial_name in find_partial_files(file_name):
+        with xarray.open_dataset(partial_name) as partial_ds:
+            partial_ds = partial_ds.load()
+        if result_ds is None:
+            result_ds = partial_ds
+            continue
+        if partial_ds.attrs["split_seed"] != result_ds.attrs["split_seed"]:
+            raise ValueError(
+                "Shard {name:s} used a different split seed".format(
+                    name=partial_name
+                )
+            )
+        # Each (split, function) fit is in exactly one shard
+        result_ds = result_ds.fillna(partial_ds)
+    return result_ds
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
+    ARGS = PARSER.parse_args()
+    print(datetime.datetime.now())
+    if ARGS.merge:
+        CROSS_TOWER_FIT_ERROR_DS = merge_partial_results(OUTPUT_FILE_NAME)
+    else:
+        CROSS_TOWER_FIT_ERROR_DS = run_cross_validation(
+            ARGS.workers, ARGS.seed, shard=ARGS.shard
+        )
+
+    save_results(
+        CROSS_TOWER_FIT_ERROR_DS,
+        get_partial_file_name(OUTPUT_FILE_NAME, ARGS.shard),
+    )
+    _LOGGER.info("Saved output")
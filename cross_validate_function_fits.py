@@ -8,6 +8,7 @@ correlation functions.
 """
 from __future__ import print_function, division
 
+import argparse
 import datetime
 import itertools
 
@@ -17,8 +18,20 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import xarray
 
-import flux_correlation_function_fits
-from correlation_utils import get_autocorrelation_stats
+import correlation_function_kernels
+from correlation_utils import WindowedAutocorrelation
+from curve_fit_adapter import FusedCurveFunction
+from lag_grids import LagGrid
+from maximum_likelihood_fits import fit_maximum_likelihood
+from normal_equation_fits import fit_normal_equations
+from variable_projection_fits import fit_variable_projection
+from correlogram_compression import (
+    CompressedCorrelogram, compress_correlogram, compression_error,
+)
+from shard_utils import (
+    add_shard_arguments, find_partial_files, get_partial_file_name,
+    select_shard,
+)
 
 from correlation_function_fits import (
     GLOBAL_DICT, CorrelationPart, PartForm,
@@ -39,6 +52,24 @@ HOURS_PER_YEAR = HOURS_PER_DAY * DAYS_PER_YEAR
 N_YEARS_DATA = 2
 REQUIRED_DATA_FRAC = 0.8
 
+# Fit to lag bins rather than every hourly lag.  This approximates
+# the full problem, so the fitted parameters change slightly.
+COMPRESS_CORRELOGRAMS = False
+
+# How to split each site into training and validation data.
+# "halves" trains on the first half of the data and validates on the
+# second.  "blocked-k-fold" cuts the data into N_FOLDS contiguous
+# blocks and validates on each in turn, training on the rest.
+CROSS_VALIDATION_MODE = "halves"
+N_FOLDS = 4
+
+# How to fit the parameters.  "correlogram" fits the empirical ACF of
+# the training data.  "maximum-likelihood" starts there and then
+# maximizes the Gaussian likelihood of the training data themselves.
+FIT_METHOD = "correlogram"
+# Correlogram solver: see normal_equation_fits.fit_normal_equations
+FIT_SOLVER = "curve_fit"
+
 
 def has_enough_data(da):
     """Check whether there is enough data for a good analysis.
@@ -164,136 +195,203 @@ for coef, val in PARAM_UPPER_BOUNDS.items():
     PARAM_UPPER_BOUNDS[coef] = np.float32(val)
 
 ############################################################
-# Read in data
-AMERIFLUX_MINUS_CASA_DATA = xarray.open_dataset(
-    "ameriflux-and-casa-matching-data-2.nc4"
+# The functions to fit, by the names of the generated kernels
+FUNCTION_FORMS = {
+    "_".join([
+        "{0:s}{1:s}".format(
+            part.get_short_name(),
+            form.get_short_name(),
+        )
+        for part, form in zip(CorrelationPart, forms)
+    ]): forms
+    for forms in itertools.product(PartForm, PartForm, PartForm)
+    if is_valid_combination(*forms)
+}
+
+AMERIFLUX_MINUS_CASA_FILE_NAME = "ameriflux-and-casa-matching-data-2.nc4"
+COEF_DATA_FILE_NAME = "coefficient-data-loop.csv"
+COEF_VAR_DATA_FILE_NAME = "coefficient-variance-data-loop.csv"
+CORRELATION_FIT_ERROR_FILE_NAME = "correlation-fit-error-loop.csv"
+
+PARSER = argparse.ArgumentParser(
+    description=__doc__,
 )
+add_shard_arguments(PARSER)
 
-############################################################
-# Set up data frames for results
-COEF_DATA = pd.DataFrame(
-    index=pd.MultiIndex.from_product(
-        [AMERIFLUX_MINUS_CASA_DATA.indexes["site"],
-         [
-             "_".join([
-                 "{0:s}{1:s}".format(
-                     part.get_short_name(),
-                     form.get_short_name(),
-                 )
-                 for part, form in zip(CorrelationPart, forms)
-             ])
-             for forms in itertools.product(PartForm, PartForm, PartForm)
-             if is_valid_combination(*forms)
-         ]],
-        names=["Site", "Correlation Function"],
-    ),
-    columns=[
-        "daily_coef",
-        "daily_timescale",
-        "daily_coef1",
-        "daily_coef2",
-        "daily_width",
-        "dm_coef1",
-        "dm_coef2",
-        "dm_width",
-        "ann_coef",
-        "ann_timescale",
-        "ann_coef1",
-        "ann_coef2",
-        "ann_width",
-        "resid_coef",
-        "resid_timescale",
-        "ec_coef",
-        "ec_timescale",
-    ],
-    dtype=np.float32,
-)
-COEF_VAR_DATA = COEF_DATA.copy()
-CORRELATION_FIT_ERROR = pd.DataFrame(
-    index=COEF_DATA.index,
-    columns=pd.MultiIndex.from_product(
-        [
-            ["function_optimized", "other_function"],
-            ["weighted_error_in_sample", "weighted_error_out_of_sample"],
+
+def make_result_frames(index):
+    """Set up data frames for results.
+
+    Parameters
+    ----------
+    index: pd.MultiIndex
+        The (site, function) pairs to fit.
+
+    Returns
+    -------
+    coef_data: pd.DataFrame
+    coef_var_data: pd.DataFrame
+    correlation_fit_error: pd.DataFrame
+    """
+    coef_data = pd.DataFrame(
+        index=index,
+        columns=[
+            "daily_coef",
+            "daily_timescale",
+            "daily_coef1",
+            "daily_coef2",
+            "daily_width",
+            "dm_coef1",
+            "dm_coef2",
+            "dm_width",
+            "ann_coef",
+            "ann_timescale",
+            "ann_coef1",
+            "ann_coef2",
+            "ann_width",
+            "resid_coef",
+            "resid_timescale",
+            "ec_coef",
+            "ec_timescale",
         ],
-        names=["which_function", "which_data"],
-    ),
-    dtype=np.float32,
-)
-CORRELATION_FIT_ERROR.iloc[:, :] = np.inf
+        dtype=np.float32,
+    )
+    coef_var_data = coef_data.copy()
+    correlation_fit_error = pd.DataFrame(
+        index=coef_data.index,
+        columns=pd.MultiIndex.from_product(
+            [
+                ["function_optimized", "other_function"],
+                ["weighted_error_in_sample", "weighted_error_out_of_sample"],
+            ],
+            names=["which_function", "which_data"],
+        ),
+        dtype=np.float32,
+    )
+    correlation_fit_error.iloc[:, :] = np.inf
+    return coef_data, coef_var_data, correlation_fit_error
+
+
+def fit_site(ameriflux_minus_casa_data, site_name, function_names,
+             coef_data, coef_var_data, correlation_fit_error):
+    """Fit and cross-validate correlation functions for one site.
+
+    Parameters
+    ----------
+    ameriflux_minus_casa_data: xarray.Dataset
+    site_name: str
+    function_names: List[str]
+        Keys of FUNCTION_FORMS.
+    coef_data, coef_var_data, correlation_fit_error: pd.DataFrame
+        From :func:`make_result_frames`.  Modified in place.
 
-for site_name in AMERIFLUX_MINUS_CASA_DATA.indexes["site"]:
+    Returns
+    -------
+    tuple or None
+        The lags and correlograms of the last training and validation
+        split, for plots, or None if the site does not have enough
+        data.
+    """
     print(site_name, flush=True)
     # Pull out non-missing site data, so I can get a decent idea of
     # what has enough data I can use.
-    site_data = AMERIFLUX_MINUS_CASA_DATA[
+    site_data = ameriflux_minus_casa_data[
         "flux_difference"
     ].sel(
         site=site_name
     ).dropna("time").sortby("time")
 
-    # Split data in two, so we have separate training and validation
-    # data sets.
-    first_half  = site_data.isel(
-        time=slice(None, len(site_data) // 2)
-    )
-    second_half = site_data.isel(
-        time=slice(len(site_data) // 2, None)
-    )
-    if not (has_enough_data(first_half) and has_enough_data(second_half)):
+    # Split data into blocks with equal amounts of data, so we have
+    # separate training and validation data sets.
+    if CROSS_VALIDATION_MODE == "halves":
+        n_blocks = 2
+        train_validation_blocks = [([0], [1])]
+    elif CROSS_VALIDATION_MODE == "blocked-k-fold":
+        n_blocks = N_FOLDS
+        train_validation_blocks = [
+            ([block for block in range(n_blocks) if block != fold], [fold])
+            for fold in range(n_blocks)
+        ]
+    else:
+        raise ValueError(
+            "Unknown cross-validation mode: {mode!r}".format(
+                mode=CROSS_VALIDATION_MODE
+            )
+        )
+    block_data = [
+        site_data.isel(
+            time=slice(
+                len(site_data) * block // n_blocks,
+                len(site_data) * (block + 1) // n_blocks,
+            )
+        )
+        for block in range(n_blocks)
+    ]
+    if not all(has_enough_data(block) for block in block_data):
         print("Not enough data.  Skipping:", site_name)
-        continue
-    
-    # Resample to an hour, so acf/count_pairs can work (they assume
-    # regularly spaced data, and I need the .freq attribute to make
-    # that happen)
-    first_half.resample(time="1H").first()
-    second_half.resample(time="1H").first()
-
-    for train_data, validation_data in itertools.permutations(
-            [first_half, second_half]
-    ):
+        return None
+
+    # Resample to an hour, so the ACF engine can work (it assumes
+    # regularly spaced data).  The lag sums within and between blocks
+    # are found once, and each split only adds them up.
+    hourly_data = site_data.to_dataframe()[
+        "flux_difference"
+    ].resample("1H").first()
+    block_starts = hourly_data.index.searchsorted(
+        [block.indexes["time"][0] for block in block_data], side="right"
+    ) - 1
+    windowed_acf = WindowedAutocorrelation(
+        hourly_data.values, block_starts, freq=hourly_data.index.freq
+    )
+
+    for train_blocks, validation_blocks in train_validation_blocks:
         print("New train/val split")
-        corr_data_train = get_autocorrelation_stats(
-            train_data.to_dataframe()[
-                "flux_difference"
-            ].resample("1H").first()
+        corr_data_train = windowed_acf.get_autocorrelation_stats(
+            train_blocks
         )
         corr_data_train = corr_data_train[
             corr_data_train["pair_counts"] > 0
         ]
-        corr_data_validate = get_autocorrelation_stats(
-            validation_data.to_dataframe()[
-                "flux_difference"
-            ].resample("1H").first()
+        corr_data_validate = windowed_acf.get_autocorrelation_stats(
+            validation_blocks
         )
         corr_data_validate = corr_data_validate[
             corr_data_validate["pair_counts"] > 0
         ]
         acf_lags_train = timedelta_index_to_floats(corr_data_train.index)
         acf_lags_validate = timedelta_index_to_floats(corr_data_validate.index)
-        acf_weights_train = 1. / np.sqrt(corr_data_train["pair_counts"])
+        # Every function is scored on these lags, so make the grids once
+        lag_grid_train = LagGrid(acf_lags_train)
+        lag_grid_validate = LagGrid(acf_lags_validate)
+        if COMPRESS_CORRELOGRAMS:
+            fit_problem_train = compress_correlogram(
+                acf_lags_train,
+                corr_data_train["acf"].values,
+                corr_data_train["pair_counts"].values,
+            )
+            print("Compressed", len(acf_lags_train), "lags to",
+                  len(fit_problem_train.lags), "points")
+        else:
+            fit_problem_train = CompressedCorrelogram(
+                acf_lags_train.astype(np.float32),
+                corr_data_train["acf"].astype(np.float32).values,
+                corr_data_train["pair_counts"].astype(np.float32).values,
+                0.,
+            )
+        acf_weights_train = 1. / np.sqrt(fit_problem_train.pair_counts)
         acf_weights_validate = 1. / np.sqrt(corr_data_validate["pair_counts"])
 
-        for forms in itertools.product(PartForm, PartForm, PartForm):
-            if not is_valid_combination(*forms):
-                continue
+        for func_short_name in function_names:
+            forms = FUNCTION_FORMS[func_short_name]
 
             # Get function to optimize
-            func_short_name = "_".join([
-                 "{0:s}{1:s}".format(
-                     part.get_short_name(),
-                     form.get_short_name(),
-                 )
-                 for part, form in zip(CorrelationPart, forms)
-             ])
             print(func_short_name, flush=True)
             name_to_optimize = "{fun_name}_fit_loop".format(fun_name=func_short_name)
             fun_to_optimize = getattr(
-                flux_correlation_function_fits, name_to_optimize
+                correlation_function_kernels, name_to_optimize
             )
             fun_to_check = getattr(
-                flux_correlation_function_fits,
+                correlation_function_kernels,
                 "{fun_name}_fit_ne".format(fun_name=func_short_name),
             )
 
@@ -314,47 +412,109 @@ for site_name in AMERIFLUX_MINUS_CASA_DATA.indexes["site"]:
 
             # Try the optimization
             # Use curve_fit to fine-tune
-            curve_and_deriv = getattr(
-                flux_correlation_function_fits,
-                "{fun_name:s}_curve_loop".format(fun_name=func_short_name),
-            )
-            def curve_deriv(tdata, *params):
-                return curve_and_deriv(tdata, *params)[1]
+            # The model and Jacobian share one pass of the loop kernel
+            fused_curve = FusedCurveFunction.from_short_name(func_short_name)
             try:
-                opt_params, param_cov = scipy.optimize.curve_fit(
-                    getattr(
-                        flux_correlation_function_fits,
-                        "{fun_name:s}_curve_ne".format(
-                            fun_name=func_short_name
+                if FIT_SOLVER == "variable-projection":
+                    opt_params, param_cov, fit_info = fit_variable_projection(
+                        getattr(
+                            correlation_function_kernels,
+                            "{fun_name:s}_curve_loop".format(
+                                fun_name=func_short_name
+                            ),
                         ),
-                    ),
-                    acf_lags_train.astype(np.float32),
-                    corr_data_train["acf"].astype(np.float32).values,
-                    starting_params.astype(np.float32),
-                    acf_weights_train.astype(np.float32),
-                    bounds=(
-                        lower_bounds.astype(np.float32),
-                        upper_bounds.astype(np.float32),
-                    ),
-                    jac=curve_deriv,
-                )
+                        getattr(
+                            correlation_function_kernels,
+                            "{fun_name:s}_normal_loop".format(
+                                fun_name=func_short_name
+                            ),
+                        ),
+                        forms,
+                        fit_problem_train.lags,
+                        fit_problem_train.acf,
+                        fit_problem_train.pair_counts,
+                        starting_params,
+                        (lower_bounds, upper_bounds),
+                        full_output=True,
+                    )
+                elif FIT_SOLVER == "normal-equations":
+                    opt_params, param_cov, fit_info = fit_normal_equations(
+                        getattr(
+                            correlation_function_kernels,
+                            "{fun_name:s}_normal_loop".format(
+                                fun_name=func_short_name
+                            ),
+                        ),
+                        fit_problem_train.lags,
+                        fit_problem_train.acf,
+                        fit_problem_train.pair_counts,
+                        starting_params,
+                        (lower_bounds, upper_bounds),
+                        full_output=True,
+                    )
+                else:
+                    opt_params, param_cov = scipy.optimize.curve_fit(
+                        fused_curve.curve,
+                        fit_problem_train.lags,
+                        fit_problem_train.acf,
+                        starting_params.astype(np.float32),
+                        acf_weights_train.astype(np.float32),
+                        bounds=(
+                            lower_bounds.astype(np.float32),
+                            upper_bounds.astype(np.float32),
+                        ),
+                        jac=fused_curve.jacobian,
+                    )
             except (RuntimeError, ValueError) as err:
                 print(err, "Curve fit failed, next function", sep="\n")
                 continue
             print(opt_params)
+            if FIT_SOLVER != "curve_fit":
+                print("Kernel passes:", fit_info["nfev"])
+            else:
+                print(fused_curve)
+            if FIT_METHOD == "maximum-likelihood":
+                train_mask = np.zeros(len(hourly_data), dtype=bool)
+                for block in train_blocks:
+                    train_mask[
+                        windowed_acf.block_starts[block]:
+                        windowed_acf.block_ends[block]
+                    ] = True
+                ml_fit = fit_maximum_likelihood(
+                    hourly_data.values, fused_curve.curve_and_deriv,
+                    opt_params,
+                    lower_bounds, upper_bounds, have_data=train_mask,
+                )
+                print("Maximum likelihood:", ml_fit.parameters,
+                      "log-likelihood:", ml_fit.log_likelihood)
+                opt_params = np.asarray(ml_fit.parameters, dtype=np.float64)
+                # No covariance estimate from the stochastic fit
+                param_cov = np.full_like(param_cov, np.nan)
+            if COMPRESS_CORRELOGRAMS:
+                print(
+                    "Training error (full, compressed, relative difference):",
+                    *compression_error(
+                        fun_to_optimize,
+                        opt_params,
+                        acf_lags_train,
+                        corr_data_train["acf"].values,
+                        corr_data_train["pair_counts"].values,
+                        fit_problem_train,
+                    )
+                )
 
             # If this fit's cross-validation score is worse than the
             # currently-stored one, don't bother recording.
             if (
                     fun_to_optimize(
                         opt_params,
-                        acf_lags_validate,
+                        lag_grid_validate,
                         corr_data_validate["acf"].astype(np.float32).values,
                         corr_data_validate["pair_counts"].astype(
                             np.float32
                         ).values,
                     )[0] >
-                    CORRELATION_FIT_ERROR.loc[
+                    correlation_fit_error.loc[
                         (site_name, func_short_name),
                         ("function_optimized", "weighted_error_out_of_sample")
                     ]
@@ -362,50 +522,67 @@ for site_name in AMERIFLUX_MINUS_CASA_DATA.indexes["site"]:
                 continue
 
             # Otherwise, save the results
-            COEF_DATA.loc[(site_name, func_short_name), parameter_list] = (
+            coef_data.loc[(site_name, func_short_name), parameter_list] = (
                 opt_params
             )
-            COEF_VAR_DATA.loc[(site_name, func_short_name), parameter_list] = (
+            coef_var_data.loc[(site_name, func_short_name), parameter_list] = (
                 np.diag(param_cov)
             )
-            CORRELATION_FIT_ERROR.loc[
+            correlation_fit_error.loc[
                 (site_name, func_short_name),
                 ("function_optimized", "weighted_error_in_sample"),
             ] = fun_to_optimize(
                 opt_params,
-                acf_lags_train,
+                lag_grid_train,
                 corr_data_train["acf"].astype(np.float32).values,
                 corr_data_train["pair_counts"].astype(np.float32).values,
             )[0]
-            CORRELATION_FIT_ERROR.loc[
+            correlation_fit_error.loc[
                 (site_name, func_short_name),
                 ("function_optimized", "weighted_error_out_of_sample"),
             ] = fun_to_optimize(
                 opt_params,
-                acf_lags_validate,
+                lag_grid_validate,
                 corr_data_validate["acf"].astype(np.float32).values,
                 corr_data_validate["pair_counts"].astype(np.float32).values,
             )[0]
-            CORRELATION_FIT_ERROR.loc[
+            correlation_fit_error.loc[
                 (site_name, func_short_name),
                 ("other_function", "weighted_error_in_sample"),
             ] = fun_to_check(
                 opt_params,
-                acf_lags_train,
+                lag_grid_train,
                 corr_data_train["acf"].astype(np.float32).values,
                 corr_data_train["pair_counts"].astype(np.float32).values,
             )
-            CORRELATION_FIT_ERROR.loc[
+            correlation_fit_error.loc[
                 (site_name, func_short_name),
                 ("other_function", "weighted_error_out_of_sample"),
             ] = fun_to_check(
                 opt_params,
-                acf_lags_validate,
+                lag_grid_validate,
                 corr_data_validate["acf"].astype(np.float32).values,
                 corr_data_validate["pair_counts"].astype(np.float32).values,
             )
-        break
-    # Done fits, make plots.
+    return (
+        acf_lags_train, corr_data_train,
+        acf_lags_validate, corr_data_validate,
+    )
+
+
+def plot_site_fits(site_name, coef_data, correlation_fit_error,
+                   acf_lags_train, corr_data_train,
+                   acf_lags_validate, corr_data_validate):
+    """Plot the correlograms and the three best fits for a site.
+
+    Parameters
+    ----------
+    site_name: str
+    coef_data, correlation_fit_error: pd.DataFrame
+        Must have every function for this site.
+    acf_lags_train, acf_lags_validate: np.ndarray
+    corr_data_train, corr_data_validate: pd.DataFrame
+    """
     fig, axes = plt.subplots(4, 2, sharey=True, sharex=True, figsize=(6.5, 5))
     fig.suptitle("Correlation fit for {site:s}".format(site=site_name))
     axes[0, 0].set_title("Training data")
@@ -424,7 +601,7 @@ for site_name in AMERIFLUX_MINUS_CASA_DATA.indexes["site"]:
     for ax in axes[-1, :]:
         ax.set_xlabel("Time difference (years)")
         ax.set_xticklabels(range(len(xticks)))
-    sorted_fits = CORRELATION_FIT_ERROR.loc[
+    sorted_fits = correlation_fit_error.loc[
         (site_name, slice(None)), ("function_optimized", slice(None))
     ].sort_values(
         ("function_optimized", "weighted_error_out_of_sample")
@@ -433,21 +610,21 @@ for site_name in AMERIFLUX_MINUS_CASA_DATA.indexes["site"]:
     for i, fun_name in enumerate(sorted_fits.iloc[:3, :].index.get_level_values(1), 1):
         print(fun_name)
         curve_fun = getattr(
-            flux_correlation_function_fits,
+            correlation_function_kernels,
             "{fun_name:s}_curve_ne".format(fun_name=fun_name),
         )
         axes[i, 0].plot(
             acf_lags_train,
             curve_fun(
                 acf_lags_train,
-                **COEF_DATA.loc[(site_name, fun_name)].dropna(),
+                **coef_data.loc[(site_name, fun_name)].dropna(),
             ),
         )
         axes[i, 1].plot(
             acf_lags_validate,
             curve_fun(
                 acf_lags_validate,
-                **COEF_DATA.loc[(site_name, fun_name)].dropna(),
+                **coef_data.loc[(site_name, fun_name)].dropna(),
             ),
         )
         axes[i, 0].set_ylabel(fun_name)
@@ -471,6 +648,86 @@ for site_name in AMERIFLUX_MINUS_CASA_DATA.indexes["site"]:
     )
     plt.close(fig)
 
-COEF_DATA.to_csv("coefficient-data-loop.csv")
-COEF_VAR_DATA.to_csv("coefficient-variance-data-loop.csv")
-CORRELATION_FIT_ERROR.to_csv("correlation-fit-error-loop.csv")
+
+def read_partial_results(file_name, n_header_rows=1):
+    """Combine the partial CSV results of every shard.
+
+    Parameters
+    ----------
+    file_name: str
+        The name of the final output.
+    n_header_rows: int
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    return pd.concat(
+        [
+            pd.read_csv(
+                partial_name,
+                index_col=[0, 1],
+                header=list(range(n_header_rows)),
+            )
+            for partial_name in find_partial_files(file_name)
+        ],
+        axis=0,
+    ).astype(np.float32)
+
+
+if __name__ == "__main__":
+    ARGS = PARSER.parse_args()
+    if ARGS.merge:
+        COEF_DATA = read_partial_results(COEF_DATA_FILE_NAME)
+        COEF_VAR_DATA = read_partial_results(COEF_VAR_DATA_FILE_NAME)
+        CORRELATION_FIT_ERROR = read_partial_results(
+            CORRELATION_FIT_ERROR_FILE_NAME, 2
+        )
+    else:
+        ########################################################
+        # Read in data
+        AMERIFLUX_MINUS_CASA_DATA = xarray.open_dataset(
+            AMERIFLUX_MINUS_CASA_FILE_NAME
+        )
+        # Work units are (site, function) pairs, site-major, so
+        # most shards see all the functions for each of their sites.
+        WORK_UNITS = select_shard(
+            list(itertools.product(
+                AMERIFLUX_MINUS_CASA_DATA.indexes["site"], FUNCTION_FORMS
+            )),
+            ARGS.shard,
+        )
+        COEF_DATA, COEF_VAR_DATA, CORRELATION_FIT_ERROR = make_result_frames(
+            pd.MultiIndex.from_tuples(
+                WORK_UNITS, names=["Site", "Correlation Function"],
+            )
+        )
+
+        for site_name, site_units in itertools.groupby(
+                WORK_UNITS, key=lambda unit: unit[0]
+        ):
+            site_function_names = [unit[1] for unit in site_units]
+            split_data = fit_site(
+                AMERIFLUX_MINUS_CASA_DATA, site_name, site_function_names,
+                COEF_DATA, COEF_VAR_DATA, CORRELATION_FIT_ERROR,
+            )
+            if split_data is None:
+                continue
+            if len(site_function_names) < len(FUNCTION_FORMS):
+                print("Functions for", site_name, "split across shards.",
+                      "Skipping plots.")
+                continue
+            # Done fits, make plots.
+            plot_site_fits(
+                site_name, COEF_DATA, CORRELATION_FIT_ERROR, *split_data
+            )
+
+    COEF_DATA.to_csv(
+        get_partial_file_name(COEF_DATA_FILE_NAME, ARGS.shard)
+    )
+    COEF_VAR_DATA.to_csv(
+        get_partial_file_name(COEF_VAR_DATA_FILE_NAME, ARGS.shard)
+    )
+    CORRELATION_FIT_ERROR.to_csv(
+        get_partial_file_name(CORRELATION_FIT_ERROR_FILE_NAME, ARGS.shard)
+    )
@@ -0,0 +1,144 @@
+# ~*~ coding: utf8 ~*~
+"""Share one kernel pass between the model and Jacobian of a fit.
+
+:func:`scipy.optimize.curve_fit` asks for the model and then for the
+Jacobian at the same parameters.  The generated ``*_curve_loop``
+kernels find both in one pass, so calling ``*_curve_ne`` for the model
+and ``*_curve_loop(...)[1]`` for the Jacobian computes the curve twice
+per accepted step.  :class:`FusedCurveFunction` remembers the last
+curve and Jacobian and hands out whichever part is asked for, so the
+model call at each new point pays for the Jacobian as well, and the
+Jacobian call that follows is free.  The counters record how many
+passes the cache saved.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+import correlation_function_kernels
+from lag_grids import get_lag_grid
+
+
+class FusedCurveFunction(object):
+    """Model and Jacobian callbacks for curve_fit from one kernel.
+
+    Parameters
+    ----------
+    curve_and_deriv: callable
+        One of the generated ``*_curve_loop`` kernels.
+    dtype: np.dtype
+        The precision of the kernel pass.  The default matches the
+        float64 results of the ``*_curve_ne`` kernels.
+
+    Examples
+    --------
+    >>> fused = FusedCurveFunction.from_short_name("d0_dm0_a0")
+    >>> scipy.optimize.curve_fit(
+    ...     fused.curve, lags, acf, starting_params, jac=fused.jacobian
+    ... )
+    """
+
+    def __init__(self, curve_and_deriv, dtype=np.float64):
+        self.curve_and_deriv = curve_and_deriv
+        self.dtype = np.dtype(dtype)
+        self.n_curve_calls = 0
+        self.n_jacobian_calls = 0
+        self.n_kernel_calls = 0
+        self._tdata = None
+        self._kernel_tdata = None
+        self._params = None
+        self._result = None
+
+    @classmethod
+    def from_short_name(cls, func_short_name, dtype=np.float64):
+        """Wrap the ``*_curve_loop`` kernel for a function.
+
+        Parameters
+        ----------
+        func_short_name: str
+            Like ``"d0_dm0_a0"``.
+        dtype: np.dtype
+
+        Returns
+        -------
+        FusedCurveFunction
+        """
+        return cls(
+            getattr(
+                correlation_function_kernels,
+                "{fun_name:s}_curve_loop".format(fun_name=func_short_name),
+            ),
+            dtype,
+        )
+
+    def _evaluate(self, tdata, params):
+        """Get the curve and Jacobian, running the kernel if needed.
+
+        Parameters
+        ----------
+        tdata: np.ndarray[N]
+        params: sequence of float
+
+        Returns
+        -------
+        curve: np.ndarray[N]
+        deriv: np.ndarray[N, N_params]
+        """
+        params = np.array(params, dtype=self.dtype)
+        if tdata is not self._tdata:
+            self._tdata = tdata
+            self._kernel_tdata = get_lag_grid(
+                np.ascontiguousarray(tdata, dtype=self.dtype)
+            )
+            self._params = None
+        if self._params is None or not np.array_equal(params, self._params):
+            self.n_kernel_calls += 1
+            self._result = self.curve_and_deriv(self._kernel_tdata, *params)
+            self._params = params
+        return self._result
+
+    def curve(self, tdata, *params):
+        """Find the correlation function at tdata.
+
+        Parameters
+        ----------
+        tdata: np.ndarray[N]
+        params: float
+
+        Returns
+        -------
+        np.ndarray[N]
+        """
+        self.n_curve_calls += 1
+        return self._evaluate(tdata, params)[0]
+
+    def jacobian(self, tdata, *params):
+        """Find the derivative of the curve wrt. params.
+
+        Parameters
+        ----------
+        tdata: np.ndarray[N]
+        params: float
+
+        Returns
+        -------
+        np.ndarray[N, N_params]
+        """
+        self.n_jacobian_calls += 1
+        return self._evaluate(tdata, params)[1]
+
+    @property
+    def n_saved_calls(self):
+        """The number of kernel passes avoided by the cache."""
+        return self.n_curve_calls + self.n_jacobian_calls - self.n_kernel_calls
+
+    def __repr__(self):
+        return (
+            "<{cls:s}: {curve:d} curve and {jac:d} Jacobian calls in "
+            "{kernel:d} kernel passes>".format(
+                cls=type(self).__name__,
+                curve=self.n_curve_calls,
+                jac=self.n_jacobian_calls,
+                kernel=self.n_kernel_calls,
+            )
+        )
@@ -0,0 +1,500 @@
+# ~*~ coding: utf8 ~*~
+"""Gaussian log-likelihoods for regularly-spaced series.
+
+The model is that the demeaned data are a sample from a stationary
+Gaussian process with autocovariance ``variance * f(lag)``, where f is
+one of the correlation functions (anything called as ``f(lags_in_days,
+*parameters)``, including the generated ``*_curve_ne`` kernels).  The
+variance is profiled out, so only the log-determinant of the
+correlation matrix R and the quadratic form ``x^T R^{-1} x`` are
+needed.
+
+Three ways to get those are provided:
+
+toeplitz
+    Exact, by the Durbin-Levinson recursion, in O(N^2) time and O(N)
+    memory.  Only for series without gaps, where R is Toeplitz.
+whittle
+    The debiased Whittle approximation (Sykulski et al. 2019) in
+    O(N log N).  Gaps are handled by comparing the periodogram of the
+    zero-filled series with its expected value, which uses the
+    autocovariance times the fraction of pairs present at each lag.
+pcg
+    Gap-aware.  The quadratic form uses preconditioned conjugate
+    gradients with FFT matrix-vector products through a circulant
+    embedding, preconditioned by the inverse of a circulant
+    approximation to R.  The log-determinant is estimated by
+    stochastic Lanczos quadrature.
+"""
+from __future__ import print_function, division
+
+import collections
+
+import numpy as np
+import scipy.fft
+import scipy.linalg
+
+HOURS_PER_DAY = 24
+LOG_2PI = np.log(2 * np.pi)
+
+PCG_TOLERANCE = 1e-6
+PCG_MAX_ITERATIONS = 1000
+N_LOGDET_PROBES = 16
+N_LANCZOS_STEPS = 60
+
+LikelihoodTerms = collections.namedtuple(
+    "LikelihoodTerms", ["log_determinant", "quadratic_form", "n_observations"]
+)
+LikelihoodTerms.__doc__ = """The parts of a Gaussian log-likelihood.
+
+log_determinant is log det R and quadratic_form is x^T R^{-1} x, for
+the correlation matrix R of the n_observations data points.
+"""
+
+
+def get_autocorrelation(correlation_function, parameters, n_lags,
+                        hours_per_step=1):
+    """Evaluate a correlation function on a regular lag grid.
+
+    Parameters
+    ----------
+    correlation_function: callable
+        Called as ``correlation_function(lags_in_days, *parameters)``.
+    parameters: sequence of float
+    n_lags: int
+    hours_per_step: float
+
+    Returns
+    -------
+    np.ndarray[n_lags]
+    """
+    lags = np.arange(n_lags, dtype=np.float32) * (
+        hours_per_step / HOURS_PER_DAY
+    )
+    return np.asarray(
+        correlation_function(lags, *parameters), dtype=np.float64
+    )
+
+
+def toeplitz_likelihood_terms(data, autocorrelation):
+    """Find the likelihood terms exactly by Durbin-Levinson.
+
+    The recursion finds the best linear predictor of each point from
+    all the points before it; the prediction error variances give
+    the determinant and the prediction errors give the quadratic
+    form.
+
+    Parameters
+    ----------
+    data: np.ndarray[N]
+        Demeaned, with no missing values.
+    autocorrelation: np.ndarray[N]
+
+    Returns
+    -------
+    LikelihoodTerms
+        Infinite if the correlation matrix is not positive definite.
+    """
+    n_times = len(data)
+    autocorrelation = autocorrelation[:n_times]
+    error_variance = autocorrelation[0]
+    if error_variance <= 0:
+        return LikelihoodTerms(np.inf, np.inf, n_times)
+    log_determinant = np.log(error_variance)
+    quadratic_form = data[0] ** 2 / error_variance
+    # predictor[:k] holds the coefficients for x[k - 1], ..., x[0]
+    predictor = np.zeros(n_times)
+    for step in range(1, n_times):
+        previous = predictor[:step - 1]
+        reflection = (
+            autocorrelation[step] -
+            previous.dot(autocorrelation[1:step][::-1])
+        ) / error_variance
+        previous -= reflection * previous[::-1].copy()
+        predictor[step - 1] = reflection
+        error_variance *= 1 - reflection ** 2
+        if error_variance <= 0:
+            return LikelihoodTerms(np.inf, np.inf, n_times)
+        prediction_error = data[step] - predictor[:step].dot(
+            data[step - 1::-1]
+        )
+        log_determinant += np.log(error_variance)
+        quadratic_form += prediction_error ** 2 / error_variance
+    return LikelihoodTerms(log_determinant, quadratic_form, n_times)
+
+
+def whittle_likelihood_terms(data, autocorrelation, have_data):
+    """Approximate the likelihood terms in the frequency domain.
+
+    Parameters
+    ----------
+    data: np.ndarray[N]
+        Demeaned, zero where have_data is False.
+    autocorrelation: np.ndarray[N]
+    have_data: np.ndarray[N] of bool
+
+    Returns
+    -------
+    LikelihoodTerms
+    """
+    n_times = len(data)
+    n_valid = np.sum(have_data)
+    fft_len = scipy.fft.next_fast_len(2 * n_times - 1, real=True)
+    # Fraction of pairs present at each lag
+    mask_spectrum = scipy.fft.rfft(have_data.astype(np.float64), fft_len)
+    pair_fraction = scipy.fft.irfft(
+        mask_spectrum.real ** 2 + mask_spectrum.imag ** 2, fft_len
+    )[:n_times] / n_valid
+    # Expected periodogram at the Fourier frequencies of the series
+    weighted_acf = autocorrelation[:n_times] * pair_fraction
+    expected_periodogram = (
+        2 * scipy.fft.rfft(weighted_acf).real - weighted_acf[0]
+    )
+    # The truncated transform of a valid correlation function can dip
+    # slightly below zero at some frequencies
+    expected_periodogram = np.maximum(
+        expected_periodogram, 1e-10 * expected_periodogram.max()
+    )
+    periodogram = np.abs(scipy.fft.rfft(data)) ** 2 / n_valid
+    # Every frequency but zero and Nyquist stands for a conjugate pair
+    frequency_weights = np.full(len(periodogram), 2.)
+    frequency_weights[0] = 0
+    if n_times % 2 == 0:
+        frequency_weights[-1] = 1
+    # Scale from N frequencies to n_valid observations
+    frequency_weights *= n_valid / n_times
+    return LikelihoodTerms(
+        np.sum(frequency_weights * np.log(expected_periodogram)),
+        np.sum(frequency_weights * periodogram / expected_periodogram),
+        n_valid,
+    )
+
+
+def get_embedding_spectrum(autocorrelation, fft_len):
+    """Find the spectrum of the circulant embedding of Toeplitz matrices.
+
+    Parameters
+    ----------
+    autocorrelation: np.ndarray[..., N]
+        The first column of each Toeplitz matrix.
+    fft_len: int
+        At least 2 * N - 1.
+
+    Returns
+    -------
+    np.ndarray[..., fft_len // 2 + 1]
+    """
+    n_times = autocorrelation.shape[-1]
+    embedding = np.zeros(autocorrelation.shape[:-1] + (fft_len,))
+    embedding[..., :n_times] = autocorrelation
+    embedding[..., fft_len - n_times + 1:] = autocorrelation[..., :0:-1]
+    return scipy.fft.rfft(embedding)
+
+
+class GappyToeplitzOperator(object):
+    """Products with the correlation matrix of the observed points.
+
+    Vectors on the observed points are put on the full time grid,
+    multiplied by the Toeplitz matrix through a circulant embedding,
+    and restricted to the observed points again.  All methods work
+    on the last axis, so several vectors can be handled at once.
+
+    Parameters
+    ----------
+    autocorrelation: np.ndarray[N]
+    have_data: np.ndarray[N] of bool
+    """
+
+    def __init__(self, autocorrelation, have_data):
+        n_times = len(have_data)
+        self.have_data = have_data
+        self.n_times = n_times
+        self.fft_len = scipy.fft.next_fast_len(2 * n_times - 1, real=True)
+        self.embedding_spectrum = get_embedding_spectrum(
+            autocorrelation[:n_times], self.fft_len
+        )
+        # Strang's circulant approximation, used as a preconditioner
+        half = n_times // 2
+        circulant = np.zeros(n_times)
+        circulant[:half + 1] = autocorrelation[:half + 1]
+        circulant[n_times - half:] = autocorrelation[half:0:-1][
+            :len(circulant[n_times - half:])
+        ]
+        circulant_eigenvalues = scipy.fft.rfft(circulant).real
+        self.preconditioner_spectrum = 1 / np.maximum(
+            circulant_eigenvalues, 1e-3 * circulant_eigenvalues.max()
+        )
+
+    def embed(self, vector, length):
+        """Put vectors on the observed points onto the full time grid.
+
+        Parameters
+        ----------
+        vector: np.ndarray[..., N_valid]
+        length: int
+            Zero-pad to this length.
+
+        Returns
+        -------
+        np.ndarray[..., length]
+        """
+        full = np.zeros(vector.shape[:-1] + (length,))
+        full[..., :self.n_times][..., self.have_data] = vector
+        return full
+
+    def apply_spectrum(self, vector_spectrum, spectrum):
+        """Multiply by a Toeplitz matrix given both spectra.
+
+        Parameters
+        ----------
+        vector_spectrum: np.ndarray[..., fft_len // 2 + 1]
+            rfft of the embedded vectors.
+        spectrum: np.ndarray[fft_len // 2 + 1]
+            From :func:`get_embedding_spectrum`.
+
+        Returns
+        -------
+        np.ndarray[..., N_valid]
+        """
+        product = scipy.fft.irfft(vector_spectrum * spectrum, self.fft_len)
+        return product[..., :self.n_times][..., self.have_data]
+
+    def matvec(self, vector):
+        """Multiply by the correlation matrix of the observed points.
+
+        Parameters
+        ----------
+        vector: np.ndarray[..., N_valid]
+
+        Returns
+        -------
+        np.ndarray[..., N_valid]
+        """
+        return self.apply_spectrum(
+            scipy.fft.rfft(self.embed(vector, self.fft_len)),
+            self.embedding_spectrum,
+        )
+
+    def precondition(self, vector):
+        """Apply the approximate inverse.
+
+        Parameters
+        ----------
+        vector: np.ndarray[..., N_valid]
+
+        Returns
+        -------
+        np.ndarray[..., N_valid]
+        """
+        product = scipy.fft.irfft(
+            scipy.fft.rfft(self.embed(vector, self.n_times)) *
+            self.preconditioner_spectrum,
+            self.n_times,
+        )
+        return product[..., self.have_data]
+
+    def solve(self, rhs, tolerance=PCG_TOLERANCE,
+              max_iterations=PCG_MAX_ITERATIONS):
+        """Solve R x = rhs by preconditioned conjugate gradients.
+
+        Parameters
+        ----------
+        rhs: np.ndarray[..., N_valid]
+            Each right-hand side is solved separately, but they share
+            the transforms.
+        tolerance: float
+            Relative to the norm of rhs.
+        max_iterations: int
+
+        Returns
+        -------
+        solution: np.ndarray[..., N_valid]
+        n_iterations: int
+        """
+        solution = np.zeros_like(rhs)
+        residual = rhs.copy()
+        preconditioned = self.precondition(residual)
+        direction = preconditioned.copy()
+        residual_dot = np.sum(residual * preconditioned, axis=-1, keepdims=True)
+        target = tolerance * np.linalg.norm(rhs, axis=-1, keepdims=True)
+        for iteration in range(1, max_iterations + 1):
+            product = self.matvec(direction)
+            step = residual_dot / np.sum(
+                direction * product, axis=-1, keepdims=True
+            )
+            solution += step * direction
+            residual -= step * product
+            if np.all(np.linalg.norm(residual, axis=-1, keepdims=True) <= target):
+                break
+            preconditioned = self.precondition(residual)
+            new_residual_dot = np.sum(
+                residual * preconditioned, axis=-1, keepdims=True
+            )
+            direction *= new_residual_dot / residual_dot
+            direction += preconditioned
+            residual_dot = new_residual_dot
+        return solution, iteration
+
+    def estimate_log_determinant(self, n_probes=N_LOGDET_PROBES,
+                                 n_steps=N_LANCZOS_STEPS, seed=0):
+        """Estimate log det R by stochastic Lanczos quadrature.
+
+        Parameters
+        ----------
+        n_probes: int
+            Number of random sign vectors to average over.
+        n_steps: int
+            Lanczos steps for each.
+        seed: int
+
+        Returns
+        -------
+        float
+        """
+        rng = np.random.default_rng(seed)
+        n_valid = np.sum(self.have_data)
+        n_steps = min(n_steps, n_valid)
+        estimates = []
+        for _ in range(n_probes):
+            probe = rng.choice([-1., 1.], n_valid)
+            basis = np.empty((n_steps, n_valid))
+            basis[0] = probe / np.sqrt(n_valid)
+            diagonal = np.empty(n_steps)
+            off_diagonal = np.empty(n_steps - 1)
+            for step in range(n_steps):
+                product = self.matvec(basis[step])
+                product_norm = np.linalg.norm(product)
+                diagonal[step] = basis[step].dot(product)
+                # Full reorthogonalization, done twice as one pass of
+                # classical Gram-Schmidt is not enough once Ritz values
+                # start to converge
+                for _ in range(2):
+                    product -= basis[:step + 1].T.dot(
+                        basis[:step + 1].dot(product)
+                    )
+                if step + 1 == n_steps:
+                    break
+                off_diagonal[step] = np.linalg.norm(product)
+                # The Krylov space is exhausted once almost nothing is
+                # left after orthogonalization.
+                if off_diagonal[step] < 1e-8 * product_norm:
+                    n_used = step + 1
+                    diagonal = diagonal[:n_used]
+                    off_diagonal = off_diagonal[:n_used - 1]
+                    break
+                basis[step + 1] = product / off_diagonal[step]
+            eigenvalues, eigenvectors = scipy.linalg.eigh_tridiagonal(
+                diagonal, off_diagonal
+            )
+            if np.any(eigenvalues <= 0):
+                return np.inf
+            estimates.append(
+                n_valid * np.sum(eigenvectors[0] ** 2 * np.log(eigenvalues))
+            )
+        return np.mean(estimates)
+
+
+def pcg_likelihood_terms(data, autocorrelation, have_data,
+                         n_probes=N_LOGDET_PROBES, seed=0):
+    """Find the likelihood terms with iterative methods.
+
+    Parameters
+    ----------
+    data: np.ndarray[N]
+        Demeaned.
+    autocorrelation: np.ndarray[N]
+    have_data: np.ndarray[N] of bool
+    n_probes: int
+    seed: int
+
+    Returns
+    -------
+    LikelihoodTerms
+        The log-determinant is a stochastic estimate; the quadratic
+        form is solved to PCG_TOLERANCE.
+    """
+    operator = GappyToeplitzOperator(autocorrelation, have_data)
+    observed = data[have_data]
+    solution, _ = operator.solve(observed)
+    return LikelihoodTerms(
+        operator.estimate_log_determinant(n_probes, seed=seed),
+        observed.dot(solution),
+        len(observed),
+    )
+
+
+def profile_log_likelihood(likelihood_terms):
+    """Find the log-likelihood with the variance at its best value.
+
+    Parameters
+    ----------
+    likelihood_terms: LikelihoodTerms
+
+    Returns
+    -------
+    float
+    """
+    log_determinant, quadratic_form, n_obs = likelihood_terms
+    if not (np.isfinite(log_determinant) and quadratic_form > 0):
+        return -np.inf
+    variance = quadratic_form / n_obs
+    return -0.5 * (
+        n_obs * (LOG_2PI + np.log(variance) + 1) + log_determinant
+    )
+
+
+def gaussian_log_likelihood(data, correlation_function, parameters,
+                            have_data=None, method="auto",
+                            hours_per_step=1):
+    """Find the log-likelihood of data for a correlation function.
+
+    Parameters
+    ----------
+    data: np.ndarray[N]
+        Regularly spaced.  Missing values may be NaN.
+    correlation_function: callable
+        Called as ``correlation_function(lags_in_days, *parameters)``.
+    parameters: sequence of float
+    have_data: np.ndarray[N] of bool, optional
+    method: {"auto", "toeplitz", "whittle", "pcg"}
+        "auto" uses "toeplitz" for series without gaps and "pcg"
+        otherwise.
+    hours_per_step: float
+
+    Returns
+    -------
+    float
+        The log-likelihood, with the mean and variance at their
+        sample estimates.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    mask = np.isfinite(data)
+    if have_data is not None:
+        mask &= have_data
+    valid = np.nonzero(mask)[0]
+    if len(valid) == 0:
+        return -np.inf
+    record = slice(valid[0], valid[-1] + 1)
+    data = data[record]
+    mask = mask[record]
+    data = np.where(mask, data - data[mask].mean(), 0)
+
+    autocorrelation = get_autocorrelation(
+        correlation_function, parameters, len(data), hours_per_step
+    )
+    if method == "auto":
+        method = "toeplitz" if mask.all() else "pcg"
+    if method == "toeplitz":
+        if not mask.all():
+            raise ValueError(
+                "The Toeplitz method needs data without gaps; "
+                "use \"pcg\" or \"whittle\"."
+            )
+        terms = toeplitz_likelihood_terms(data, autocorrelation)
+    elif method == "whittle":
+        terms = whittle_likelihood_terms(data, autocorrelation, mask)
+    elif method == "pcg":
+        terms = pcg_likelihood_terms(data, autocorrelation, mask)
+    else:
+        raise ValueError("Unknown method: {method!r}".format(method=method))
+    return profile_log_likelihood(terms)
@@ -0,0 +1,159 @@
+# ~*~ coding: utf8 ~*~
+"""Functions of the lags that do not depend on the parameters.
+
+Terms like ``cos(TWO_PI_OVER_DAY * tdata)`` or the square of
+``sin(PI_OVER_YEAR * tdata)`` only depend on the lags, but the loop
+kernels would otherwise work them out again at every optimizer
+iteration, for every combination of forms.  A :class:`LagGrid` keeps
+the lags along with each such term the first time a kernel asks for it,
+so only the parts that depend on the parameters are recomputed.
+
+The kernels accept either a LagGrid or the lags themselves.  Given the
+lags, they look up a LagGrid with :func:`get_lag_grid`, which keeps the
+grids for the last few distinct arrays of lags.  The fitting code makes
+its grids once and passes those, so the kernels need not hash the lags
+on every call.  A LagGrid also notes whether the lags are evenly
+spaced, like the hourly lags of the correlograms, in which case the
+kernels find the exponential decays by recurrence instead of calling
+exp at every lag.
+"""
+from __future__ import print_function, division
+
+import collections
+import hashlib
+
+import numexpr as ne
+import numpy as np
+
+# The number of distinct arrays of lags to keep grids for
+N_CACHED_GRIDS = 16
+_LAG_GRIDS = collections.OrderedDict()
+
+
+class LagGrid(object):
+    """The lags of a correlogram, with functions of them.
+
+    Parameters
+    ----------
+    lags: np.ndarray[N]
+        In days.  Converted to float64 unless already float32 or
+        float64.  The grid keeps a read-only copy, so later changes to
+        the array do not reach the grid.
+    """
+
+    def __init__(self, lags):
+        lags = np.asarray(lags)
+        if lags.dtype not in (np.float32, np.float64):
+            lags = lags.astype(np.float64)
+        self.lags = np.array(lags, order="C")
+        self.lags.flags.writeable = False
+        self._spacing = None
+        self._bases = {}
+        self._stacked_bases = {}
+
+    def __len__(self):
+        return len(self.lags)
+
+    @property
+    def spacing(self):
+        """The distance between successive lags.
+
+        Zero unless the lags are evenly spaced and increasing, to within
+        a few rounding errors.  The kernels use this to find the
+        exponentials at each lag from the lag before.
+        """
+        if self._spacing is None:
+            self._spacing = 0.0
+            if len(self.lags) > 1:
+                lags = self.lags.astype(np.float64)
+                spacing = (lags[-1] - lags[0]) / (len(lags) - 1)
+                even_lags = lags[0] + spacing * np.arange(len(lags))
+                if spacing > 0 and (
+                        np.abs(lags - even_lags).max() <=
+                        4 * np.finfo(self.lags.dtype).eps * np.abs(lags).max()
+                ):
+                    self._spacing = spacing
+        return self._spacing
+
+    def get_basis(self, expression):
+        """Get one function of the lags.
+
+        Parameters
+        ----------
+        expression: str
+            A numexpr expression using only ``tdata`` and numbers.
+
+        Returns
+        -------
+        np.ndarray[N]
+            Worked out in float64, and stored read-only with the type of
+            the lags.
+        """
+        if expression not in self._bases:
+            basis = np.asarray(
+                ne.evaluate(
+                    expression,
+                    local_dict={"tdata": self.lags.astype(np.float64)},
+                    global_dict={},
+                ),
+                dtype=self.lags.dtype,
+            )
+            basis.flags.writeable = False
+            self._bases[expression] = basis
+        return self._bases[expression]
+
+    def get_bases(self, expressions):
+        """Get several functions of the lags, one in each row.
+
+        Parameters
+        ----------
+        expressions: tuple of str
+            As for :meth:`get_basis`.
+
+        Returns
+        -------
+        np.ndarray[len(expressions), N]
+        """
+        if expressions not in self._stacked_bases:
+            result = np.empty(
+                (len(expressions), len(self.lags)), dtype=self.lags.dtype
+            )
+            for row, expression in zip(result, expressions):
+                row[:] = self.get_basis(expression)
+            result.flags.writeable = False
+            self._stacked_bases[expressions] = result
+        return self._stacked_bases[expressions]
+
+
+def get_lag_grid(lags):
+    """Find the LagGrid for the lags.
+
+    Parameters
+    ----------
+    lags: LagGrid or np.ndarray[N]
+
+    Returns
+    -------
+    LagGrid
+        The same one for equal arrays of lags with the same type, as
+        long as it is one of the last N_CACHED_GRIDS used.
+
+    Notes
+    -----
+    Finding the grid for an array means hashing all of it, so code
+    that calls the kernels many times with the same lags should make
+    the LagGrid once and pass that instead.
+    """
+    if isinstance(lags, LagGrid):
+        return lags
+    grid = LagGrid(lags)
+    key = (
+        grid.lags.dtype.str,
+        len(grid),
+        hashlib.sha1(grid.lags.view(np.uint8)).digest(),
+    )
+    grid = _LAG_GRIDS.pop(key, grid)
+    _LAG_GRIDS[key] = grid
+    if len(_LAG_GRIDS) > N_CACHED_GRIDS:
+        _LAG_GRIDS.popitem(last=False)
+    return grid
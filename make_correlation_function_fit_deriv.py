@@ -2,11 +2,24 @@
 # ~*~ coding: utf8 ~*~
 """Write a file containing cost functions.
 
-Also derivatives, ideally.
+Also derivatives, found by sympy from the expressions and checked
+against finite differences before anything is written.
+
+Each combination of forms gets its own small extension module in
+OUT_DIR, and flux_correlation_function_fits imports the kernels from
+all of them.  A module is only rewritten, and so only recompiled, when
+the hash of its source changes.
 """
 from __future__ import print_function, division
 
+import glob
+import hashlib
+import io
 import itertools
+import json
+import os
+import os.path
+import sys
 
 import numpy as np
 
@@ -17,26 +30,54 @@ from correlation_function_fits import (
     GLOBAL_DICT, CorrelationPart, PartForm,
     is_valid_combination, get_full_expression,
     get_full_parameter_list,
-    get_weighted_fit_expression,
+    check_derivatives, eliminate_common_subexpressions,
+    get_loop_expressions, count_operations,
 )
 
-OUT_FILE_NAME = "flux_correlation_function_fits.pyx"
-
-with open(OUT_FILE_NAME, "w") as out_file:
-    out_file.write("""# cython: embedsignature=True
+# The package with one extension module per combination of forms
+OUT_DIR = "flux_fit_kernels"
+HASH_FILE_NAME = os.path.join(OUT_DIR, "kernel_hashes.json")
+# The module that gathers the kernels from OUT_DIR
+DISPATCH_FILE_NAME = "flux_correlation_function_fits.py"
+# Modules to compile at once
+N_JOBS = os.cpu_count()
+# Build the loop kernels with OpenMP:
+# python make_correlation_function_fit_deriv.py --openmp build_ext
+OPENMP_BUILD = "--openmp" in sys.argv
+if OPENMP_BUILD:
+    sys.argv.remove("--openmp")
+# Turn on bounds checks, debug information, and the annotated HTML
+DEBUG_BUILD = "--debug" in sys.argv
+if DEBUG_BUILD:
+    sys.argv.remove("--debug")
+
+# The build options are part of the source, so changing them changes
+# the hashes
+DIRECTIVES = """# cython: embedsignature=True
 # cython: language_level=3str
 # cython: cdivision=True
-# cython: wraparound=False
-# cython: boundscheck=False
-# cython: gdb_debug=False
-from libc cimport math
+# cython: wraparound={debug!s:s}
+# cython: boundscheck={debug!s:s}
+""".format(debug=DEBUG_BUILD)
+if OPENMP_BUILD:
+    DIRECTIVES += """# distutils: extra_compile_args = -fopenmp
+# distutils: extra_link_args = -fopenmp
+"""
+
+HEADER = """from libc cimport math
+from cython.parallel cimport prange, threadid
 from cython.view cimport array as cvarray
 
 import numpy as np
 cimport numpy as np
-import numexpr as ne
 # from numpy cimport PyArray_Where as where
 
+from correlation_function_fits import (
+    get_numexpr_programs, get_numexpr_type, run_numexpr_programs,
+    substitute_constants,
+)
+from lag_grids import get_lag_grid
+
 ctypedef fused floating_type:
     np.float32_t
     np.float64_t
@@ -46,30 +87,66 @@ cdef extern from "<math.h>" nogil:
     float cosf(float x)
     float expf(float x)
 
-cdef inline floating_type cycos(floating_type x) nogil:
+cdef inline floating_type cycos(floating_type x) noexcept nogil:
     if floating_type is float:
         return cosf(x)
     elif floating_type is double:
         return math.cos(x)
 
-cdef inline floating_type cysin(floating_type x) nogil:
+cdef inline floating_type cysin(floating_type x) noexcept nogil:
     if floating_type is float:
         return sinf(x)
     elif floating_type is double:
         return math.sin(x)
 
-cdef inline floating_type cyexp(floating_type x) nogil:
+cdef inline floating_type cyexp(floating_type x) noexcept nogil:
     if floating_type is float:
         return expf(x)
     elif floating_type is double:
         return math.exp(x)
 
-cdef inline floating_type where(bint cond, floating_type a, floating_type b) nogil:
+cdef inline floating_type where(bint cond, floating_type a, floating_type b) noexcept nogil:
     if cond:
         return a
     return b
 
-ctypedef floating_type (*float_fun)(floating_type) nogil
+# noexcept, so calls in nogil blocks need not take the GIL to check
+# for errors
+ctypedef floating_type (*float_fun)(floating_type) noexcept nogil
+
+# The kernels run serially unless compiled with OpenMP
+cdef extern from *:
+    \"\"\"
+    #ifdef _OPENMP
+    #include <omp.h>
+    #else
+    static int omp_get_max_threads(void) { return 1; }
+    static void omp_set_num_threads(int num_threads) { (void) num_threads; }
+    #endif
+    \"\"\"
+    int omp_get_max_threads() noexcept nogil
+    void omp_set_num_threads(int num_threads) noexcept nogil
+
+
+def set_num_threads(int num_threads):
+    \"\"\"Set the number of threads the loop kernels use by default.
+
+    Worker processes should set this to one.  Does nothing unless the
+    module was built with OpenMP.
+    \"\"\"
+    if num_threads < 1:
+        raise ValueError("Need at least one thread")
+    omp_set_num_threads(num_threads)
+
+
+cdef inline int get_num_threads(int num_threads) noexcept nogil:
+    if num_threads > 0:
+        return num_threads
+    return omp_get_max_threads()
+
+# On evenly spaced lags, the loop kernels find each exponential from
+# the one at the lag before, recomputing it every ANCHOR_INTERVAL lags
+cdef long int ANCHOR_INTERVAL = 64
 
 cdef float HOURS_PER_DAY = 24.
 cdef float DAYS_PER_DAY = 1.
@@ -87,101 +164,223 @@ cdef float FOUR_PI_OVER_DAY = 2 * TWO_PI_OVER_DAY
 cdef float PI_OVER_YEAR = np.pi / DAYS_PER_YEAR
 cdef float TWO_PI_OVER_YEAR = 2 * PI_OVER_YEAR
 cdef float FOUR_PI_OVER_YEAR = 2 * TWO_PI_OVER_YEAR
+"""
 
-cdef dict GLOBAL_DICT = {
-    "HOURS_PER_DAY": HOURS_PER_DAY,
-    "DAYS_PER_DAY": DAYS_PER_DAY,
-    "DAYS_PER_WEEK": DAYS_PER_WEEK,
-    "DAYS_PER_FORTNIGHT": DAYS_PER_FORTNIGHT,
-    "DAYS_PER_YEAR": DAYS_PER_YEAR,
-    "DAYS_PER_DECADE": DAYS_PER_DECADE,
-    "PI_OVER_DAY": PI_OVER_DAY,
-    "TWO_PI_OVER_DAY": TWO_PI_OVER_DAY,
-    "FOUR_PI_OVER_DAY": FOUR_PI_OVER_DAY,
-    "PI_OVER_YEAR": PI_OVER_YEAR,
-    "TWO_PI_OVER_YEAR": TWO_PI_OVER_YEAR,
-    "FOUR_PI_OVER_YEAR": FOUR_PI_OVER_YEAR,
-}
-""")
-    for forms in itertools.product(PartForm, PartForm, PartForm):
-        if not is_valid_combination(*forms):
-            continue
-        print(forms)
-        out_file.write("""
-def {func_name:s}_fit_ne(parameters, tdata, empirical_correlogram, pair_count):
-    return ne.evaluate(
-        "{weighted_sum_expr:s}",
-        local_dict={{
-{param_names_from_parameters:s}
-            "tdata": tdata,
-            "empirical_correlogram": empirical_correlogram,
-            "num_pairs": pair_count,
-        }},
-        global_dict=GLOBAL_DICT,
-    )
-""".format(
-    func_name="_".join([
+os.makedirs(OUT_DIR, exist_ok=True)
+try:
+    with open(HASH_FILE_NAME) as hash_file:
+        OLD_HASHES = json.load(hash_file)
+except (IOError, ValueError):
+    OLD_HASHES = {}
+NEW_HASHES = {}
+
+for forms in itertools.product(PartForm, PartForm, PartForm):
+    if not is_valid_combination(*forms):
+        continue
+    # The derivatives are generated, so make sure they are right
+    # before compiling them
+    check_derivatives(*forms)
+    module_name = "_".join([
         "{0:s}{1:s}".format(
             part.get_short_name(),
             form.get_short_name(),
         )
         for part, form in zip(CorrelationPart, forms)
-    ]),
-    weighted_sum_expr=get_weighted_fit_expression(*forms),
-    param_names_from_parameters="".join([
-        "            \"{param_name:s}\": parameters[{i:d}],\n"
-        .format(i=i, param_name=param_name)
-        for i, param_name in enumerate(get_full_parameter_list(*forms))
     ])
+    out_file = io.StringIO()
+    out_file.write(DIRECTIVES)
+    out_file.write(HEADER)
+    func_name = module_name
+    param_names = get_full_parameter_list(*forms)
+    # The loop kernels work out each shared subexpression once per
+    # lag, and those without tdata once per call
+    loop_cse, loop_expressions = get_loop_expressions(*forms)
+    n_daily = len(forms[0].get_parameters(CorrelationPart.DAILY))
+    n_day_mod = len(forms[1].get_parameters(CorrelationPart.DAILY_MODULATION))
+    daily_derivs, day_mod_derivs, annual_derivs = (
+        ["({0:s})".format(piece) for piece in loop_cse.reduced[start:stop]]
+        for start, stop in (
+            (3, 3 + n_daily),
+            (3 + n_daily, 3 + n_daily + n_day_mod),
+            (3 + n_daily + n_day_mod, len(loop_cse.reduced)),
+        )
+    )
+    cse_names = [
+        name
+        for name, _ in loop_cse.basis + loop_cse.invariant + loop_cse.per_lag
+    ]
+    cse_declarations = (
+        "    cdef floating_type {0:s}\n".format(", ".join(cse_names))
+        if cse_names else ""
+    )
+    invariant_subexpressions = "".join(
+        "    {0:s} = {1:s}\n".format(name, value)
+        for name, value in loop_cse.invariant
+    )
+    # The functions of the lags alone come from the LagGrid
+    basis_lookups = "".join(
+        "                {0:s} = bases[{1:d}, i]\n".format(name, k)
+        for k, (name, _) in enumerate(loop_cse.basis)
+    )
+    per_lag_subexpressions = "".join(
+        "                {0:s} = {1:s}\n".format(name, value)
+        for name, value in loop_cse.per_lag
+    )
+    # The exponential decays, found by recurrence on evenly spaced lags
+    decay_names = [name for name, _ in loop_cse.decay] + [
+        "resid_decay", "ec_decay",
+    ]
+    decay_declarations = "    cdef floating_type {0:s}\n".format(", ".join(
+        name + suffix
+        for name in decay_names
+        for suffix in ("", "_rate", "_ratio")
+    ))
+    decay_rates = "".join(
+        "    {0:s}_rate = {1:s}\n".format(name, rate)
+        for name, rate in loop_cse.decay + [
+            ("resid_decay", "-1 / resid_timescale if resid_timescale > 0 else 0"),
+            ("ec_decay", "-1 / ec_timescale if ec_timescale > 0 else 0"),
+        ]
+    ) + "".join(
+        "    {0:s}_ratio = math.exp({0:s}_rate * spacing)\n".format(name)
+        for name in decay_names
+    )
+    anchor_decays = "".join(
+        "                    {0:s} = exp({0:s}_rate * tdata)\n".format(name)
+        for name in decay_names
+    )
+    step_decays = "".join(
+        "                    {0:s} = {0:s} * {0:s}_ratio\n".format(name)
+        for name in decay_names
+    )
+    # The numexpr programs work out the expensive subexpressions they
+    # share into arrays first
+    numexpr_cse = eliminate_common_subexpressions(
+        [get_full_expression(*forms)], only_expensive=True,
+        hoist_invariant=False,
+    )
+    numexpr_steps = "".join(
+        "        (\"{name:s}\", \"{expression:s}\"),\n".format(
+            name=name, expression=expression
+        )
+        for name, expression in numexpr_cse.per_lag
+    )
+    print(
+        "{0:s} operations (calls) per lag: loop kernels {1[0]:d} ({1[1]:d}) "
+        "-> {2[0]:d} ({2[1]:d}), numexpr {3[0]:d} ({3[1]:d}) "
+        "-> {4[0]:d} ({4[1]:d})".format(
+            module_name,
+            count_operations(loop_expressions),
+            count_operations(
+                [value for _, value in loop_cse.per_lag] + loop_cse.reduced
+            ),
+            count_operations([get_full_expression(*forms)]),
+            count_operations(
+                [value for _, value in numexpr_cse.per_lag] +
+                numexpr_cse.reduced
+            ),
+        )
+    )
+    out_file.write("""
+_{func_name:s}_FIT_PROGRAMS = get_numexpr_programs(
+    "sum(num_pairs * (empirical_correlogram - ({full_expr:s})) ** 2)",
+    ("tdata", "empirical_correlogram", "num_pairs"),
+    ({param_names:s}),
+    steps=(
+{steps:s}    ),
+)
+
+
+def {func_name:s}_fit_ne(parameters, tdata, empirical_correlogram, pair_count):
+    return run_numexpr_programs(
+        _{func_name:s}_FIT_PROGRAMS,
+        (tdata, empirical_correlogram, pair_count),
+        parameters,
+    )
+""".format(
+    func_name=func_name,
+    full_expr=numexpr_cse.reduced[0],
+    param_names="".join(
+        "\"{param_name:s}\", ".format(param_name=param_name)
+        for param_name in param_names
+    ),
+    steps=numexpr_steps,
 ))
 
-        out_file.write("""
+    out_file.write("""
+_{func_name:s}_CURVE_PROGRAMS = get_numexpr_programs(
+    "{full_expr:s}",
+    ("tdata",),
+    ({param_names:s}),
+    steps=(
+{steps:s}    ),
+)
+
+
 def {func_name:s}_curve_ne(
     tdata,
 {parameters:s}
+    out=None,
 ):
-    return ne.evaluate(
-        "{full_expr:s}",
-        local_dict={{
-{param_names_from_parameters:s}
-            "tdata": tdata
-        }},
-        global_dict=GLOBAL_DICT,
+    if out is None:
+        out = np.empty(len(tdata), dtype=get_numexpr_type(tdata))
+    return run_numexpr_programs(
+        _{func_name:s}_CURVE_PROGRAMS,
+        (tdata,),
+        (
+{arguments:s}        ),
+        out=out,
     )
 """.format(
-    func_name="_".join([
-        "{0:s}{1:s}".format(
-            part.get_short_name(),
-            form.get_short_name(),
-        )
-        for part, form in zip(CorrelationPart, forms)
-    ]),
-    param_names_from_parameters="".join([
-        "            \"{param_name:s}\": {param_name:s},\n"
-        .format(param_name=param_name)
-        for param_name in get_full_parameter_list(*forms)
-    ]),
+    func_name=func_name,
+    param_names="".join(
+        "\"{param_name:s}\", ".format(param_name=param_name)
+        for param_name in param_names
+    ),
     parameters="".join([
         "    {param:s},\n".format(param=param_name)
-        for param_name in get_full_parameter_list(*forms)
+        for param_name in param_names
     ]),
-    full_expr=get_full_expression(*forms)
+    arguments="".join([
+        "            {param:s},\n".format(param=param_name)
+        for param_name in param_names
+    ]),
+    full_expr=numexpr_cse.reduced[0],
+    steps=numexpr_steps,
 ))
 
-        out_file.write("""
-def {function_name:s}_fit_loop(
+    out_file.write("""
+def _{function_name:s}_fit_loop(
     np.float64_t[::1] parameters not None,
-    floating_type[::1] tdata_base not None,
-    floating_type[::1] empirical_correlogram not None,
-    floating_type[::1] pair_count not None,
+    const floating_type[::1] tdata_base not None,
+    const floating_type[:, ::1] bases not None,
+    np.float64_t spacing,
+    const floating_type[::1] empirical_correlogram not None,
+    const floating_type[::1] pair_count not None,
+    int num_threads=0,
 ):
     cdef floating_type weighted_fit = 0.0
-    cdef floating_type deriv[{n_parameters:d}]
-    cdef floating_type here_deriv[{n_parameters:d}]
     cdef long int n_parameters = {n_parameters:d}
+    cdef long int n_times = len(tdata_base)
+    cdef int n_threads = get_num_threads(num_threads)
+    if floating_type == np.float32_t:
+        typecode = "f"
+    elif floating_type == np.float64_t:
+        typecode = "d"
+    # Each thread accumulates its own gradient
+    cdef floating_type[:, ::1] thread_deriv = np.zeros(
+        (n_threads, n_parameters), dtype=typecode
+    )
+    cdef floating_type[:, ::1] thread_here_deriv = np.zeros(
+        (n_threads, n_parameters), dtype=typecode
+    )
+    cdef floating_type *deriv
+    cdef floating_type *here_deriv
 
 {params_from_parameters:s}
 
+    cdef long int n_blocks = (n_times + ANCHOR_INTERVAL - 1) // ANCHOR_INTERVAL
+    cdef long int block = 0, block_start = 0
     cdef long int i = 0, j = 0
 
     cdef floating_type tdata
@@ -189,53 +388,73 @@ def {function_name:s}_fit_loop(
     cdef floating_type ann_corr
     cdef floating_type resid_corr, ec_corr
     cdef floating_type here_corr
-    cdef floating_type deriv_common
+{cse_declarations:s}{decay_declarations:s}    cdef floating_type deriv_common
 
-    cdef float_fun exp = cyexp
-    cdef float_fun cos = cycos
-    cdef float_fun sin = cysin
+    cdef float_fun exp, cos, sin
 
     resid_timescale *= DAYS_PER_FORTNIGHT
     ec_timescale /= HOURS_PER_DAY
-
-    for j in range(n_parameters):
-        deriv[j] = 0.0
-
-    for i in range(len(tdata_base)):
-        tdata = tdata_base[i]
-        here_corr = 0.0
-
-        daily_corr = {daily_form:s}
-        dm_corr = {daily_modulation_form:s}
-        here_corr += daily_corr * dm_corr
-        {accum_day_deriv:s}
-        {accum_dm_deriv:s}
-
-        ann_corr = {annual_form:s}
-        here_corr += ann_corr
-        {accum_ann_deriv:s}
-
-        if resid_timescale > 0:
-            resid_corr = resid_coef * exp(-tdata / resid_timescale)
-            here_corr += resid_corr
-            here_deriv[n_parameters - 4] = exp(-tdata / resid_timescale)
-            here_deriv[n_parameters - 3] = resid_corr * tdata / resid_timescale ** 2
-
-        if ec_timescale > 0:
-            ec_corr = ec_coef * exp(-tdata / ec_timescale)
-            here_corr += ec_corr
-            here_deriv[n_parameters - 2] = exp(-tdata / ec_timescale)
-            here_deriv[n_parameters - 1] = ec_corr * tdata / ec_timescale ** 2
-
-        weighted_fit += pair_count[i] * (here_corr - empirical_correlogram[i]) ** 2
-        deriv_common = pair_count[i] * 2 * (here_corr - empirical_correlogram[i])
-        for j in range(n_parameters):
-            deriv[j] += deriv_common * here_deriv[j]
-
-    deriv[n_parameters - 3] *= DAYS_PER_FORTNIGHT
-    deriv[n_parameters - 1] /= HOURS_PER_DAY
-
-    return weighted_fit, np.asarray(<floating_type[:n_parameters]>deriv).astype(np.float64)
+{invariant_subexpressions:s}{decay_rates:s}
+    with nogil:
+        for block in prange(n_blocks, num_threads=n_threads, schedule="static"):
+            # Set in the loop, so the compiler sees the calls are to
+            # the inline functions and not through shared pointers
+            exp = cyexp
+            cos = cycos
+            sin = cysin
+            deriv = &thread_deriv[threadid(), 0]
+            here_deriv = &thread_here_deriv[threadid(), 0]
+            block_start = block * ANCHOR_INTERVAL
+            for i in range(
+                    block_start, min(block_start + ANCHOR_INTERVAL, n_times)
+            ):
+                tdata = tdata_base[i]
+                # Found from the lag before on evenly spaced lags, and
+                # recomputed at the start of each block so float32
+                # rounding does not build up
+                if spacing == 0 or i == block_start:
+{anchor_decays:s}                else:
+{step_decays:s}
+{basis_lookups:s}{per_lag_subexpressions:s}                daily_corr = {daily_form:s}
+                dm_corr = {daily_modulation_form:s}
+                {accum_day_deriv:s}
+                {accum_dm_deriv:s}
+
+                ann_corr = {annual_form:s}
+                {accum_ann_deriv:s}
+
+                # Assigned rather than incremented, so prange keeps them
+                # private to each thread instead of making them reductions
+                here_corr = daily_corr * dm_corr + ann_corr
+
+                if resid_timescale > 0:
+                    resid_corr = resid_coef * resid_decay
+                    here_corr = here_corr + resid_corr
+                    here_deriv[n_parameters - 4] = resid_decay
+                    here_deriv[n_parameters - 3] = resid_corr * tdata / resid_timescale ** 2
+                else:
+                    here_deriv[n_parameters - 4] = 0.0
+                    here_deriv[n_parameters - 3] = 0.0
+
+                if ec_timescale > 0:
+                    ec_corr = ec_coef * ec_decay
+                    here_corr = here_corr + ec_corr
+                    here_deriv[n_parameters - 2] = ec_decay
+                    here_deriv[n_parameters - 1] = ec_corr * tdata / ec_timescale ** 2
+                else:
+                    here_deriv[n_parameters - 2] = 0.0
+                    here_deriv[n_parameters - 1] = 0.0
+
+                weighted_fit += pair_count[i] * (here_corr - empirical_correlogram[i]) ** 2
+                deriv_common = pair_count[i] * 2 * (here_corr - empirical_correlogram[i])
+                for j in range(n_parameters):
+                    deriv[j] += deriv_common * here_deriv[j]
+
+    total_deriv = np.asarray(thread_deriv).sum(axis=0, dtype=np.float64)
+    total_deriv[n_parameters - 3] *= DAYS_PER_FORTNIGHT
+    total_deriv[n_parameters - 1] /= HOURS_PER_DAY
+
+    return weighted_fit, total_deriv
 """.format(
     function_name="_".join([
         "{0:s}{1:s}".format(
@@ -250,47 +469,53 @@ def {function_name:s}_fit_loop(
         .format(i=i, param_name=param_name)
         for i, param_name in enumerate(get_full_parameter_list(*forms))
     ]),
-    daily_form=forms[0].get_expression(CorrelationPart.DAILY),
-    daily_modulation_form=forms[1].get_expression(
-        CorrelationPart.DAILY_MODULATION
-    ),
-    annual_form=forms[2].get_expression(CorrelationPart.ANNUAL),
-    accum_day_deriv="\n        ".join(
+    cse_declarations=cse_declarations,
+    decay_declarations=decay_declarations,
+    invariant_subexpressions=invariant_subexpressions,
+    decay_rates=decay_rates,
+    anchor_decays=anchor_decays,
+    step_decays=step_decays,
+    basis_lookups=basis_lookups,
+    per_lag_subexpressions=per_lag_subexpressions,
+    daily_form=loop_cse.reduced[0],
+    daily_modulation_form=loop_cse.reduced[1],
+    annual_form=loop_cse.reduced[2],
+    accum_day_deriv="\n                ".join(
         "here_deriv[{i:d}] = {deriv_piece:s} * dm_corr".format(
             i=i, deriv_piece=deriv_piece
         )
         for i, deriv_piece in enumerate(
-                forms[0].get_derivative(CorrelationPart.DAILY)
+                daily_derivs
         )
     ),
-    accum_dm_deriv="\n        ".join(
+    accum_dm_deriv="\n                ".join(
         "here_deriv[{i:d}] = daily_corr * {deriv_piece:s}".format(
             i=i, deriv_piece=deriv_piece
         )
         for i, deriv_piece in enumerate(
-                forms[1].get_derivative(CorrelationPart.DAILY_MODULATION),
-                len(forms[0].get_parameters(CorrelationPart.DAILY))
+                day_mod_derivs, n_daily
         )
     ),
-    accum_ann_deriv="\n        ".join(
+    accum_ann_deriv="\n                ".join(
         "here_deriv[{i:d}] = {deriv_piece:s}".format(
             i=i, deriv_piece=deriv_piece
         )
         for i, deriv_piece in enumerate(
-                forms[2].get_derivative(CorrelationPart.ANNUAL),
-                len(forms[0].get_parameters(CorrelationPart.DAILY)) +
-                len(forms[1].get_parameters(CorrelationPart.DAILY_MODULATION))
+                annual_derivs, n_daily + n_day_mod
         )
     ),
 ))
 
-        out_file.write("""
-def {function_name:s}_curve_loop(
-    floating_type[::1] tdata_base not None,
+    out_file.write("""
+def _{function_name:s}_curve_loop(
+    const floating_type[::1] tdata_base not None,
+    const floating_type[:, ::1] bases not None,
+    np.float64_t spacing,
 {parameters:s}
+    int num_threads=0,
 ):
-    cdef floating_type weighted_fit = 0.0
     cdef long int n_times = len(tdata_base)
+    cdef int n_threads = get_num_threads(num_threads)
     if floating_type == np.float32_t:
         typecode = "f"
     elif floating_type == np.float64_t:
@@ -307,49 +532,69 @@ def {function_name:s}_curve_loop(
     )
     cdef long int n_parameters = {n_parameters:d}
 
-    cdef long int i = 0, j = 0
+    cdef long int n_blocks = (n_times + ANCHOR_INTERVAL - 1) // ANCHOR_INTERVAL
+    cdef long int block = 0, block_start = 0
+    cdef long int i = 0
 
     cdef floating_type tdata
     cdef floating_type daily_corr, dm_corr
     cdef floating_type ann_corr
     cdef floating_type resid_corr, ec_corr
     cdef floating_type here_corr
-    cdef floating_type deriv_common
-
-    cdef float_fun exp = cyexp
-    cdef float_fun cos = cycos
-    cdef float_fun sin = cysin
+{cse_declarations:s}{decay_declarations:s}
+    cdef float_fun exp, cos, sin
 
     resid_timescale *= DAYS_PER_FORTNIGHT
     ec_timescale /= HOURS_PER_DAY
-
-    for i in range(n_times):
-        tdata = tdata_base[i]
-        here_corr = 0.0
-
-        daily_corr = {daily_form:s}
-        dm_corr = {daily_modulation_form:s}
-        here_corr += daily_corr * dm_corr
-        {accum_day_deriv:s}
-        {accum_dm_deriv:s}
-
-        ann_corr = {annual_form:s}
-        here_corr += ann_corr
-        {accum_ann_deriv:s}
-
-        if resid_timescale > 0:
-            resid_corr = resid_coef * exp(-tdata / resid_timescale)
-            here_corr += resid_corr
-            deriv[i, n_parameters - 4] = exp(-tdata / resid_timescale)
-            deriv[i, n_parameters - 3] = resid_corr * tdata / resid_timescale ** 2 * DAYS_PER_FORTNIGHT
-
-        if ec_timescale > 0:
-            ec_corr = ec_coef * exp(-tdata / ec_timescale)
-            here_corr += ec_corr
-            deriv[i, n_parameters - 2] = exp(-tdata / ec_timescale)
-            deriv[i, n_parameters - 1] = ec_corr * tdata / ec_timescale ** 2 / HOURS_PER_DAY
-
-        curve[i] = here_corr
+{invariant_subexpressions:s}{decay_rates:s}
+    # Each lag has its own row, so the threads need not share anything
+    with nogil:
+        for block in prange(n_blocks, num_threads=n_threads, schedule="static"):
+            # Set in the loop, so the compiler sees the calls are to
+            # the inline functions and not through shared pointers
+            exp = cyexp
+            cos = cycos
+            sin = cysin
+            block_start = block * ANCHOR_INTERVAL
+            for i in range(
+                    block_start, min(block_start + ANCHOR_INTERVAL, n_times)
+            ):
+                tdata = tdata_base[i]
+                # Found from the lag before on evenly spaced lags, and
+                # recomputed at the start of each block so float32
+                # rounding does not build up
+                if spacing == 0 or i == block_start:
+{anchor_decays:s}                else:
+{step_decays:s}
+{basis_lookups:s}{per_lag_subexpressions:s}                daily_corr = {daily_form:s}
+                dm_corr = {daily_modulation_form:s}
+                {accum_day_deriv:s}
+                {accum_dm_deriv:s}
+
+                ann_corr = {annual_form:s}
+                {accum_ann_deriv:s}
+
+                here_corr = daily_corr * dm_corr + ann_corr
+
+                if resid_timescale > 0:
+                    resid_corr = resid_coef * resid_decay
+                    here_corr = here_corr + resid_corr
+                    deriv[i, n_parameters - 4] = resid_decay
+                    deriv[i, n_parameters - 3] = resid_corr * tdata / resid_timescale ** 2 * DAYS_PER_FORTNIGHT
+                else:
+                    deriv[i, n_parameters - 4] = 0.0
+                    deriv[i, n_parameters - 3] = 0.0
+
+                if ec_timescale > 0:
+                    ec_corr = ec_coef * ec_decay
+                    here_corr = here_corr + ec_corr
+                    deriv[i, n_parameters - 2] = ec_decay
+                    deriv[i, n_parameters - 1] = ec_corr * tdata / ec_timescale ** 2 / HOURS_PER_DAY
+                else:
+                    deriv[i, n_parameters - 2] = 0.0
+                    deriv[i, n_parameters - 1] = 0.0
+
+                curve[i] = here_corr
 
     return (
         np.asarray(curve),
@@ -369,64 +614,388 @@ def {function_name:s}_curve_loop(
         .format(i=i, param_name=param_name)
         for i, param_name in enumerate(get_full_parameter_list(*forms))
     ]),
-    daily_form=forms[0].get_expression(CorrelationPart.DAILY),
-    daily_modulation_form=forms[1].get_expression(
-        CorrelationPart.DAILY_MODULATION
-    ),
-    annual_form=forms[2].get_expression(CorrelationPart.ANNUAL),
-    accum_day_deriv="\n        ".join(
+    cse_declarations=cse_declarations,
+    decay_declarations=decay_declarations,
+    invariant_subexpressions=invariant_subexpressions,
+    decay_rates=decay_rates,
+    anchor_decays=anchor_decays,
+    step_decays=step_decays,
+    basis_lookups=basis_lookups,
+    per_lag_subexpressions=per_lag_subexpressions,
+    daily_form=loop_cse.reduced[0],
+    daily_modulation_form=loop_cse.reduced[1],
+    annual_form=loop_cse.reduced[2],
+    accum_day_deriv="\n                ".join(
         "deriv[i, {j:d}] = {deriv_piece:s} * dm_corr".format(
             j=j, deriv_piece=deriv_piece
         )
         for j, deriv_piece in enumerate(
-                forms[0].get_derivative(CorrelationPart.DAILY)
+                daily_derivs
         )
     ),
-    accum_dm_deriv="\n        ".join(
+    accum_dm_deriv="\n                ".join(
         "deriv[i, {j:d}] = daily_corr * {deriv_piece:s}".format(
             j=j, deriv_piece=deriv_piece
         )
         for j, deriv_piece in enumerate(
-                forms[1].get_derivative(CorrelationPart.DAILY_MODULATION),
-                len(forms[0].get_parameters(CorrelationPart.DAILY))
+                day_mod_derivs, n_daily
         )
     ),
-    accum_ann_deriv="\n        ".join(
+    accum_ann_deriv="\n                ".join(
         "deriv[i, {j:d}] = {deriv_piece:s}".format(
             j=j, deriv_piece=deriv_piece
         )
         for j, deriv_piece in enumerate(
-                forms[2].get_derivative(CorrelationPart.ANNUAL),
-                len(forms[0].get_parameters(CorrelationPart.DAILY)) +
-                len(forms[1].get_parameters(CorrelationPart.DAILY_MODULATION))
+                annual_derivs, n_daily + n_day_mod
         )
     ),
 ))
 
+    out_file.write("""
+def _{function_name:s}_normal_loop(
+    np.float64_t[::1] parameters not None,
+    const floating_type[::1] tdata_base not None,
+    const floating_type[:, ::1] bases not None,
+    np.float64_t spacing,
+    const floating_type[::1] empirical_correlogram not None,
+    const floating_type[::1] pair_count not None,
+    int num_threads=0,
+):
+    cdef np.float64_t weighted_fit = 0.0
+    cdef long int n_parameters = {n_parameters:d}
+    cdef long int n_times = len(tdata_base)
+    cdef int n_threads = get_num_threads(num_threads)
+    if floating_type == np.float32_t:
+        typecode = "f"
+    elif floating_type == np.float64_t:
+        typecode = "d"
+    # Each thread accumulates its own sums
+    cdef np.float64_t[:, ::1] thread_gradient = np.zeros(
+        (n_threads, n_parameters)
+    )
+    cdef np.float64_t[:, ::1] thread_normal_matrix = np.zeros(
+        (n_threads, n_parameters * n_parameters)
+    )
+    cdef floating_type[:, ::1] thread_here_deriv = np.zeros(
+        (n_threads, n_parameters), dtype=typecode
+    )
+    cdef np.float64_t *gradient
+    cdef np.float64_t *normal_matrix
+    cdef floating_type *here_deriv
+
+{params_from_parameters:s}
+
+    cdef long int n_blocks = (n_times + ANCHOR_INTERVAL - 1) // ANCHOR_INTERVAL
+    cdef long int block = 0, block_start = 0
+    cdef long int i = 0, j = 0, k = 0
+
+    cdef floating_type tdata
+    cdef floating_type daily_corr, dm_corr
+    cdef floating_type ann_corr
+    cdef floating_type resid_corr, ec_corr
+    cdef floating_type here_corr
+{cse_declarations:s}{decay_declarations:s}    cdef np.float64_t weight, weighted_resid, weighted_deriv
+
+    cdef float_fun exp, cos, sin
+
+    if (
+            len(empirical_correlogram) != n_times or
+            len(pair_count) != n_times
+    ):
+        raise ValueError("Need one correlogram value and pair count per lag")
+
+    resid_timescale *= DAYS_PER_FORTNIGHT
+    ec_timescale /= HOURS_PER_DAY
+{invariant_subexpressions:s}{decay_rates:s}
+    with nogil:
+        for block in prange(n_blocks, num_threads=n_threads, schedule="static"):
+            # Set in the loop, so the compiler sees the calls are to
+            # the inline functions and not through shared pointers
+            exp = cyexp
+            cos = cycos
+            sin = cysin
+            gradient = &thread_gradient[threadid(), 0]
+            normal_matrix = &thread_normal_matrix[threadid(), 0]
+            here_deriv = &thread_here_deriv[threadid(), 0]
+            block_start = block * ANCHOR_INTERVAL
+            for i in range(
+                    block_start, min(block_start + ANCHOR_INTERVAL, n_times)
+            ):
+                tdata = tdata_base[i]
+                # Found from the lag before on evenly spaced lags, and
+                # recomputed at the start of each block so float32
+                # rounding does not build up
+                if spacing == 0 or i == block_start:
+{anchor_decays:s}                else:
+{step_decays:s}
+                weight = pair_count[i]
+                if weight == 0:
+                    continue
+
+{basis_lookups:s}{per_lag_subexpressions:s}                daily_corr = {daily_form:s}
+                dm_corr = {daily_modulation_form:s}
+                {accum_day_deriv:s}
+                {accum_dm_deriv:s}
+
+                ann_corr = {annual_form:s}
+                {accum_ann_deriv:s}
+
+                here_corr = daily_corr * dm_corr + ann_corr
+
+                if resid_timescale > 0:
+                    resid_corr = resid_coef * resid_decay
+                    here_corr = here_corr + resid_corr
+                    here_deriv[n_parameters - 4] = resid_decay
+                    here_deriv[n_parameters - 3] = resid_corr * tdata / resid_timescale ** 2 * DAYS_PER_FORTNIGHT
+                else:
+                    here_deriv[n_parameters - 4] = 0.0
+                    here_deriv[n_parameters - 3] = 0.0
+
+                if ec_timescale > 0:
+                    ec_corr = ec_coef * ec_decay
+                    here_corr = here_corr + ec_corr
+                    here_deriv[n_parameters - 2] = ec_decay
+                    here_deriv[n_parameters - 1] = ec_corr * tdata / ec_timescale ** 2 / HOURS_PER_DAY
+                else:
+                    here_deriv[n_parameters - 2] = 0.0
+                    here_deriv[n_parameters - 1] = 0.0
+
+                weighted_resid = weight * (here_corr - empirical_correlogram[i])
+                weighted_fit += weighted_resid * (here_corr - empirical_correlogram[i])
+                for j in range(n_parameters):
+                    weighted_deriv = weight * here_deriv[j]
+                    gradient[j] += weighted_resid * here_deriv[j]
+                    for k in range(j, n_parameters):
+                        normal_matrix[j * n_parameters + k] += weighted_deriv * here_deriv[k]
+
+    total_normal_matrix = np.asarray(thread_normal_matrix).sum(axis=0).reshape(
+        n_parameters, n_parameters
+    )
+    total_normal_matrix = (
+        np.triu(total_normal_matrix) + np.triu(total_normal_matrix, 1).T
+    )
+    return (
+        weighted_fit,
+        np.asarray(thread_gradient).sum(axis=0),
+        total_normal_matrix,
+    )
+""".format(
+    function_name="_".join([
+        "{0:s}{1:s}".format(
+            part.get_short_name(),
+            form.get_short_name(),
+        )
+        for part, form in zip(CorrelationPart, forms)
+    ]),
+    n_parameters=len(get_full_parameter_list(*forms)),
+    params_from_parameters="".join([
+        "    cdef floating_type {param_name:s} = parameters[{i:d}]\n"
+        .format(i=i, param_name=param_name)
+        for i, param_name in enumerate(get_full_parameter_list(*forms))
+    ]),
+    cse_declarations=cse_declarations,
+    decay_declarations=decay_declarations,
+    invariant_subexpressions=invariant_subexpressions,
+    decay_rates=decay_rates,
+    anchor_decays=anchor_decays,
+    step_decays=step_decays,
+    basis_lookups=basis_lookups,
+    per_lag_subexpressions=per_lag_subexpressions,
+    daily_form=loop_cse.reduced[0],
+    daily_modulation_form=loop_cse.reduced[1],
+    annual_form=loop_cse.reduced[2],
+    accum_day_deriv="\n                ".join(
+        "here_deriv[{j:d}] = {deriv_piece:s} * dm_corr".format(
+            j=j, deriv_piece=deriv_piece
+        )
+        for j, deriv_piece in enumerate(
+                daily_derivs
+        )
+    ),
+    accum_dm_deriv="\n                ".join(
+        "here_deriv[{j:d}] = daily_corr * {deriv_piece:s}".format(
+            j=j, deriv_piece=deriv_piece
+        )
+        for j, deriv_piece in enumerate(
+                day_mod_derivs, n_daily
+        )
+    ),
+    accum_ann_deriv="\n                ".join(
+        "here_deriv[{j:d}] = {deriv_piece:s}".format(
+            j=j, deriv_piece=deriv_piece
+        )
+        for j, deriv_piece in enumerate(
+                annual_derivs, n_daily + n_day_mod
+        )
+    ),
+))
+
+    out_file.write("""
+# The functions of the lags the loop kernels look up
+_{function_name:s}_BASES = tuple(substitute_constants(basis) for basis in (
+{bases:s}))
+
+
+def {function_name:s}_fit_loop(
+    parameters,
+    lags,
+    empirical_correlogram,
+    pair_count,
+    int num_threads=0,
+):
+    \"\"\"Find the weighted SSE and its gradient.
+
+    lags may be a LagGrid, and the correlogram and pair counts must
+    have the same type as its lags.
+    \"\"\"
+    grid = get_lag_grid(lags)
+    return _{function_name:s}_fit_loop(
+        parameters,
+        grid.lags,
+        grid.get_bases(_{function_name:s}_BASES),
+        grid.spacing,
+        empirical_correlogram,
+        pair_count,
+        num_threads,
+    )
+
+
+def {function_name:s}_curve_loop(
+    lags,
+{parameters:s}
+    int num_threads=0,
+):
+    \"\"\"Find the curve and its Jacobian.
+
+    lags may be a LagGrid.
+    \"\"\"
+    grid = get_lag_grid(lags)
+    return _{function_name:s}_curve_loop(
+        grid.lags,
+        grid.get_bases(_{function_name:s}_BASES),
+        grid.spacing,
+{arguments:s}        num_threads,
+    )
+
+
+def {function_name:s}_normal_loop(
+    parameters,
+    lags,
+    empirical_correlogram,
+    pair_count,
+    int num_threads=0,
+):
+    \"\"\"Find the weighted SSE, J^T W r, and J^T W J in one pass.
+
+    Only the O(n_parameters ** 2) sums are kept, never the Jacobian.
+    lags may be a LagGrid, and the correlogram and pair counts must
+    have the same type as its lags.
+    \"\"\"
+    grid = get_lag_grid(lags)
+    return _{function_name:s}_normal_loop(
+        parameters,
+        grid.lags,
+        grid.get_bases(_{function_name:s}_BASES),
+        grid.spacing,
+        empirical_correlogram,
+        pair_count,
+        num_threads,
+    )
+""".format(
+    function_name=func_name,
+    bases="".join(
+        "    \"{0:s}\",\n".format(basis) for _, basis in loop_cse.basis
+    ),
+    parameters="".join(
+        "    {param_name:s},\n".format(param_name=param_name)
+        for param_name in param_names
+    ),
+    arguments="".join(
+        "        {param_name:s},\n".format(param_name=param_name)
+        for param_name in param_names
+    ),
+))
+
+    source = out_file.getvalue()
+    NEW_HASHES[module_name] = hashlib.sha256(source.encode("utf8")).hexdigest()
+    pyx_name = os.path.join(OUT_DIR, module_name + ".pyx")
+    if (
+            NEW_HASHES[module_name] != OLD_HASHES.get(module_name) or
+            not os.path.exists(pyx_name)
+    ):
+        print("Writing", pyx_name, forms)
+        with open(pyx_name, "w") as pyx_file:
+            pyx_file.write(source)
+
+with open(HASH_FILE_NAME, "w") as hash_file:
+    json.dump(NEW_HASHES, hash_file, indent=0, sort_keys=True)
+
+with open(os.path.join(OUT_DIR, "__init__.py"), "w") as init_file:
+    init_file.write(
+        '"""The kernels for each combination of forms.\n\n'
+        'Written by make_correlation_function_fit_deriv.py.\n"""\n'
+    )
+
+with open(DISPATCH_FILE_NAME, "w") as dispatch_file:
+    dispatch_file.write(
+        '"""Gather the kernels for each combination of forms.\n\n'
+        'Written by make_correlation_function_fit_deriv.py.\n"""\n'
+        "from {package:s}.{module_name:s} import set_num_threads\n"
+        .format(package=OUT_DIR, module_name=min(NEW_HASHES))
+    )
+    for module_name in sorted(NEW_HASHES):
+        dispatch_file.write(
+            "from {package:s}.{module_name:s} import (\n"
+            "{kernels:s}"
+            ")\n".format(
+                package=OUT_DIR,
+                module_name=module_name,
+                kernels="".join(
+                    "    {module_name:s}_{kind:s},\n".format(
+                        module_name=module_name, kind=kind
+                    )
+                    for kind in (
+                        "fit_ne", "curve_ne", "fit_loop", "curve_loop",
+                        "normal_loop",
+                    )
+                ),
+            )
+        )
+
+# The single extension this script used to build would hide the
+# dispatch module
+for old_build in glob.glob("flux_correlation_function_fits.*"):
+    if old_build != DISPATCH_FILE_NAME:
+        os.remove(old_build)
+
 
 ############################################################
-# Now build the module
+# Now build the modules
 setup(
     name="co2_flux_correlation_analysis",
     author="DWesl",
     version="0.0.0.dev0",
-    py_modules=["correlation_function_fits"],
+    py_modules=[
+        "correlation_function_fits", "flux_correlation_function_fits",
+        "lag_grids",
+    ],
+    packages=[OUT_DIR],
     ext_modules=cythonize(
         [
             Extension(
-                OUT_FILE_NAME.replace(".pyx", ""),
-                [OUT_FILE_NAME],
+                "{package:s}.{module_name:s}".format(
+                    package=OUT_DIR, module_name=module_name
+                ),
+                [os.path.join(OUT_DIR, module_name + ".pyx")],
                 include_dirs=[np.get_include()],
-            ),
+            )
+            for module_name in sorted(NEW_HASHES)
         ],
         include_path=[np.get_include()],
-        compiler_directives=dict(
-            embedsignature=True,
-            cdivision=True,
-            wraparound=True,
-            boundscheck=True,
-        ),
-        annotate=True,
-        gdb_debug=True,
+        nthreads=N_JOBS,
+        annotate=DEBUG_BUILD,
+        gdb_debug=DEBUG_BUILD,
     ),
+    # Unchanged modules are older than their builds and are skipped
+    options={"build_ext": {"parallel": N_JOBS}},
 )
@@ -18,7 +18,6 @@ import scipy.optimize
 import pyproj
 import cartopy.crs as ccrs
 import xarray
-from statsmodels.tsa.stattools import acovf, acf
 from statsmodels.tools.eval_measures import aic, aicc, bic, hqic
 from bottleneck import nansum
 # import pymc3 as pm
@@ -28,7 +27,11 @@ from correlation_function_fits import (
     CorrelationPart, PartForm,
     is_valid_combination, get_full_parameter_list
 )
-from correlation_utils import count_pairs
+from correlation_utils import get_autocorrelation_stats_batched
+from cross_correlation_utils import write_cross_correlation_store
+from calendar_correlation_utils import get_calendar_autocorrelation_arrays
+from gaussian_likelihood import gaussian_log_likelihood
+from variogram_utils import get_variograms
 import flux_correlation_function_fits
 
 MINUTES_PER_HOUR = 60
@@ -589,25 +592,41 @@ plt.close(fig)
 ############################################################
 # Find temporal autocorrelations, autocovariances, and pairs per lag.
 acovf_index = pd.timedelta_range(start=0, freq="1H", periods=24 * 365 * 8)
-acovf_data = pd.DataFrame(index=acovf_index)
-acf_data = pd.DataFrame(index=acovf_index)
+# All towers at once, from a single batched FFT.  The batched version
+# assumes regular spacing, so put the differences on an hourly grid.
+difference_df_hourly = difference_df_rect.resample("1H").mean()
+acf_arrays = get_autocorrelation_stats_batched(
+    difference_df_hourly.values.T.astype(np.float32),
+    max_lag=len(acovf_index) - 1,
+)
+n_acf_lags = acf_arrays.acf.shape[1]
+# acovf(..., missing="conservative") defaults to the biased estimator,
+# which divides by the number of observations rather than the number
+# of pairs at each lag.
+acovf_biased = (
+    acf_arrays.acovf * np.maximum(acf_arrays.pair_counts, 1) /
+    np.maximum(acf_arrays.pair_counts[:, :1], 1)
+)
+towers_with_data = acf_arrays.pair_counts[:, 0] > 0
+acovf_data = pd.DataFrame(
+    acovf_biased[towers_with_data].T,
+    index=acovf_index[:n_acf_lags],
+    columns=difference_df_hourly.columns[towers_with_data],
+).reindex(acovf_index)
+acf_data = pd.DataFrame(
+    acf_arrays.acf[towers_with_data].T,
+    index=acovf_index[:n_acf_lags],
+    columns=difference_df_hourly.columns[towers_with_data],
+).reindex(acovf_index)
 # acf_width = pd.DataFrame(index=acovf_index)
-pair_counts = pd.DataFrame(index=acovf_index)
-
-for column in difference_df_rect.columns:
-    col_data = difference_df_rect.loc[:, column].dropna()
-    if col_data.shape[0] == 0:
-        continue
-    col_data = col_data.resample("1H").mean()
-    acovf_col = acovf(col_data, missing="conservative")
-    nlags = len(acovf_col)
-    acovf_data.loc[acovf_index[:nlags], column] = acovf_col
-    acf_col = acf(col_data, missing="conservative", nlags=nlags, unbiased=True)
-    acf_data.loc[acovf_index[:nlags], column] = acf_col
-    # varacf = np.ones(nlags + 1) / col_data.count()
-    # np.ones(acf_data.shape) / acf_data.count()[np.newaxis, :] * (1 + 2 * acf_data.cumsum() ** 2)
-    # acf_width.loc[acovf_index[:nlags], column] = confint[:, 1] - confint[:, 0]
-    pair_counts.loc[acovf_index[:nlags], column] = count_pairs(col_data)[:nlags]
+pair_counts = pd.DataFrame(
+    acf_arrays.pair_counts[towers_with_data].T,
+    index=acovf_index[:n_acf_lags],
+    columns=difference_df_hourly.columns[towers_with_data],
+).reindex(acovf_index).where(acf_data.notna())
+# varacf = np.ones(nlags + 1) / col_data.count()
+# np.ones(acf_data.shape) / acf_data.count()[np.newaxis, :] * (1 + 2 * acf_data.cumsum() ** 2)
+# acf_width.loc[acovf_index[:nlags], column] = confint[:, 1] - confint[:, 0]
 
 to_fit = acf_data.loc[~acf_data.isna().all(axis=1), :]
 time_in_days = to_fit.index.values.astype("m8[h]").astype(np.int64) / 24
@@ -616,6 +635,67 @@ acf_data.to_csv("ameriflux-minus-casa-hour-towers-autocorrelation-functions.csv"
 pair_counts.to_csv("ameriflux-minus-casa-hour-towers-pair-counts.csv")
 acovf_data.to_csv("ameriflux-minus-casa-hour-towers-autocovariance-functions.csv")
 
+############################################################
+# Find lagged cross-correlations between every pair of towers.
+# difference_df_rect.corr() above only covers lag zero.
+write_cross_correlation_store(
+    difference_df_hourly.values.T.astype(np.float32),
+    "ameriflux-minus-casa-hour-towers-cross-correlation-functions.nc4",
+    site_names=list(difference_df_hourly.columns),
+    max_lag=len(acovf_index) - 1,
+)
+
+############################################################
+# Find autocorrelations conditioned on the month and hour of the
+# first point, to see how the daily cycle of the correlations changes
+# with season.  Only the first few weeks of lags are needed for that.
+CALENDAR_ACF_MAX_LAG = 24 * 7 * 6
+calendar_acf_arrays = get_calendar_autocorrelation_arrays(
+    difference_df_hourly.values.T.astype(np.float32),
+    difference_df_hourly.index,
+    max_lag=CALENDAR_ACF_MAX_LAG,
+)
+calendar_acf_coords = dict(
+    site=difference_df_hourly.columns.values,
+    month=np.arange(1, 13),
+    hour=np.arange(24),
+    time_lag=acovf_index[:calendar_acf_arrays.acf.shape[-1]],
+)
+calendar_acf_dims = ("site", "month", "hour", "time_lag")
+xarray.Dataset(
+    dict(
+        flux_error_autocorrelation=(
+            calendar_acf_dims, calendar_acf_arrays.acf,
+            dict(long_name="ameriflux_minus_casa_surface_upward_carbon_"
+                 "dioxide_flux_difference_autocorrelation_by_month_"
+                 "and_hour_of_first_point",
+                 units="1"),
+        ),
+        flux_error_autocovariance=(
+            calendar_acf_dims, calendar_acf_arrays.acovf,
+            dict(long_name="ameriflux_minus_casa_surface_upward_carbon_"
+                 "dioxide_flux_difference_autocovariance_by_month_"
+                 "and_hour_of_first_point",
+                 units="(umol/m2/s)^2"),
+        ),
+        flux_error_n_pairs=(
+            calendar_acf_dims, calendar_acf_arrays.pair_counts,
+            dict(long_name="ameriflux_minus_casa_surface_upward_carbon_"
+                 "dioxide_flux_difference_number_of_pairs_at_lag",
+                 units="1"),
+        ),
+    ),
+    calendar_acf_coords,
+).to_netcdf(
+    "ameriflux-minus-casa-hour-towers-calendar-autocorrelation-functions.nc4",
+    encoding={
+        name: {"zlib": True, "_FillValue": -9999}
+        for name in ("flux_error_autocorrelation",
+                     "flux_error_autocovariance",
+                     "flux_error_n_pairs")
+    },
+)
+
 # corr_to_fit, time_in_days = np.broadcast_arrays(to_fit.values, time_in_days[:, newaxis])
 # not_nan = np.isfinite(corr_to_fit)
 # corr_to_fit = corr_to_fit[not_nan]
@@ -1056,8 +1136,14 @@ IC_DATA = pd.DataFrame(
         names=["Site", "Correlation function"]
     )
 )
-SAMPLE_SIZE = 2000
-MVN_LOGPDF = scipy.stats.multivariate_normal.logpdf
+# "whittle" is O(N log N) and fast enough for every tower and
+# function; "pcg" handles gaps more accurately but is much slower.
+# With gaps the Whittle value is only an approximation to the
+# likelihood, biased low where much of the record is missing, so the
+# information criteria from it are Whittle pseudo-ICs: fine for
+# ranking functions at one tower, not comparable with exact ICs or
+# across towers with different gaps.
+LIKELIHOOD_METHOD = "whittle"
 
 
 for column in acf_data.iloc[:, :]:
@@ -1151,13 +1237,7 @@ for column in acf_data.iloc[:, :]:
             veg=amf_ds.coords["IGBP"].sel(site=column).values,
         )
     )
-    # col_data = difference_df_rect.loc[:, column].dropna()
-    # sample = col_data.sample(min(SAMPLE_SIZE, col_data.shape[0]))
-    # sample /= sample.std()
-    # sample_times = acf_col.index.values.astype("M8[h]").astype("u8")
-    # sample_times -= sample_times[0]
-    # sample_times = sample_times.astype("f4") / 24
-    # dt_sample = np.abs(sample_times[:, np.newaxis] - sample_times[np.newaxis, :])
+    hourly_col = difference_df_hourly[column].values
     uncertainty = 1. / np.sqrt(acf_pair_counts + 1e-30).astype(np.float32)
     for corr_fun, ax in zip(CORR_FUNS, axes[1:]):
         argspec = inspect.getfullargspec(corr_fun)
@@ -1181,24 +1261,23 @@ for column in acf_data.iloc[:, :]:
             np.mean(np.abs(acf_fit_resids)),
             np.median(np.abs(acf_fit_resids)),
         ]
-        # def loglik_fn(params):
-        #     corr_mat = corr_fun(dt_sample, *params)
-        #     return MVN_LOGPDF(sample.values, cov=corr_mat)
-        # # res = scipy.optimize.minimize(lambda params: -loglik_fn(params), param_vals)
-        # # ax.plot(acf_times, corr_fun(acf_times, *res.x), label="ML fit")
-        # # ax.legend()
-        # loglik = loglik_fn(param_vals)
-        # for ic_fun in INF_CRIT:
-        #     IC_DATA.loc[(column, corr_fun.__name__), ic_fun.__name__] = ic_fun(loglik, 1, len(param_names))
-        # ic_str = "AIC: {aic:3.2e} AICC: {aicc:3.2e} BIC: {3.2e} HQIC: {3.2e}".format(
-        #     IC_DATA.loc[(column, corr_fun.__name__), :]
-        # )
-        # ax.set_title(
-        #     "Fit of {corr_fun:s}  (ic_str:s}".format(
-        #         corr_fun=corr_fun.__name__, ic_str=ic_str
-        #     )
-        # )
-        # ax.set_title("Fit of {corr_fun:s}".format(corr_fun=corr_fun.__name__))
+        loglik = gaussian_log_likelihood(
+            hourly_col, corr_fun, param_vals, method=LIKELIHOOD_METHOD
+        )
+        # Pseudo-ICs unless LIKELIHOOD_METHOD is exact for the gaps in
+        # hourly_col; see above
+        for ic_fun in INF_CRIT:
+            # The mean and variance are also estimated
+            IC_DATA.loc[(column, corr_fun.__name__), ic_fun.__name__] = ic_fun(
+                loglik, np.isfinite(hourly_col).sum(), len(param_names) + 2
+            )
+        print(
+            corr_fun.__name__,
+            LIKELIHOOD_METHOD,
+            "AIC: {aic:3.2e} AICC: {aicc:3.2e} BIC: {bic:3.2e} HQIC: {hqic:3.2e}"
+            .format(**IC_DATA.loc[(column, corr_fun.__name__), :]),
+            flush=True,
+        )
         ax.set_title(corr_fun.__doc__)
     fig.tight_layout()
     fig.subplots_adjust(top=.9, hspace=1.1)
@@ -1216,6 +1295,10 @@ for column in acf_data.iloc[:, :]:
 COEF_DATA.to_csv("ameriflux-minus-casa-hour-towers-parameters.csv")
 COEF_VAR_DATA.to_csv("ameriflux-minus-casa-hour-towers-parameter-variances.csv")
 FIT_ERROR.to_csv("ameriflux-minus-casa-hour-towers-correlation-function-fits.csv")
+IC_DATA.to_csv(
+    "ameriflux-minus-casa-hour-towers-{method:s}-information-criteria.csv"
+    .format(method=LIKELIHOOD_METHOD)
+)
 
 
 for column in difference_df_rect:
@@ -1308,109 +1391,56 @@ import sklearn.tree
 tree_model = sklearn.tree.DecisionTreeClassifier(max_depth=3)
 classifier = tree_model.fit(sparse_explanatory_data, TOWER_CORR_FUNS)
 
-for column in difference_df_rect:
-    # # Calculate variograms directly.  Very slow with lots of data
-    # data = difference_df_rect[column].dropna()
-    # times = data.index.values.astype("M8[h]").astype("u8")
-    # times -= times[0]
-    # times = times.astype("f4") / 24
-    # pair_differences = pd.DataFrame(dict(
-    #     time_diff=np.abs(times[:, np.newaxis] - times[np.newaxis, :]).flat,
-    #     data_diff=(data[:, np.newaxis] - data[np.newaxis, :]).flat
-    # ))
-    # pair_differences.eval(
-    #     "data_diff_squared = data_diff ** 2\n"
-    #     "sqrt_data_diff = sqrt(abs(data_diff))",
-    #     inplace=True
-    # )
-    # grouped_pairs = pair_differences.groupby(
-    #     np.round(pair_differences.loc[:, "time_diff"] * 6) / 6
-    # )
-    # # The rest of the estimators are from this paper:
-    # # @article{MINGOTI2008,
-    # #   title = {{A note on robust and non-robust variogram estimators}},
-    # #   journal = {{Rem: Revista Escola de Minas}},
-    # #   author={Mingoti, Sueli Aparecida AND Rosa, Gilmar},
-    # #   ISSN = {0370-4467},
-    # #   eissn = {1807-0353},
-    # #   language = {en},
-    # #   URL = {http://www.scielo.br/scielo.php?script=sci_arttext&pid=S0370-44672008000100014&nrm=iso},
-    # #   volume = {61},
-    # #   year = {2008},
-    # #   month = {03},
-    # #   pages = {87 - 95},
-    # #   publisher = {scielo},
-    # #   doi = {10.1590/S0370-44672008000100014},
-    # # }
-    # # http://www.scielo.br/scielo.php?script=sci_arttext&pid=S0370-44672008000100014&lng=en&tlng=en
-    # tmp_data = grouped_pairs[["data_diff_squared", "sqrt_data_diff"]].mean()
-    # matheron_estimator = 0.5 * tmp_data["data_diff_squared"]
-    # counts = grouped_pairs["time_diff"].count()
-    # cressie_estimator = 0.5 * ((tmp_data["sqrt_data_diff"] ** 4) /
-    #                      (0.457 + 0.494 / counts + 0.045 / (counts ** 2)))
-    # median_estimator = grouped_pairs["sqrt_data_diff"].median() ** 4 / 0.457 * 0.5
-    # vgm_estimators = pd.DataFrame(dict(
-    #     variance_estimator=variance_estimator,
-    #     matheron_estimator=matheron_estimator,
-    #     cressie_estimator=cressie_estimator
-    # ))
-    # # @article{Haslett1997,
-    # # author = {Haslett, John},
-    # # title = {On the sample variogram and the sample autocovariance for non-stationary time series},
-    # # journal = {Journal of the Royal Statistical Society: Series D (The Statistician)},
-    # # volume = {46},
-    # # number = {4},
-    # # pages = {475-484},
-    # # keywords = {Autocorrelation, Autocovariance, Bias, Non-stationary mean,
-    # #             Non-stationary variance, Time series, Variogram},
-    # # doi = {10.1111/1467-9884.00101},
-    # # url = {https://rss.onlinelibrary.wiley.com/doi/abs/10.1111/1467-9884.00101},
-    # # abstract = {We consider the estimation of the covariance structure in time
-    # #    series for which the classical conditions of both mean and variance
-    # #    stationary may not be satisfied.
-    # #  It is well known that the classical estimators of the autocovariance are
-    # #    biased even when the process is stationary; even for series of length
-    # #    100–200 this bias can be surprisingly large.
-    # #  When the process is not mean stationary these estimators become hopelessly biased.
-    # #  When the process is not variance stationary the autocovariance is not even defined.
-    # #  By contrast the variogram is well defined for the much wider class of
-    # #    so-called intrinsic processes,
-    # #  its classical estimator is unbiased when the process is only mean
-    # #    stationary and an alternative but natural estimator has only a small
-    # #    bias even when the process is neither mean nor variance stationary.
-    # #  The basic theory is discussed and simulations presented.
-    # #  The procedures are illustrated in the context of a time series of the
-    # #    temperature of the Earth since the mid-19th century.},
-    # # year = {1997}
-    # # }
-    # variance_estimator = 0.5 * grouped_pairs["data_diff"].var()
-
-    # times = times.reshape(-1, 1)
-    # with pm.Model() as marginal_gp_model_daily:
-    #     # Daily correlation
-    #     time_daily = pm.HalfCauchy("T_d", 100)
-    #     temporal_falloff_daily = pm.gp.cov.Exponential(ls=time_daily, input_dim=3, active_dims=[0])
-    #     diel_harmonic1_coefficient = pm.Cauchy("a", 0.618, 1)
-    #     temporal_harmonic1_daily = pm.gp.cov.Cosine(ls=DAYS_PER_DAY, input_dim=3, active_dims=[0])
-    #     daily_cov = (diel_harmonic1_coefficient * temporal_harmonic1_daily *
-    #                  temporal_falloff_daily)
-    #     # Residual correlation
-    #     time_resid = pm.HalfCauchy("T_o", 250)
-    #     time_cov_resid = pm.gp.cov.Exponential(ls=time_resid, input_dim=3, active_dims=[0])
-    #     resid_coefficient = pm.Cauchy("c", 0.618, 1)
-    #     resid_cov = resid_coefficient * time_cov_resid
-    #     full_cov = daily_cov + resid_cov
-    #     # Instrument correlation
-    #     instrument_time = pm.HalfCauchy("T_ec", 2. / HOURS_PER_DAY)
-    #     instrument_temporal_cov = pm.gp.cov.Exponential(ls=instrument_time, input_dim=3, active_dims=[0])
-    #     instrument_coefficient = pm.Cauchy("d", 0.5, 1)
-    #     instrument_error = instrument_coefficient * instrument_temporal_cov
-    #     # Form the Gaussian Process
-    #     gp = pm.gp.Marginal(cov_func=full_cov)
-    #     print("Adding the data to the model", flush=True)
-    #     flux_diffs = gp.marginal_likelihood("flux_diff", X=times, y=data,
-    #                                         noise=instrument_error)
-    #     print("Finding MAP:", flush=True)
-    #     gp_map = pm.find_MAP()
-    #     print("MAP:", gp_map, flush=True)
-    pass
+# Variogram estimators from
+# @article{MINGOTI2008,
+#   title = {{A note on robust and non-robust variogram estimators}},
+#   journal = {{Rem: Revista Escola de Minas}},
+#   author={Mingoti, Sueli Aparecida AND Rosa, Gilmar},
+#   volume = {61},
+#   year = {2008},
+#   pages = {87 - 95},
+#   doi = {10.1590/S0370-44672008000100014},
+# }
+# and the variance of the differences from
+# @article{Haslett1997,
+# author = {Haslett, John},
+# title = {On the sample variogram and the sample autocovariance for non-stationary time series},
+# journal = {Journal of the Royal Statistical Society: Series D (The Statistician)},
+# volume = {46},
+# number = {4},
+# pages = {475-484},
+# doi = {10.1111/1467-9884.00101},
+# year = {1997}
+# }
+# Hourly lags, lined up with the ACF files so the variograms can be
+# compared with acovf(0) - acovf(lag) for each tower.
+VARIOGRAM_ESTIMATORS = ("matheron", "cressie_hawkins", "median",
+                        "difference_variance")
+tower_variograms = {
+    column: get_variograms(
+        difference_df_hourly[column].values,
+        max_lag=len(acovf_index) - 1,
+    )
+    for column in difference_df_hourly
+}
+vgm_estimators = {
+    name: pd.DataFrame({
+        column: pd.Series(
+            getattr(variograms, name),
+            index=acovf_index[:len(variograms.pair_counts)],
+        )
+        for column, variograms in tower_variograms.items()
+    }).reindex(acovf_index)
+    for name in VARIOGRAM_ESTIMATORS + ("pair_counts",)
+}
+vgm_estimators["acf_implied"] = acovf_data.iloc[0, :] - acovf_data
+for name, vgm_data in vgm_estimators.items():
+    vgm_data.to_csv(
+        "ameriflux-minus-casa-hour-towers-variograms-{name:s}.csv".format(
+            name=name.replace("_", "-")
+        )
+    )
+
+# Maximum-likelihood fits of the correlation functions to the hourly
+# series themselves, rather than to the correlograms, are in
+# cross_validate_function_fits.py with FIT_METHOD = "maximum-likelihood".
@@ -0,0 +1,215 @@
+# ~*~ coding: utf8 ~*~
+"""Maximum-likelihood fits of correlation functions to raw data.
+
+Fitting the empirical correlogram weights each lag by its pair count,
+which ignores the correlations between the lags.  These functions fit
+the parameters of the generated correlation functions by maximizing
+the Gaussian likelihood of the hourly series itself, gaps included,
+with the variance profiled out (see :mod:`gaussian_likelihood`).
+
+For the correlation matrix R of the observed points, z = R^{-1} x and
+q = x^T z, the gradient of the profile log-likelihood is
+
+    d loglik / d theta = (n / q * z^T dR z - tr(R^{-1} dR)) / 2.
+
+dR comes from the derivatives returned by the ``*_curve_loop``
+kernels, and every product with R or dR uses the circulant embedding
+of the Toeplitz matrix on the full hourly grid.  The trace is
+estimated from random sign vectors u as mean((R^{-1} u)^T dR u), and
+all the solves share one block of preconditioned conjugate gradient
+iterations.  The resulting gradients are noisy but unbiased, so the
+parameters are found by projected Adam ascent, averaging the iterates
+over the last half of the run.
+"""
+from __future__ import print_function, division
+
+import collections
+
+import numpy as np
+import scipy.fft
+
+from gaussian_likelihood import (
+    HOURS_PER_DAY,
+    GappyToeplitzOperator, get_embedding_spectrum,
+    pcg_likelihood_terms, profile_log_likelihood,
+)
+from lag_grids import LagGrid
+
+N_TRACE_PROBES = 8
+N_ITERATIONS = 150
+# Step size relative to the size of each parameter
+LEARNING_RATE = 0.02
+# Parameters smaller than this take steps as if they were this big
+MIN_PARAMETER_SCALE = 0.05
+ADAM_DECAY_RATES = (0.9, 0.999)
+ADAM_EPSILON = 1e-8
+
+MaximumLikelihoodFit = collections.namedtuple(
+    "MaximumLikelihoodFit",
+    ["parameters", "variance", "log_likelihood", "n_iterations"],
+)
+
+
+def get_lags(n_times, hours_per_step=1):
+    """Get the lags on the full time grid, in days.
+
+    Parameters
+    ----------
+    n_times: int
+    hours_per_step: float
+
+    Returns
+    -------
+    np.ndarray[n_times] of float32
+    """
+    return np.arange(n_times, dtype=np.float32) * np.float32(
+        hours_per_step / HOURS_PER_DAY
+    )
+
+
+def log_likelihood_gradient(data, have_data, curve_and_deriv, parameters,
+                            rng, n_probes=N_TRACE_PROBES, hours_per_step=1,
+                            lags=None):
+    """Estimate the gradient of the profile log-likelihood.
+
+    Parameters
+    ----------
+    data: np.ndarray[N]
+        Demeaned, on a regular grid.
+    have_data: np.ndarray[N] of bool
+    curve_and_deriv: callable
+        One of the generated ``*_curve_loop`` kernels.
+    parameters: np.ndarray[N_params]
+    rng: np.random.Generator
+    n_probes: int
+    hours_per_step: float
+    lags: LagGrid, optional
+        Of :func:`get_lags` for the data.  Made here if not given, but
+        passing the same one to every call saves the kernel finding the
+        grid each time.
+
+    Returns
+    -------
+    gradient: np.ndarray[N_params]
+    variance: float
+        The profiled variance at these parameters.
+    """
+    if lags is None:
+        lags = LagGrid(get_lags(len(data), hours_per_step))
+    curve, deriv = curve_and_deriv(lags, *parameters)
+    curve = np.asarray(curve, dtype=np.float64)
+    deriv = np.asarray(deriv, dtype=np.float64)
+    operator = GappyToeplitzOperator(curve, have_data)
+    deriv_spectra = get_embedding_spectrum(deriv.T, operator.fft_len)
+
+    observed = data[have_data]
+    n_obs = len(observed)
+    probes = rng.choice([-1., 1.], (n_probes, n_obs))
+    solutions, _ = operator.solve(np.concatenate([observed[np.newaxis], probes]))
+    data_solution = solutions[0]
+    probe_solutions = solutions[1:]
+    quadratic_form = observed.dot(data_solution)
+
+    # dR z and dR u for every derivative, sharing the forward transforms
+    vector_spectra = scipy.fft.rfft(
+        operator.embed(
+            np.concatenate([data_solution[np.newaxis], probes]),
+            operator.fft_len,
+        )
+    )
+    gradient = np.empty(len(parameters))
+    for i, deriv_spectrum in enumerate(deriv_spectra):
+        products = operator.apply_spectrum(vector_spectra, deriv_spectrum)
+        data_term = data_solution.dot(products[0])
+        trace_term = np.mean(np.sum(probe_solutions * products[1:], axis=-1))
+        gradient[i] = 0.5 * (n_obs / quadratic_form * data_term - trace_term)
+    return gradient, quadratic_form / n_obs
+
+
+def fit_maximum_likelihood(
+        data, curve_and_deriv, starting_params, lower_bounds, upper_bounds,
+        have_data=None, n_iterations=N_ITERATIONS, n_probes=N_TRACE_PROBES,
+        learning_rate=LEARNING_RATE, seed=0, hours_per_step=1,
+):
+    """Fit correlation function parameters to a gappy series.
+
+    Parameters
+    ----------
+    data: np.ndarray[N]
+        Regularly spaced.  Missing values may be NaN.
+    curve_and_deriv: callable
+        One of the generated ``*_curve_loop`` kernels.
+    starting_params, lower_bounds, upper_bounds: np.ndarray[N_params]
+        Starting from a correlogram fit saves many iterations.
+    have_data: np.ndarray[N] of bool, optional
+    n_iterations: int
+    n_probes: int
+        Random vectors per iteration for the trace estimates.
+    learning_rate: float
+    seed: int
+    hours_per_step: float
+
+    Returns
+    -------
+    MaximumLikelihoodFit
+        log_likelihood uses a stochastic estimate of the
+        log-determinant, so it is for comparing fits, not for tests.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    mask = np.isfinite(data)
+    if have_data is not None:
+        mask &= have_data
+    valid = np.nonzero(mask)[0]
+    record = slice(valid[0], valid[-1] + 1)
+    data = data[record]
+    mask = mask[record]
+    data = np.where(mask, data - data[mask].mean(), 0)
+
+    rng = np.random.default_rng(seed)
+    lower_bounds = np.asarray(lower_bounds, dtype=np.float64)
+    upper_bounds = np.asarray(upper_bounds, dtype=np.float64)
+    parameters = np.clip(
+        np.asarray(starting_params, dtype=np.float64),
+        lower_bounds, upper_bounds,
+    )
+    step_scale = learning_rate * np.maximum(
+        np.abs(parameters), MIN_PARAMETER_SCALE
+    )
+    first_moment = np.zeros_like(parameters)
+    second_moment = np.zeros_like(parameters)
+    first_decay, second_decay = ADAM_DECAY_RATES
+    average_start = n_iterations // 2
+    parameter_sum = np.zeros_like(parameters)
+    lags = LagGrid(get_lags(len(data), hours_per_step))
+
+    for iteration in range(1, n_iterations + 1):
+        gradient, _ = log_likelihood_gradient(
+            data, mask, curve_and_deriv, parameters, rng, n_probes,
+            hours_per_step, lags,
+        )
+        first_moment = first_decay * first_moment + (1 - first_decay) * gradient
+        second_moment = (
+            second_decay * second_moment + (1 - second_decay) * gradient ** 2
+        )
+        corrected_first = first_moment / (1 - first_decay ** iteration)
+        corrected_second = second_moment / (1 - second_decay ** iteration)
+        parameters = np.clip(
+            parameters + step_scale * corrected_first / (
+                np.sqrt(corrected_second) + ADAM_EPSILON
+            ),
+            lower_bounds, upper_bounds,
+        )
+        if iteration > average_start:
+            parameter_sum += parameters
+
+    parameters = parameter_sum / (n_iterations - average_start)
+    curve, _ = curve_and_deriv(lags, *parameters)
+    terms = pcg_likelihood_terms(
+        data, np.asarray(curve, dtype=np.float64), mask, seed=seed
+    )
+    return MaximumLikelihoodFit(
+        parameters,
+        terms.quadratic_form / terms.n_observations,
+        profile_log_likelihood(terms),
+        n_iterations,
+    )
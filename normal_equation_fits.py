@@ -0,0 +1,586 @@
+# ~*~ coding: utf8 ~*~
+"""Bounded trust-region fits from the normal equations.
+
+:func:`scipy.optimize.curve_fit` with bounds hands the full N x P
+Jacobian to the trust-region reflective solver of
+:func:`scipy.optimize.least_squares`, which takes an SVD of it, or of
+it stacked on a diagonal, every iteration.  The generated
+``*_normal_loop`` kernels instead return the weighted sum of squares
+F, g = J^T W r, and H = J^T W J from one pass over the lags, so each
+iteration here works with P x P matrices only.
+
+The steps are those of the trust-region reflective solver.  With the
+Coleman-Li scaling d and the diagonal C = diag(g dv) for the bounds,
+the augmented least-squares problem it solves is
+
+    min |[J d; C^(1/2)] p + [r; 0]|  subject to  |p| < Delta,
+
+whose normal equations involve only d H d + C and d g.  Every
+quantity it takes from the SVD is found from the eigenvalues and
+eigenvectors of that P x P matrix instead.  The steps are then
+reflected off or stopped short of the bounds, the radius updated, and
+the fit stopped by the same rules, and the covariance is found the
+same way as in curve_fit with relative weights.  Forming H squares
+the condition number, though, so on ill-conditioned problems
+:func:`fit_normal_equations` can end at a different local optimum
+than curve_fit.
+"""
+from __future__ import print_function, division
+
+import math
+import warnings
+
+import numpy as np
+import scipy.linalg
+import scipy.optimize
+
+from lag_grids import get_lag_grid
+
+DEFAULT_TOLERANCE = 1e-8
+# Relative accuracy of the step length on the trust-region boundary
+STEP_LENGTH_RTOL = 0.01
+MAX_STEP_LENGTH_ITERATIONS = 10
+
+_EPS = np.finfo(float).eps
+
+
+def _get_scaling_vector(parameters, gradient, lower_bounds, upper_bounds):
+    """Find the Coleman-Li scaling vector and its derivative.
+
+    Parameters
+    ----------
+    parameters, gradient, lower_bounds, upper_bounds: np.ndarray[N_params]
+
+    Returns
+    -------
+    scaling, scaling_deriv: np.ndarray[N_params]
+    """
+    scaling = np.ones_like(parameters)
+    scaling_deriv = np.zeros_like(parameters)
+    toward_upper = (gradient < 0) & np.isfinite(upper_bounds)
+    scaling[toward_upper] = (upper_bounds - parameters)[toward_upper]
+    scaling_deriv[toward_upper] = -1
+    toward_lower = (gradient > 0) & np.isfinite(lower_bounds)
+    scaling[toward_lower] = (parameters - lower_bounds)[toward_lower]
+    scaling_deriv[toward_lower] = 1
+    return scaling, scaling_deriv
+
+
+def _make_strictly_feasible(parameters, lower_bounds, upper_bounds,
+                            rstep=1e-10):
+    """Move parameters on or past a bound just inside it.
+
+    Parameters
+    ----------
+    parameters, lower_bounds, upper_bounds: np.ndarray[N_params]
+    rstep: float
+        Relative distance to move inside.  Zero moves one ulp.
+
+    Returns
+    -------
+    np.ndarray[N_params]
+    """
+    result = parameters.copy()
+    if rstep == 0:
+        at_lower = parameters <= lower_bounds
+        at_upper = parameters >= upper_bounds
+        result[at_lower] = np.nextafter(
+            lower_bounds[at_lower], upper_bounds[at_lower]
+        )
+        result[at_upper] = np.nextafter(
+            upper_bounds[at_upper], lower_bounds[at_upper]
+        )
+    else:
+        to_lower = parameters - lower_bounds
+        to_upper = upper_bounds - parameters
+        at_lower = np.isfinite(lower_bounds) & (
+            to_lower <= np.minimum(
+                to_upper, rstep * np.maximum(1, np.abs(lower_bounds))
+            )
+        )
+        at_upper = np.isfinite(upper_bounds) & (
+            to_upper <= np.minimum(
+                to_lower, rstep * np.maximum(1, np.abs(upper_bounds))
+            )
+        )
+        result[at_lower] = lower_bounds[at_lower] + rstep * np.maximum(
+            1, np.abs(lower_bounds[at_lower])
+        )
+        result[at_upper] = upper_bounds[at_upper] - rstep * np.maximum(
+            1, np.abs(upper_bounds[at_upper])
+        )
+    too_tight = (result < lower_bounds) | (result > upper_bounds)
+    result[too_tight] = 0.5 * (lower_bounds + upper_bounds)[too_tight]
+    return result
+
+
+def _get_step_to_bound(parameters, step, lower_bounds, upper_bounds):
+    """Find how far along a step the first bound is.
+
+    Parameters
+    ----------
+    parameters, step, lower_bounds, upper_bounds: np.ndarray[N_params]
+
+    Returns
+    -------
+    stride: float
+        The multiple of step that reaches the first bound.
+    hits: np.ndarray[N_params] of int
+        The direction of the step for the parameters that hit a bound
+        there, zero for the rest.
+    """
+    moving = step != 0
+    strides = np.full_like(parameters, np.inf)
+    with np.errstate(over="ignore"):
+        strides[moving] = np.maximum(
+            (lower_bounds - parameters)[moving] / step[moving],
+            (upper_bounds - parameters)[moving] / step[moving],
+        )
+    stride = np.min(strides)
+    return stride, np.equal(strides, stride) * np.sign(step).astype(int)
+
+
+def _intersect_trust_region(start, direction, radius):
+    """Find where a line from inside the trust region crosses its edge.
+
+    Parameters
+    ----------
+    start, direction: np.ndarray[N_params]
+    radius: float
+
+    Returns
+    -------
+    Tuple[float, float]
+        The multiples of direction, negative then positive.
+    """
+    quadratic = np.dot(direction, direction)
+    half_linear = np.dot(start, direction)
+    constant = np.dot(start, start) - radius ** 2
+    root = -(half_linear + math.copysign(
+        np.sqrt(half_linear ** 2 - quadratic * constant), half_linear
+    ))
+    return tuple(sorted((root / quadratic, constant / root)))
+
+
+def _minimize_quadratic_1d(quadratic, linear, lower, upper, constant=0):
+    """Minimize quadratic t ** 2 + linear t + constant on [lower, upper].
+
+    Returns
+    -------
+    t, value: float
+    """
+    candidates = [lower, upper]
+    if quadratic != 0:
+        extremum = -0.5 * linear / quadratic
+        if lower < extremum < upper:
+            candidates.append(extremum)
+    candidates = np.asarray(candidates)
+    values = candidates * (quadratic * candidates + linear) + constant
+    best = np.argmin(values)
+    return candidates[best], values[best]
+
+
+def _solve_trust_region(eigenvalues, eigenvectors, gradient, radius,
+                        n_points, damping):
+    """Minimize the model within the trust region.
+
+    Parameters
+    ----------
+    eigenvalues, eigenvectors: np.ndarray
+        Of the model's matrix, eigenvalues in decreasing order.
+    gradient: np.ndarray[N_params]
+        Of the model.
+    radius: float
+    n_points: int
+        The number of residuals, for the rank test.
+    damping: float
+        The Levenberg-Marquardt parameter that solved the last problem.
+
+    Returns
+    -------
+    step: np.ndarray[N_params]
+    damping: float
+    """
+    # The eigenvalues are the squares of the singular values of the
+    # augmented Jacobian, and the rotated gradient their products with
+    # the rotated residuals.  Forming the matrix squares the condition
+    # number, so the rank test is on the eigenvalues themselves.
+    rotated_gradient = eigenvectors.T.dot(gradient)
+    full_rank = eigenvalues[-1] > _EPS * n_points * eigenvalues[0]
+
+    if full_rank:
+        step = -eigenvectors.dot(rotated_gradient / eigenvalues)
+        if np.linalg.norm(step) <= radius:
+            return step, 0.0
+
+    def excess_length(damping):
+        """Find how far the damped step overshoots, and the derivative."""
+        denominator = eigenvalues + damping
+        step_length = np.linalg.norm(rotated_gradient / denominator)
+        return (
+            step_length - radius,
+            -np.sum(rotated_gradient ** 2 / denominator ** 3) / step_length,
+        )
+
+    damping_upper = np.linalg.norm(rotated_gradient) / radius
+    if full_rank:
+        excess, excess_deriv = excess_length(0.0)
+        damping_lower = -excess / excess_deriv
+    else:
+        damping_lower = 0.0
+    if not full_rank and damping == 0:
+        damping = max(0.001 * damping_upper,
+                      (damping_lower * damping_upper) ** 0.5)
+
+    for _ in range(MAX_STEP_LENGTH_ITERATIONS):
+        if damping < damping_lower or damping > damping_upper:
+            damping = max(0.001 * damping_upper,
+                          (damping_lower * damping_upper) ** 0.5)
+        excess, excess_deriv = excess_length(damping)
+        if excess < 0:
+            damping_upper = damping
+        ratio = excess / excess_deriv
+        damping_lower = max(damping_lower, damping - ratio)
+        damping -= (excess + radius) * ratio / radius
+        if abs(excess) < STEP_LENGTH_RTOL * radius:
+            break
+
+    step = -eigenvectors.dot(rotated_gradient / (eigenvalues + damping))
+    step *= radius / np.linalg.norm(step)
+    return step, damping
+
+
+def _select_step(parameters, model_matrix, model_gradient, step,
+                 scaled_step, scaling, radius, lower_bounds, upper_bounds,
+                 step_back):
+    """Choose among the step, its reflection, and the gradient step.
+
+    All the scaled quantities are in the Coleman-Li variables.
+
+    Parameters
+    ----------
+    parameters: np.ndarray[N_params]
+    model_matrix: np.ndarray[N_params, N_params]
+    model_gradient: np.ndarray[N_params]
+    step, scaled_step: np.ndarray[N_params]
+        The trust-region solution, unscaled and scaled.
+    scaling: np.ndarray[N_params]
+    radius: float
+    lower_bounds, upper_bounds: np.ndarray[N_params]
+    step_back: float
+        How far toward a bound to go, as a fraction of the way.
+
+    Returns
+    -------
+    step, scaled_step: np.ndarray[N_params]
+    predicted_decrease: float
+        In half the sum of squares.
+    """
+    def model_1d(direction, start=None):
+        """Get the coefficients of the model along a line."""
+        matrix_direction = model_matrix.dot(direction)
+        quadratic = 0.5 * direction.dot(matrix_direction)
+        linear = model_gradient.dot(direction)
+        if start is None:
+            return quadratic, linear
+        linear += start.dot(matrix_direction)
+        constant = (
+            0.5 * start.dot(model_matrix.dot(start)) +
+            model_gradient.dot(start)
+        )
+        return quadratic, linear, constant
+
+    def model_value(scaled_step):
+        """Find the change in the model for a step."""
+        return (
+            0.5 * scaled_step.dot(model_matrix.dot(scaled_step)) +
+            model_gradient.dot(scaled_step)
+        )
+
+    new_parameters = parameters + step
+    if (
+            (new_parameters >= lower_bounds) &
+            (new_parameters <= upper_bounds)
+    ).all():
+        return step, scaled_step, -model_value(scaled_step)
+
+    stride, hits = _get_step_to_bound(
+        parameters, step, lower_bounds, upper_bounds
+    )
+    reflected_scaled = scaled_step.copy()
+    reflected_scaled[hits.astype(bool)] *= -1
+    reflected = scaling * reflected_scaled
+    step = step * stride
+    scaled_step = scaled_step * stride
+    on_bound = parameters + step
+
+    to_trust_region = _intersect_trust_region(
+        scaled_step, reflected_scaled, radius
+    )[1]
+    to_bound = _get_step_to_bound(
+        on_bound, reflected, lower_bounds, upper_bounds
+    )[0]
+    reflected_stride = min(to_bound, to_trust_region)
+    if reflected_stride > 0:
+        min_reflected_stride = (1 - step_back) * stride / reflected_stride
+        if reflected_stride == to_bound:
+            max_reflected_stride = step_back * to_bound
+        else:
+            max_reflected_stride = to_trust_region
+    else:
+        min_reflected_stride = 0
+        max_reflected_stride = -1
+    if min_reflected_stride <= max_reflected_stride:
+        quadratic, linear, constant = model_1d(reflected_scaled, scaled_step)
+        reflected_stride, reflected_value = _minimize_quadratic_1d(
+            quadratic, linear, min_reflected_stride, max_reflected_stride,
+            constant,
+        )
+        reflected_scaled = scaled_step + reflected_stride * reflected_scaled
+        reflected = scaling * reflected_scaled
+    else:
+        reflected_value = np.inf
+
+    step = step * step_back
+    scaled_step = scaled_step * step_back
+    step_value = model_value(scaled_step)
+
+    descent_scaled = -model_gradient
+    descent = scaling * descent_scaled
+    to_trust_region = radius / np.linalg.norm(descent_scaled)
+    to_bound = _get_step_to_bound(
+        parameters, descent, lower_bounds, upper_bounds
+    )[0]
+    if to_bound < to_trust_region:
+        descent_stride = step_back * to_bound
+    else:
+        descent_stride = to_trust_region
+    descent_stride, descent_value = _minimize_quadratic_1d(
+        *model_1d(descent_scaled), 0, descent_stride
+    )
+    descent_scaled = descent_scaled * descent_stride
+    descent = descent * descent_stride
+
+    if step_value < reflected_value and step_value < descent_value:
+        return step, scaled_step, -step_value
+    if reflected_value < step_value and reflected_value < descent_value:
+        return reflected, reflected_scaled, -reflected_value
+    return descent, descent_scaled, -descent_value
+
+
+def _get_covariance(normal_matrix, sum_squares, n_points):
+    """Find the parameter covariance the way curve_fit does.
+
+    Parameters
+    ----------
+    normal_matrix: np.ndarray[N_params, N_params]
+        J^T W J at the solution.
+    sum_squares: float
+        The weighted sum of squared residuals at the solution.
+    n_points: int
+
+    Returns
+    -------
+    np.ndarray[N_params, N_params]
+    """
+    n_params = len(normal_matrix)
+    # Moore-Penrose inverse, dropping singular values of W^(1/2) J
+    # below curve_fit's threshold
+    eigenvalues, eigenvectors = scipy.linalg.eigh(normal_matrix)
+    singular_values = np.sqrt(np.maximum(eigenvalues, 0))
+    keep = singular_values > (
+        _EPS * max(n_points, n_params) * singular_values.max()
+    )
+    eigenvectors = eigenvectors[:, keep]
+    param_cov = (eigenvectors / eigenvalues[keep]).dot(eigenvectors.T)
+    if n_points > n_params:
+        param_cov *= sum_squares / (n_points - n_params)
+    else:
+        param_cov.fill(np.inf)
+        warnings.warn(
+            "Covariance of the parameters could not be estimated",
+            category=scipy.optimize.OptimizeWarning,
+        )
+    return param_cov
+
+
+def fit_normal_equations(normal_equations, lags, acf, pair_counts, p0,
+                         bounds, ftol=DEFAULT_TOLERANCE,
+                         xtol=DEFAULT_TOLERANCE, gtol=DEFAULT_TOLERANCE,
+                         max_nfev=None, full_output=False):
+    """Fit a correlation function to a correlogram weighted by pair counts.
+
+    Minimizes sum(pair_counts * (curve(lags) - acf) ** 2), which is the
+    problem :func:`scipy.optimize.curve_fit` solves when given
+    ``sigma=1 / sqrt(pair_counts)``, taking the same steps.
+
+    This is the ``FIT_SOLVER = "normal-equations"`` option of the
+    cross-validation drivers, which avoids forming the Jacobian.  The
+    steps are curve_fit's, but the rounding differs, so on
+    ill-conditioned correlograms the two can end at different local
+    optima or differ in whether they converge at all.  The drivers
+    therefore default to "curve_fit" itself.  "variable-projection"
+    (:func:`variable_projection_fits.fit_variable_projection`)
+    searches only the nonlinear parameters before polishing with this
+    function, and can also find a different local minimum.
+
+    Parameters
+    ----------
+    normal_equations: callable
+        One of the generated ``*_normal_loop`` kernels.  It is passed
+        a :class:`lag_grids.LagGrid` for the lags.
+    lags, acf, pair_counts: np.ndarray[N]
+    p0: np.ndarray[N_params]
+    bounds: Tuple[np.ndarray[N_params], np.ndarray[N_params]]
+        Lower and upper bounds on the parameters.
+    ftol, xtol, gtol: float
+        Tolerances on the change in the sum of squares, the change in
+        the parameters, and the scaled gradient, as for
+        :func:`scipy.optimize.least_squares`.
+    max_nfev: int, optional
+        Kernel passes allowed.  The default is 100 per parameter, like
+        curve_fit.
+    full_output: bool
+        Also return a dict with the number of kernel passes and the
+        reason the fit stopped.
+
+    Returns
+    -------
+    popt: np.ndarray[N_params]
+    pcov: np.ndarray[N_params, N_params]
+        Scaled by the residual variance, as with curve_fit's default
+        ``absolute_sigma=False``.
+    infodict: dict
+        Only if full_output.
+
+    Raises
+    ------
+    ValueError
+        If p0 is outside the bounds.
+    RuntimeError
+        If the fit does not converge within max_nfev kernel passes.
+    """
+    # Look the grid up once, rather than at every kernel pass
+    lags = get_lag_grid(np.ascontiguousarray(lags, dtype=np.float64))
+    acf = np.ascontiguousarray(acf, dtype=np.float64)
+    pair_counts = np.ascontiguousarray(pair_counts, dtype=np.float64)
+    parameters = np.array(p0, dtype=np.float64)
+    lower_bounds, upper_bounds = (
+        np.broadcast_to(np.asarray(bound, dtype=np.float64), parameters.shape)
+        for bound in bounds
+    )
+    if ((parameters < lower_bounds) | (parameters > upper_bounds)).any():
+        raise ValueError("Initial guess is outside of provided bounds")
+    parameters = _make_strictly_feasible(
+        parameters, lower_bounds, upper_bounds
+    )
+    n_points = len(acf)
+    if max_nfev is None:
+        max_nfev = 100 * len(parameters)
+
+    # The solver works with half the sum of squares
+    sum_squares, gradient, normal_matrix = normal_equations(
+        parameters, lags, acf, pair_counts
+    )
+    cost = 0.5 * sum_squares
+    nfev = 1
+    scaling = _get_scaling_vector(
+        parameters, gradient, lower_bounds, upper_bounds
+    )[0]
+    radius = np.linalg.norm(parameters / scaling ** 0.5)
+    if radius == 0:
+        radius = 1.0
+    damping = 0.0
+    status = None
+    while True:
+        scaling, scaling_deriv = _get_scaling_vector(
+            parameters, gradient, lower_bounds, upper_bounds
+        )
+        gradient_norm = np.linalg.norm(gradient * scaling, ord=np.inf)
+        if gradient_norm < gtol:
+            status = "`gtol` termination condition is satisfied."
+        if status is not None or nfev == max_nfev:
+            break
+
+        scaling = scaling ** 0.5
+        model_matrix = (
+            scaling[:, np.newaxis] * normal_matrix * scaling[np.newaxis, :] +
+            np.diag(gradient * scaling_deriv)
+        )
+        model_gradient = scaling * gradient
+        eigenvalues, eigenvectors = scipy.linalg.eigh(model_matrix)
+        eigenvalues = np.maximum(eigenvalues[::-1], 0)
+        eigenvectors = eigenvectors[:, ::-1]
+        step_back = max(0.995, 1 - gradient_norm)
+
+        actual_decrease = -1
+        while actual_decrease <= 0 and nfev < max_nfev:
+            scaled_step, damping = _solve_trust_region(
+                eigenvalues, eigenvectors, model_gradient, radius,
+                n_points, damping,
+            )
+            step, scaled_step, predicted_decrease = _select_step(
+                parameters, model_matrix, model_gradient,
+                scaling * scaled_step, scaled_step, scaling, radius,
+                lower_bounds, upper_bounds, step_back,
+            )
+            new_parameters = _make_strictly_feasible(
+                parameters + step, lower_bounds, upper_bounds, rstep=0
+            )
+            new_sum_squares, new_gradient, new_normal_matrix = (
+                normal_equations(new_parameters, lags, acf, pair_counts)
+            )
+            nfev += 1
+            scaled_step_norm = np.linalg.norm(scaled_step)
+            if not np.isfinite(new_sum_squares):
+                radius = 0.25 * scaled_step_norm
+                continue
+
+            new_cost = 0.5 * new_sum_squares
+            actual_decrease = cost - new_cost
+            if predicted_decrease > 0:
+                gain_ratio = actual_decrease / predicted_decrease
+            elif predicted_decrease == actual_decrease == 0:
+                gain_ratio = 1
+            else:
+                gain_ratio = 0
+            new_radius = radius
+            if gain_ratio < 0.25:
+                new_radius = 0.25 * scaled_step_norm
+            elif gain_ratio > 0.75 and scaled_step_norm > 0.95 * radius:
+                new_radius = 2.0 * radius
+
+            ftol_satisfied = (
+                actual_decrease < ftol * cost and gain_ratio > 0.25
+            )
+            xtol_satisfied = np.linalg.norm(step) < xtol * (
+                xtol + np.linalg.norm(parameters)
+            )
+            if ftol_satisfied and xtol_satisfied:
+                status = ("Both `ftol` and `xtol` termination conditions "
+                          "are satisfied.")
+            elif ftol_satisfied:
+                status = "`ftol` termination condition is satisfied."
+            elif xtol_satisfied:
+                status = "`xtol` termination condition is satisfied."
+            if status is not None:
+                break
+            damping *= radius / new_radius
+            radius = new_radius
+
+        if actual_decrease > 0:
+            parameters = new_parameters
+            cost = new_cost
+            sum_squares = new_sum_squares
+            gradient = new_gradient
+            normal_matrix = new_normal_matrix
+
+    if status is None:
+        raise RuntimeError(
+            "Optimal parameters not found: The maximum number of function "
+            "evaluations is exceeded."
+        )
+    param_cov = _get_covariance(normal_matrix, sum_squares, n_points)
+    if full_output:
+        return parameters, param_cov, dict(nfev=nfev, message=status)
+    return parameters, param_cov
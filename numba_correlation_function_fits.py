@@ -0,0 +1,465 @@
+# ~*~ coding: utf8 ~*~
+"""Numba builds of the kernels in flux_correlation_function_fits.
+
+Changing a :class:`correlation_function_fits.PartForm` otherwise means
+rerunning ``make_correlation_function_fit_deriv.py`` and compiling the
+changed extension modules before any fit can run.  Here the kernels for a
+combination are written from the same
+:func:`correlation_function_fits.get_loop_expressions` as the extension
+modules to a small Python module the first time one of them is asked
+for, and numba compiles them on their first call.
+numba caches the machine code next to that module, so later runs only
+compile again if the expressions change.
+
+The kernels have the same names and arguments as those in the
+extension module, so
+
+>>> numba_correlation_function_fits.d0_dm0_a0_curve_loop(lags, *params)
+
+works like the Cython version, and the lags may be a
+:class:`lag_grids.LagGrid`.  The kernels take num_threads to match,
+but ignore it: numba's thread count belongs to the calling thread, so
+set it once with :func:`set_num_threads`, as worker initializers do.
+"""
+from __future__ import print_function, division
+
+import importlib.util
+import itertools
+import os
+import os.path
+import sys
+
+import numba
+
+from correlation_function_fits import (
+    GLOBAL_DICT, CorrelationPart, PartForm,
+    is_valid_combination, get_full_expression,
+    get_full_parameter_list, get_loop_expressions, substitute_constants,
+)
+
+# Where the generated kernel modules and numba's cache go
+KERNEL_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "numba_kernels"
+)
+# Lags per partial sum in the reductions
+CHUNK_SIZE = 4096
+
+KERNEL_KINDS = ("fit_ne", "curve_ne", "fit_loop", "curve_loop", "normal_loop")
+
+MODULE_TEMPLATE = '''# ~*~ coding: utf8 ~*~
+"""Numba kernels for {function_name:s}.
+
+Written by numba_correlation_function_fits.  Do not edit.
+"""
+from math import exp, cos, sin
+
+import numba
+import numpy as np
+
+from lag_grids import LagGrid, get_lag_grid
+
+{constants:s}
+N_PARAMETERS = {n_parameters:d}
+CHUNK_SIZE = {chunk_size:d}
+# Fuse and reorder the arithmetic, but keep NaN and inf, so a failed
+# fit still shows up as NaN, as with the Cython kernels
+FASTMATH = {{"contract", "reassoc"}}
+# The functions of the lags curve_point looks up
+BASES = (
+{bases:s})
+
+
+@numba.njit(fastmath=FASTMATH, cache=True)
+def where(cond, a, b):
+    if cond:
+        return a
+    return b
+
+
+@numba.njit(fastmath=FASTMATH, cache=True)
+def curve_value(tdata, parameters):
+{params_from_parameters:s}
+    return {full_expr:s}
+
+
+@numba.njit(fastmath=FASTMATH, cache=True)
+def curve_point(tdata, bases, i, parameters, here_deriv):
+    """Find the curve at lag i and put its gradient in here_deriv."""
+{params_from_parameters:s}
+    resid_timescale = resid_timescale * DAYS_PER_FORTNIGHT
+    ec_timescale = ec_timescale / HOURS_PER_DAY
+{subexpressions:s}
+    daily_corr = {daily_form:s}
+    dm_corr = {daily_modulation_form:s}
+    {accum_day_deriv:s}
+    {accum_dm_deriv:s}
+
+    ann_corr = {annual_form:s}
+    {accum_ann_deriv:s}
+
+    here_corr = daily_corr * dm_corr + ann_corr
+
+    if resid_timescale > 0:
+        resid_corr = resid_coef * exp(-tdata / resid_timescale)
+        here_corr += resid_corr
+        here_deriv[N_PARAMETERS - 4] = exp(-tdata / resid_timescale)
+        here_deriv[N_PARAMETERS - 3] = resid_corr * tdata / resid_timescale ** 2 * DAYS_PER_FORTNIGHT
+    else:
+        here_deriv[N_PARAMETERS - 4] = 0.0
+        here_deriv[N_PARAMETERS - 3] = 0.0
+
+    if ec_timescale > 0:
+        ec_corr = ec_coef * exp(-tdata / ec_timescale)
+        here_corr += ec_corr
+        here_deriv[N_PARAMETERS - 2] = exp(-tdata / ec_timescale)
+        here_deriv[N_PARAMETERS - 1] = ec_corr * tdata / ec_timescale ** 2 / HOURS_PER_DAY
+    else:
+        here_deriv[N_PARAMETERS - 2] = 0.0
+        here_deriv[N_PARAMETERS - 1] = 0.0
+
+    return here_corr
+
+
+@numba.njit(parallel=True, fastmath=FASTMATH, cache=True)
+def fit_ne(parameters, tdata, empirical_correlogram, pair_count):
+    weighted_fit = 0.0
+    for i in numba.prange(len(tdata)):
+        weighted_fit += pair_count[i] * (
+            empirical_correlogram[i] - curve_value(tdata[i], parameters)
+        ) ** 2
+    return weighted_fit
+
+
+@numba.njit(parallel=True, fastmath=FASTMATH, cache=True)
+def curve_ne(tdata, parameters, curve):
+    for i in numba.prange(len(tdata)):
+        curve[i] = curve_value(tdata[i], parameters)
+
+
+@numba.njit(parallel=True, fastmath=FASTMATH, cache=True)
+def curve_loop(tdata, bases, parameters):
+    curve = np.empty(len(tdata), dtype=tdata.dtype)
+    deriv = np.empty((len(tdata), N_PARAMETERS), dtype=tdata.dtype)
+    for i in numba.prange(len(tdata)):
+        curve[i] = curve_point(tdata[i], bases, i, parameters, deriv[i])
+    return curve, deriv
+
+
+@numba.njit(parallel=True, fastmath=FASTMATH, cache=True)
+def fit_loop(parameters, tdata, bases, empirical_correlogram, pair_count):
+    n_chunks = (len(tdata) + CHUNK_SIZE - 1) // CHUNK_SIZE
+    chunk_fit = np.zeros(n_chunks)
+    chunk_deriv = np.zeros((n_chunks, N_PARAMETERS))
+    for chunk in numba.prange(n_chunks):
+        here_deriv = np.empty(N_PARAMETERS)
+        for i in range(
+                chunk * CHUNK_SIZE, min((chunk + 1) * CHUNK_SIZE, len(tdata))
+        ):
+            resid = (
+                curve_point(tdata[i], bases, i, parameters, here_deriv) -
+                empirical_correlogram[i]
+            )
+            chunk_fit[chunk] += pair_count[i] * resid ** 2
+            for j in range(N_PARAMETERS):
+                chunk_deriv[chunk, j] += 2 * pair_count[i] * resid * here_deriv[j]
+    return chunk_fit.sum(), chunk_deriv.sum(axis=0)
+
+
+@numba.njit(parallel=True, fastmath=FASTMATH, cache=True)
+def normal_loop(parameters, tdata, bases, empirical_correlogram, pair_count):
+    n_chunks = (len(tdata) + CHUNK_SIZE - 1) // CHUNK_SIZE
+    chunk_fit = np.zeros(n_chunks)
+    chunk_gradient = np.zeros((n_chunks, N_PARAMETERS))
+    chunk_normal_matrix = np.zeros((n_chunks, N_PARAMETERS, N_PARAMETERS))
+    for chunk in numba.prange(n_chunks):
+        here_deriv = np.empty(N_PARAMETERS)
+        for i in range(
+                chunk * CHUNK_SIZE, min((chunk + 1) * CHUNK_SIZE, len(tdata))
+        ):
+            weight = pair_count[i]
+            if weight == 0:
+                continue
+            resid = (
+                curve_point(tdata[i], bases, i, parameters, here_deriv) -
+                empirical_correlogram[i]
+            )
+            chunk_fit[chunk] += weight * resid ** 2
+            for j in range(N_PARAMETERS):
+                chunk_gradient[chunk, j] += weight * resid * here_deriv[j]
+                for k in range(j, N_PARAMETERS):
+                    chunk_normal_matrix[chunk, j, k] += (
+                        weight * here_deriv[j] * here_deriv[k]
+                    )
+    normal_matrix = chunk_normal_matrix.sum(axis=0)
+    for j in range(N_PARAMETERS):
+        for k in range(j):
+            normal_matrix[j, k] = normal_matrix[k, j]
+    return chunk_fit.sum(), chunk_gradient.sum(axis=0), normal_matrix
+
+
+def _as_lags(tdata):
+    if isinstance(tdata, LagGrid):
+        return tdata.lags
+    tdata = np.ascontiguousarray(tdata)
+    if tdata.dtype not in (np.float32, np.float64):
+        tdata = tdata.astype(np.float64)
+    return tdata
+
+
+def _as_data(tdata, empirical_correlogram, pair_count):
+    if (
+            len(empirical_correlogram) != len(tdata) or
+            len(pair_count) != len(tdata)
+    ):
+        raise ValueError("Need one correlogram value and pair count per lag")
+    return (
+        np.ascontiguousarray(empirical_correlogram, dtype=tdata.dtype),
+        np.ascontiguousarray(pair_count, dtype=tdata.dtype),
+    )
+
+
+def {function_name:s}_fit_ne(
+    parameters, tdata, empirical_correlogram, pair_count, num_threads=0
+):
+    tdata = _as_lags(tdata)
+    return fit_ne(
+        np.asarray(parameters, dtype=np.float64),
+        tdata, *_as_data(tdata, empirical_correlogram, pair_count)
+    )
+
+
+def {function_name:s}_curve_ne(
+    tdata,
+{parameters:s}
+    out=None,
+    num_threads=0,
+):
+    tdata = _as_lags(tdata)
+    if out is None:
+        out = np.empty(len(tdata), dtype=tdata.dtype)
+    elif len(out) != len(tdata):
+        raise ValueError("Need one output value per lag")
+    curve_ne(
+        tdata, np.array([{parameter_list:s}], dtype=np.float64), out
+    )
+    return out
+
+
+def {function_name:s}_fit_loop(
+    parameters, tdata_base, empirical_correlogram, pair_count, num_threads=0
+):
+    grid = get_lag_grid(tdata_base)
+    return fit_loop(
+        np.asarray(parameters, dtype=np.float64),
+        grid.lags, grid.get_bases(BASES),
+        *_as_data(grid.lags, empirical_correlogram, pair_count)
+    )
+
+
+def {function_name:s}_curve_loop(
+    tdata_base,
+{parameters:s}
+    num_threads=0,
+):
+    grid = get_lag_grid(tdata_base)
+    return curve_loop(
+        grid.lags, grid.get_bases(BASES),
+        np.array([{parameter_list:s}], dtype=np.float64),
+    )
+
+
+def {function_name:s}_normal_loop(
+    parameters, tdata_base, empirical_correlogram, pair_count, num_threads=0
+):
+    """Find the weighted SSE, J^T W r, and J^T W J in one pass."""
+    grid = get_lag_grid(tdata_base)
+    return normal_loop(
+        np.asarray(parameters, dtype=np.float64),
+        grid.lags, grid.get_bases(BASES),
+        *_as_data(grid.lags, empirical_correlogram, pair_count)
+    )
+'''
+
+# The combinations by short name, and their kernel modules once loaded
+_COMBINATIONS = {
+    "_".join(
+        "{0:s}{1:s}".format(part.get_short_name(), form.get_short_name())
+        for part, form in zip(CorrelationPart, forms)
+    ): forms
+    for forms in itertools.product(PartForm, PartForm, PartForm)
+    if is_valid_combination(*forms)
+}
+_KERNEL_MODULES = {}
+
+
+def get_kernel_source(forms):
+    """Write the numba kernels for a combination.
+
+    Parameters
+    ----------
+    forms: Tuple[PartForm, PartForm, PartForm]
+
+    Returns
+    -------
+    str
+        The source of a python module.
+    """
+    parameter_list = get_full_parameter_list(*forms)
+    n_daily = len(forms[0].get_parameters(CorrelationPart.DAILY))
+    n_dm = len(forms[1].get_parameters(CorrelationPart.DAILY_MODULATION))
+    loop_cse = get_loop_expressions(*forms)[0]
+    daily_derivs, dm_derivs, annual_derivs = (
+        ["({0:s})".format(piece) for piece in loop_cse.reduced[start:stop]]
+        for start, stop in (
+            (3, 3 + n_daily),
+            (3 + n_daily, 3 + n_daily + n_dm),
+            (3 + n_daily + n_dm, len(loop_cse.reduced)),
+        )
+    )
+    return MODULE_TEMPLATE.format(
+        function_name="_".join(
+            "{0:s}{1:s}".format(part.get_short_name(), form.get_short_name())
+            for part, form in zip(CorrelationPart, forms)
+        ),
+        constants="".join(
+            "{name:s} = {value!r:s}\n".format(name=name, value=value)
+            for name, value in sorted(GLOBAL_DICT.items())
+        ),
+        n_parameters=len(parameter_list),
+        chunk_size=CHUNK_SIZE,
+        bases="".join(
+            "    \"{0:s}\",\n".format(substitute_constants(basis))
+            for _, basis in loop_cse.basis
+        ),
+        params_from_parameters="".join(
+            "    {param_name:s} = parameters[{i:d}]\n".format(
+                i=i, param_name=param_name
+            )
+            for i, param_name in enumerate(parameter_list)
+        ),
+        parameters="".join(
+            "    {param_name:s},\n".format(param_name=param_name)
+            for param_name in parameter_list
+        ),
+        parameter_list=", ".join(parameter_list),
+        full_expr=get_full_expression(*forms),
+        subexpressions="".join(
+            ["    {0:s} = bases[{1:d}, i]\n".format(name, k)
+             for k, (name, _) in enumerate(loop_cse.basis)] +
+            ["    {0:s} = {1:s}\n".format(name, value)
+             for name, value in loop_cse.invariant] +
+            ["    {0:s} = exp(({1:s}) * tdata)\n".format(name, rate)
+             for name, rate in loop_cse.decay] +
+            ["    {0:s} = {1:s}\n".format(name, value)
+             for name, value in loop_cse.per_lag]
+        ),
+        daily_form=loop_cse.reduced[0],
+        daily_modulation_form=loop_cse.reduced[1],
+        annual_form=loop_cse.reduced[2],
+        accum_day_deriv="\n    ".join(
+            "here_deriv[{j:d}] = {deriv_piece:s} * dm_corr".format(
+                j=j, deriv_piece=deriv_piece
+            )
+            for j, deriv_piece in enumerate(
+                daily_derivs
+            )
+        ),
+        accum_dm_deriv="\n    ".join(
+            "here_deriv[{j:d}] = daily_corr * {deriv_piece:s}".format(
+                j=j, deriv_piece=deriv_piece
+            )
+            for j, deriv_piece in enumerate(
+                dm_derivs,
+                n_daily,
+            )
+        ),
+        accum_ann_deriv="\n    ".join(
+            "here_deriv[{j:d}] = {deriv_piece:s}".format(
+                j=j, deriv_piece=deriv_piece
+            )
+            for j, deriv_piece in enumerate(
+                annual_derivs,
+                n_daily + n_dm,
+            )
+        ),
+    )
+
+
+def get_kernel_module(func_short_name):
+    """Load the numba kernels for a combination, writing them if needed.
+
+    The source is only rewritten when it changes, so numba's on-disk
+    cache stays valid between runs.
+
+    Parameters
+    ----------
+    func_short_name: str
+        Like ``"d0_dm0_a0"``.
+
+    Returns
+    -------
+    module
+    """
+    if func_short_name in _KERNEL_MODULES:
+        return _KERNEL_MODULES[func_short_name]
+    source = get_kernel_source(_COMBINATIONS[func_short_name])
+    file_name = os.path.join(
+        KERNEL_DIR, "{0:s}_kernels.py".format(func_short_name)
+    )
+    try:
+        with open(file_name) as in_file:
+            up_to_date = in_file.read() == source
+    except IOError:
+        up_to_date = False
+    if not up_to_date:
+        os.makedirs(KERNEL_DIR, exist_ok=True)
+        # Other processes may be loading the same file
+        temp_name = "{0:s}.{1:d}.tmp".format(file_name, os.getpid())
+        with open(temp_name, "w") as out_file:
+            out_file.write(source)
+        os.replace(temp_name, file_name)
+    module_name = "numba_kernels_{0:s}".format(func_short_name)
+    spec = importlib.util.spec_from_file_location(module_name, file_name)
+    module = importlib.util.module_from_spec(spec)
+    # numba imports the module by name when loading its cache
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    _KERNEL_MODULES[func_short_name] = module
+    return module
+
+
+def set_num_threads(num_threads):
+    """Set the number of threads the kernels use from this thread.
+
+    Parameters
+    ----------
+    num_threads: int
+    """
+    if num_threads < 1:
+        raise ValueError("Need at least one thread")
+    numba.set_num_threads(num_threads)
+
+
+def __getattr__(name):
+    """Find the kernel called name, building it if needed."""
+    for kind in KERNEL_KINDS:
+        suffix = "_" + kind
+        if (
+                name.endswith(suffix) and
+                name[:-len(suffix)] in _COMBINATIONS
+        ):
+            return getattr(get_kernel_module(name[:-len(suffix)]), name)
+    raise AttributeError(
+        "module {0:s} has no attribute {1:s}".format(__name__, name)
+    )
+
+
+def __dir__():
+    return sorted(
+        list(globals()) +
+        [
+            "{0:s}_{1:s}".format(func_short_name, kind)
+            for func_short_name in _COMBINATIONS
+            for kind in KERNEL_KINDS
+        ]
+    )
@@ -23,7 +23,7 @@ from pandas.plotting import register_matplotlib_converters
 
 import correlation_function_fits
 import correlation_utils
-import flux_correlation_function_fits
+import correlation_function_kernels
 
 mpl.rcParams["figure.dpi"] = 144
 mpl.rcParams["savefig.dpi"] = 300
@@ -378,14 +378,14 @@ CORRELATION_TIMES = (
     correlation_data.index.values.astype("m8[h]").astype("i8").astype("f4") / 24
 )
 CORRELATIONS = {
-    "EC-driven: with ann.": flux_correlation_function_fits.dc_dmc_ap_curve_ne(
+    "EC-driven: with ann.": correlation_function_kernels.dc_dmc_ap_curve_ne(
         CORRELATION_TIMES,
         **MEAN_COEFFICIENTS.sel(correlation_function="dc_dmc_ap")
         .to_series()
         .dropna()
         .to_dict(),
     ),
-    "EC-driven no ann.": flux_correlation_function_fits.dp_dmc_a0_curve_ne(
+    "EC-driven no ann.": correlation_function_kernels.dp_dmc_a0_curve_ne(
         CORRELATION_TIMES,
         **MEAN_COEFFICIENTS.sel(correlation_function="dp_dmc_a0")
         .to_series()
@@ -0,0 +1,162 @@
+# ~*~ coding: utf8 ~*~
+"""Split the work of a driver script across batch jobs.
+
+Each driver lists its work units in a fixed order, and shard ``i/n``
+(counting from zero, like most batch array task IDs) takes the i-th of
+n contiguous, nearly equal runs of them.  Contiguous runs keep the
+units for one site or split together, so per-site setup is mostly done
+once.  Each shard writes its results next to the final output, with
+``.shard-III-of-NNN`` before the extension, and the merge step puts
+them back together in shard order.
+"""
+from __future__ import print_function, division
+
+import argparse
+import collections
+import glob
+import os.path
+import re
+
+Shard = collections.namedtuple("Shard", ["index", "count"])
+
+_PARTIAL_FILE_RE = re.compile(r"\.shard-(\d+)-of-(\d+)$")
+
+
+def parse_shard(text):
+    """Parse a shard given as ``i/n`` on the command line.
+
+    Parameters
+    ----------
+    text: str
+
+    Returns
+    -------
+    Shard
+    """
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "Shard must look like i/n, not {text!r}".format(text=text)
+        )
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            "Need 0 <= i < n for shard i/n, not {text!r}".format(text=text)
+        )
+    return Shard(index, count)
+
+
+def add_shard_arguments(parser):
+    """Add the --shard and --merge options to a driver's parser.
+
+    Parameters
+    ----------
+    parser: argparse.ArgumentParser
+    """
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="Do only part i of n of the work, counting from zero, "
+        "and save a partial result file.",
+    )
+    group.add_argument(
+        "--merge",
+        action="store_true",
+        help="Combine the partial result files from all shards.",
+    )
+
+
+def select_shard(work_units, shard):
+    """Get the work units for a shard.
+
+    Parameters
+    ----------
+    work_units: Sequence
+    shard: Shard or None
+        None selects everything.
+
+    Returns
+    -------
+    Sequence
+    """
+    if shard is None:
+        return work_units
+    n_units = len(work_units)
+    return work_units[
+        n_units * shard.index // shard.count:
+        n_units * (shard.index + 1) // shard.count
+    ]
+
+
+def get_partial_file_name(file_name, shard):
+    """Get the name of a shard's partial result file.
+
+    Parameters
+    ----------
+    file_name: str
+        The name of the final output.
+    shard: Shard or None
+        None gives the final name back.
+
+    Returns
+    -------
+    str
+    """
+    if shard is None:
+        return file_name
+    base, ext = os.path.splitext(file_name)
+    return "{base:s}.shard-{index:03d}-of-{count:03d}{ext:s}".format(
+        base=base, index=shard.index, count=shard.count, ext=ext,
+    )
+
+
+def find_partial_files(file_name):
+    """Find the partial result files of every shard, in shard order.
+
+    Parameters
+    ----------
+    file_name: str
+        The name of the final output.
+
+    Returns
+    -------
+    List[str]
+
+    Raises
+    ------
+    ValueError
+        If shards are missing or the files come from runs with
+        different numbers of shards.
+    """
+    base, ext = os.path.splitext(file_name)
+    shards = dict()
+    for partial_name in glob.glob(glob.escape(base) + ".shard-*" + ext):
+        match = _PARTIAL_FILE_RE.search(
+            os.path.splitext(partial_name)[0]
+        )
+        if match is None:
+            continue
+        shards[Shard(*(int(group) for group in match.groups()))] = (
+            partial_name
+        )
+    counts = {shard.count for shard in shards}
+    if len(counts) != 1:
+        raise ValueError(
+            "Need partial files from exactly one run for {name:s}, "
+            "found shard counts {counts!r}".format(
+                name=file_name, counts=sorted(counts)
+            )
+        )
+    count = counts.pop()
+    missing = [
+        index for index in range(count) if Shard(index, count) not in shards
+    ]
+    if missing:
+        raise ValueError(
+            "Missing shards {missing!r} of {count:d} for {name:s}".format(
+                missing=missing, count=count, name=file_name
+            )
+        )
+    return [shards[Shard(index, count)] for index in range(count)]
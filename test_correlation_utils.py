@@ -0,0 +1,62 @@
+# ~*~ coding: utf8 ~*~
+"""Check the autocorrelations against statsmodels."""
+from __future__ import print_function, division
+
+import numpy as np
+import pytest
+from statsmodels.tsa.stattools import acf, acovf
+
+from correlation_utils import (
+    get_autocorrelation_arrays, get_autocorrelation_stats_batched,
+)
+
+MAX_LAG = 50
+
+
+def get_gappy_series(n_times=500, seed=0):
+    """Make a red-noise series with scattered and block gaps."""
+    rng = np.random.default_rng(seed)
+    data = (
+        0.1 * rng.standard_normal(n_times).cumsum() +
+        rng.standard_normal(n_times)
+    )
+    data[rng.random(n_times) < 0.2] = np.nan
+    data[n_times // 5:n_times // 4] = np.nan
+    return data
+
+
+@pytest.mark.parametrize("method", ["fft", "direct"])
+def test_autocorrelation_arrays_match_statsmodels(method):
+    data = get_gappy_series()
+    result = get_autocorrelation_arrays(data, max_lag=MAX_LAG, method=method)
+    np.testing.assert_allclose(
+        result.acovf,
+        acovf(data, missing="conservative", adjusted=True, nlag=MAX_LAG),
+        rtol=1e-5, atol=1e-6,
+    )
+    np.testing.assert_allclose(
+        result.acf,
+        acf(data, missing="conservative", adjusted=True, nlags=MAX_LAG),
+        atol=1e-6,
+    )
+    np.testing.assert_array_equal(
+        result.pair_counts[:3],
+        [
+            np.sum(np.isfinite(data[lag:]) & np.isfinite(data[:-lag or None]))
+            for lag in range(3)
+        ],
+    )
+
+
+def test_batched_matches_one_site_at_a_time():
+    data = np.stack([get_gappy_series(seed=seed) for seed in range(3)])
+    batched = get_autocorrelation_stats_batched(
+        data, max_lag=MAX_LAG, sites_per_block=2
+    )
+    for site, site_data in enumerate(data):
+        single = get_autocorrelation_arrays(site_data, max_lag=MAX_LAG)
+        np.testing.assert_allclose(batched.acf[site], single.acf)
+        np.testing.assert_allclose(batched.acovf[site], single.acovf)
+        np.testing.assert_array_equal(
+            batched.pair_counts[site], single.pair_counts
+        )
@@ -0,0 +1,92 @@
+# ~*~ coding: utf8 ~*~
+"""Check the likelihood terms against dense linear algebra."""
+from __future__ import print_function, division
+
+import numpy as np
+import scipy.linalg
+
+from gaussian_likelihood import (
+    HOURS_PER_DAY, LOG_2PI,
+    gaussian_log_likelihood, pcg_likelihood_terms, toeplitz_likelihood_terms,
+)
+
+N_TIMES = 400
+
+
+def correlation_function(lags, long_coef, long_timescale):
+    """Two exponential decays, with lags in days."""
+    return (
+        long_coef * np.exp(-lags / long_timescale) +
+        (1 - long_coef) * np.exp(-lags * HOURS_PER_DAY / 3)
+    )
+
+
+def get_problem(seed=0):
+    """Draw a series from the process with its correlation matrix."""
+    autocorrelation = correlation_function(
+        np.arange(N_TIMES) / HOURS_PER_DAY, 0.7, 2.
+    )
+    correlation_matrix = scipy.linalg.toeplitz(autocorrelation)
+    rng = np.random.default_rng(seed)
+    data = np.linalg.cholesky(correlation_matrix).dot(
+        rng.standard_normal(N_TIMES)
+    )
+    return data, autocorrelation, correlation_matrix, rng
+
+
+def test_toeplitz_terms_match_dense():
+    data, autocorrelation, correlation_matrix, _ = get_problem()
+    terms = toeplitz_likelihood_terms(data, autocorrelation)
+    np.testing.assert_allclose(
+        terms.log_determinant, np.linalg.slogdet(correlation_matrix)[1],
+        rtol=1e-10,
+    )
+    np.testing.assert_allclose(
+        terms.quadratic_form,
+        data.dot(np.linalg.solve(correlation_matrix, data)),
+        rtol=1e-10,
+    )
+    assert terms.n_observations == N_TIMES
+
+
+def test_toeplitz_log_likelihood_matches_dense():
+    data, _, correlation_matrix, _ = get_problem()
+    demeaned = data - data.mean()
+    variance = demeaned.dot(
+        np.linalg.solve(correlation_matrix, demeaned)
+    ) / N_TIMES
+    expected = -0.5 * (
+        N_TIMES * (LOG_2PI + np.log(variance) + 1) +
+        np.linalg.slogdet(correlation_matrix)[1]
+    )
+    # The correlation function is evaluated at float32 lags
+    np.testing.assert_allclose(
+        gaussian_log_likelihood(
+            data, correlation_function, (0.7, 2.), method="toeplitz"
+        ),
+        expected,
+        rtol=1e-6,
+    )
+
+
+def test_pcg_terms_match_dense_with_gaps():
+    data, autocorrelation, correlation_matrix, rng = get_problem()
+    have_data = rng.random(N_TIMES) > 0.25
+    have_data[[0, -1]] = True
+    observed_matrix = correlation_matrix[np.ix_(have_data, have_data)]
+    terms = pcg_likelihood_terms(
+        np.where(have_data, data, 0), autocorrelation, have_data
+    )
+    np.testing.assert_allclose(
+        terms.quadratic_form,
+        data[have_data].dot(
+            np.linalg.solve(observed_matrix, data[have_data])
+        ),
+        rtol=1e-5,
+    )
+    # A stochastic estimate
+    np.testing.assert_allclose(
+        terms.log_determinant, np.linalg.slogdet(observed_matrix)[1],
+        rtol=1e-2,
+    )
+    assert terms.n_observations == have_data.sum()
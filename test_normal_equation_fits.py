@@ -0,0 +1,76 @@
+# ~*~ coding: utf8 ~*~
+"""Check the normal-equation kernels and solver against curve_fit.
+
+These use the numba kernels, which need no build step.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+import scipy.optimize
+
+import numba_correlation_function_fits
+from normal_equation_fits import fit_normal_equations
+
+# resid_coef, resid_timescale, ec_coef, ec_timescale
+TRUE_PARAMETERS = np.array([0.6, 1.5, 0.3, 2.0])
+P0 = np.array([0.5, 1.0, 0.5, 1.0])
+BOUNDS = ([0, 0.01, 0, 0.01], [1, 10, 1, 10])
+
+
+def curve(lags, *parameters):
+    """The d0_dm0_a0 correlation function."""
+    return numba_correlation_function_fits.d0_dm0_a0_curve_ne(
+        lags, *parameters
+    )
+
+
+def get_correlogram(seed=0):
+    """Make a noisy correlogram with its pair counts."""
+    lags = np.arange(24 * 60, dtype=np.float64) / 24
+    pair_counts = np.linspace(5000, 1000, len(lags))
+    rng = np.random.default_rng(seed)
+    acf = (
+        curve(lags, *TRUE_PARAMETERS) +
+        rng.standard_normal(len(lags)) / np.sqrt(pair_counts)
+    )
+    return lags, acf, pair_counts
+
+
+def test_normal_loop_matches_curve_loop():
+    lags, acf, pair_counts = get_correlogram()
+    sum_squares, gradient, normal_matrix = (
+        numba_correlation_function_fits.d0_dm0_a0_normal_loop(
+            P0, lags, acf, pair_counts
+        )
+    )
+    fitted, jacobian = numba_correlation_function_fits.d0_dm0_a0_curve_loop(
+        lags, *P0
+    )
+    residuals = fitted - acf
+    np.testing.assert_allclose(
+        sum_squares, np.sum(pair_counts * residuals ** 2), rtol=1e-10
+    )
+    np.testing.assert_allclose(
+        gradient, jacobian.T.dot(pair_counts * residuals), rtol=1e-10
+    )
+    np.testing.assert_allclose(
+        normal_matrix,
+        jacobian.T.dot(pair_counts[:, np.newaxis] * jacobian),
+        rtol=1e-10,
+    )
+
+
+def test_fit_normal_equations_matches_curve_fit():
+    lags, acf, pair_counts = get_correlogram()
+    popt, pcov = fit_normal_equations(
+        numba_correlation_function_fits.d0_dm0_a0_normal_loop,
+        lags, acf, pair_counts, P0, BOUNDS,
+    )
+    expected_popt, expected_pcov = scipy.optimize.curve_fit(
+        curve, lags, acf, P0,
+        sigma=1 / np.sqrt(pair_counts), bounds=BOUNDS,
+    )
+    np.testing.assert_allclose(popt, expected_popt, rtol=1e-6)
+    np.testing.assert_allclose(
+        pcov, expected_pcov, atol=1e-6 * np.abs(expected_pcov).max()
+    )
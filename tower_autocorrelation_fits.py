@@ -4,7 +4,10 @@
 
 One tower at a time, still.
 """
+import argparse
+import functools
 import inspect
+import itertools
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -13,33 +16,11 @@ import scipy.optimize
 
 import flux_correlation_functions
 import flux_correlation_functions_py
-
-print("Reading correlation data", flush=True)
-corr_data1 = pd.read_csv(
-    "ameriflux-minus-casa-half-hour-towers-autocorrelation-functions.csv",
-    index_col=0
-)
-corr_data2 = pd.read_csv(
-    "ameriflux-minus-casa-hour-towers-autocorrelation-functions.csv",
-    index_col=0
-)
-corr_data = pd.concat([corr_data1, corr_data2], axis=1)
-corr_data.index = pd.TimedeltaIndex(corr_data.index)
-corr_data.index.name = "Time separation"
-corr_data = corr_data.astype(np.float32)
-print("Have correlation data", flush=True)
-
-pair_counts1 = pd.read_csv(
-    "ameriflux-minus-casa-half-hour-towers-pair-counts.csv",
-    index_col=0
+from correlogram_compression import compress_correlogram, compression_error
+from shard_utils import (
+    add_shard_arguments, find_partial_files, get_partial_file_name,
+    select_shard,
 )
-pair_counts2 = pd.read_csv(
-    "ameriflux-minus-casa-hour-towers-pair-counts.csv",
-    index_col=0
-)
-pair_counts = pd.concat([pair_counts1, pair_counts2], axis=1)
-pair_counts.index = pd.TimedeltaIndex(pair_counts.index)
-print("Have pair counts", flush=True)
 
 HOURS_PER_DAY = 24
 DAYS_PER_WEEK = 7
@@ -47,6 +28,10 @@ DAYS_PER_YEAR = 365.2425
 HOURS_PER_YEAR = HOURS_PER_DAY * DAYS_PER_YEAR
 N_YEARS_DATA = 4
 
+# Fit to lag bins rather than every hourly lag.  This approximates
+# the full problem, so the fitted parameters change slightly.
+COMPRESS_CORRELOGRAMS = False
+
 CORRELATION_FUNCTION_NAMES = [
     corr_name
     for corr_name in dir(flux_correlation_functions_py)
@@ -118,22 +103,120 @@ PARAM_UPPER_BOUNDS = dict(
 for coef, val in STARTING_PARAMS.items():
     STARTING_PARAMS[coef] = np.float32(val)
 
-COEFFICIENT_DATA = pd.DataFrame(
-    columns=STARTING_PARAMS.keys(),
-    index=pd.MultiIndex.from_product(
-        [corr_data, CORRELATION_FUNCTION_NAMES],
-        names=["Site", "Correlation Function"],
-    )
+COEFFICIENT_FILE_NAME = "ameriflux-minus-casa-all-towers-parameters.csv"
+COEFFICIENT_VAR_FILE_NAME = (
+    "ameriflux-minus-casa-all-towers-parameter-variances.csv"
 )
-COEFFICIENT_VAR_DATA = pd.DataFrame(
-    columns=STARTING_PARAMS.keys(),
-    index=pd.MultiIndex.from_product(
-        [corr_data, CORRELATION_FUNCTION_NAMES],
-        names=["Site", "Correlation Function"],
-    )
+
+PARSER = argparse.ArgumentParser(
+    description=__doc__,
 )
+add_shard_arguments(PARSER)
+
+
+def read_correlation_data():
+    """Read the correlograms and pair counts for every tower.
+
+    Returns
+    -------
+    corr_data: pd.DataFrame
+    pair_counts: pd.DataFrame
+    """
+    print("Reading correlation data", flush=True)
+    corr_data1 = pd.read_csv(
+        "ameriflux-minus-casa-half-hour-towers-autocorrelation-functions.csv",
+        index_col=0
+    )
+    corr_data2 = pd.read_csv(
+        "ameriflux-minus-casa-hour-towers-autocorrelation-functions.csv",
+        index_col=0
+    )
+    corr_data = pd.concat([corr_data1, corr_data2], axis=1)
+    corr_data.index = pd.TimedeltaIndex(corr_data.index)
+    corr_data.index.name = "Time separation"
+    corr_data = corr_data.astype(np.float32)
+    print("Have correlation data", flush=True)
+
+    pair_counts1 = pd.read_csv(
+        "ameriflux-minus-casa-half-hour-towers-pair-counts.csv",
+        index_col=0
+    )
+    pair_counts2 = pd.read_csv(
+        "ameriflux-minus-casa-hour-towers-pair-counts.csv",
+        index_col=0
+    )
+    pair_counts = pd.concat([pair_counts1, pair_counts2], axis=1)
+    pair_counts.index = pd.TimedeltaIndex(pair_counts.index)
+    print("Have pair counts", flush=True)
+    return corr_data, pair_counts
+
 
-for column in corr_data.iloc[:, :]:
+def make_result_frames(index):
+    """Set up data frames for the fitted parameters and their variances.
+
+    Parameters
+    ----------
+    index: pd.MultiIndex
+        The (site, function) pairs to fit.
+
+    Returns
+    -------
+    coefficient_data: pd.DataFrame
+    coefficient_var_data: pd.DataFrame
+    """
+    coefficient_data = pd.DataFrame(
+        columns=STARTING_PARAMS.keys(),
+        index=index,
+    )
+    coefficient_var_data = pd.DataFrame(
+        columns=STARTING_PARAMS.keys(),
+        index=index,
+    )
+    return coefficient_data, coefficient_var_data
+
+
+def get_weighted_error(corr_fun, parameters, lags, correlations, counts):
+    """Find the pair-weighted sum of squares of a fit.
+
+    Takes its arguments in the order of the ``*_fit_ne`` kernels, for
+    :func:`correlogram_compression.compression_error`.
+
+    Parameters
+    ----------
+    corr_fun: callable
+        One of the functions in CORRELATION_FUNCTIONS.
+    parameters: np.ndarray
+    lags, correlations, counts: np.ndarray
+
+    Returns
+    -------
+    float
+    """
+    return np.sum(counts * (correlations - corr_fun(lags, *parameters)) ** 2)
+
+
+def fit_tower(column, corr_data, pair_counts, corr_names,
+              coefficient_data, coefficient_var_data):
+    """Fit correlation functions to one tower's correlogram.
+
+    Parameters
+    ----------
+    column: str
+        The tower.
+    corr_data, pair_counts: pd.DataFrame
+    corr_names: List[str]
+        Which of CORRELATION_FUNCTION_NAMES to fit.
+    coefficient_data, coefficient_var_data: pd.DataFrame
+        From :func:`make_result_frames`.  Modified in place.
+
+    Returns
+    -------
+    tower_lags: np.ndarray or None
+        None if the tower does not have enough data.
+    tower_correlations: pd.Series
+    fitted_params: Dict[str, np.ndarray]
+        The parameters for each function that could be fit.
+    """
     print(column, flush=True)
     tower_counts = pair_counts.loc[:, column].dropna()
     tower_correlations = corr_data.loc[tower_counts.index, column].loc[tower_counts != 0]
@@ -152,24 +235,28 @@ for column in corr_data.iloc[:, :]:
             tower_lags[-1] /DAYS_PER_YEAR,
             "years.",
         )
-        continue
-    tower_lag_weights = np.sqrt(1. / tower_counts).astype(np.float32)
-    fig, axes = plt.subplots(len(CORRELATION_FUNCTIONS) + 1, 1,
-                             figsize=(6.5, 9), sharex=True, sharey=True)
-    emp_line, = axes[0].plot(tower_lags, tower_correlations)
-    emp_title = axes[0].set_title("Empirical Correlogram")
-    fig_title = fig.suptitle(column)
-    for corr_name, corr_fun, ax in zip(
-            CORRELATION_FUNCTION_NAMES,
-            CORRELATION_FUNCTIONS,
-            axes[1:]
-    ):
+        return None, tower_correlations, {}
+    if COMPRESS_CORRELOGRAMS:
+        fit_problem = compress_correlogram(
+            tower_lags, tower_correlations, tower_counts
+        )
+        fit_lags, fit_correlations, fit_counts = fit_problem[:3]
+        print("Compressed", len(tower_lags), "lags to", len(fit_lags),
+              "points", flush=True)
+    else:
+        fit_lags = tower_lags
+        fit_correlations = tower_correlations
+        fit_counts = tower_counts
+    tower_lag_weights = np.sqrt(1. / fit_counts).astype(np.float32)
+    fitted_params = dict()
+    for corr_name in corr_names:
+        corr_fun = getattr(flux_correlation_functions_py, corr_name)
         print(corr_name, flush=True)
         argspec = inspect.getfullargspec(corr_fun)
         param_names = argspec.args[1:]
         try:
             param_vals, param_cov = scipy.optimize.curve_fit(
-                corr_fun, tower_lags, tower_correlations,
+                corr_fun, fit_lags, fit_correlations,
                 [STARTING_PARAMS[param] for param in param_names],
                 sigma=tower_lag_weights,
                 bounds=(
@@ -185,27 +272,68 @@ for column in corr_data.iloc[:, :]:
             )
         except RuntimeError:
             continue
-        COEFFICIENT_DATA.loc[(column, corr_name), param_names] = param_vals
-        COEFFICIENT_VAR_DATA.loc[(column, corr_name), param_names] = np.diag(
+        if COMPRESS_CORRELOGRAMS:
+            print(
+                "Training error (full, compressed, relative difference):",
+                *compression_error(
+                    functools.partial(get_weighted_error, corr_fun),
+                    param_vals,
+                    tower_lags,
+                    tower_correlations.values,
+                    tower_counts.values,
+                    fit_problem,
+                )
+            )
+        coefficient_data.loc[(column, corr_name), param_names] = param_vals
+        coefficient_var_data.loc[(column, corr_name), param_names] = np.diag(
             param_cov
         )
+        fitted_params[corr_name] = param_vals
+    return tower_lags, tower_correlations, fitted_params
+
+
+def plot_tower_fits(column, tower_lags, tower_correlations, fitted_params):
+    """Plot a tower's correlogram and the fit of each function.
+
+    Parameters
+    ----------
+    column: str
+    tower_lags: np.ndarray
+    tower_correlations: pd.Series
+    fitted_params: Dict[str, np.ndarray]
+        From :func:`fit_tower`.
+    """
+    fig, axes = plt.subplots(len(CORRELATION_FUNCTIONS) + 1, 1,
+                             figsize=(6.5, 9), sharex=True, sharey=True)
+    emp_line, = axes[0].plot(tower_lags, tower_correlations)
+    axes[0].set_title("Empirical Correlogram")
+    fig.suptitle(column)
+    for corr_name, corr_fun, ax in zip(
+            CORRELATION_FUNCTION_NAMES,
+            CORRELATION_FUNCTIONS,
+            axes[1:]
+    ):
+        if corr_name not in fitted_params:
+            continue
         fit_line, = ax.plot(
-            tower_lags, corr_fun(tower_lags, *param_vals), label="ACF fit"
+            tower_lags, corr_fun(tower_lags, *fitted_params[corr_name]),
+            label="ACF fit"
         )
-        fit_name = ax.set_title("Fit of {corr_name:s}".format(corr_name=corr_name))
+        ax.set_title("Fit of {corr_name:s}".format(corr_name=corr_name))
+    ax = axes[-1]
     fig.tight_layout()
     fig.subplots_adjust(top=.9, hspace=1.1)
-    old_xlim = ax.set_xlim(0, DAYS_PER_YEAR * N_YEARS_DATA)
-    old_ylim = ax.set_ylim(-1, 1)
+    ax.set_xlim(0, DAYS_PER_YEAR * N_YEARS_DATA)
+    ax.set_ylim(-1, 1)
     xtick_locations = pd.timedelta_range(
         start=0, freq="365D", periods=N_YEARS_DATA + 1
     ).to_numpy().astype("m8[D]").astype("u8").astype(np.float32)
     for ax in axes:
-        xticks = ax.set_xticks(xtick_locations)
+        ax.set_xticks(xtick_locations)
     fig.savefig("{tower:s}-ameriflux-minus-casa-corr-fits-long.pdf".format(
         tower=column
     ))
-    old_xlim = ax.set_xlim(0, DAYS_PER_WEEK * N_YEARS_DATA)
+    ax.set_xlim(0, DAYS_PER_WEEK * N_YEARS_DATA)
     xtick_locations = pd.timedelta_range(
         start=0, freq="7D", periods=N_YEARS_DATA + 1
     ).to_numpy().astype("m8[D]").astype("u8").astype(np.float32)
@@ -213,12 +341,75 @@ for column in corr_data.iloc[:, :]:
         start=0, freq="1D", periods=N_YEARS_DATA + 1
     ).to_numpy().astype("m8[D]").astype("u8").astype(np.float32)
     for ax in axes:
-        xticks = ax.set_xticks(xtick_locations)
-        xticks_minor = ax.set_xticks(xtick_locations_minor, minor=True)
+        ax.set_xticks(xtick_locations)
+        ax.set_xticks(xtick_locations_minor, minor=True)
     fig.savefig("{tower:s}-ameriflux-minus-casa-corr-fits-short.pdf".format(
         tower=column
     ))
     plt.close(fig)
 
-COEFFICIENT_DATA.to_csv("ameriflux-minus-casa-all-towers-parameters.csv")
-COEFFICIENT_VAR_DATA.to_csv("ameriflux-minus-casa-all-towers-parameter-variances.csv")
+
+def read_partial_results(file_name):
+    """Combine the partial CSV results of every shard.
+
+    Parameters
+    ----------
+    file_name: str
+        The name of the final output.
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    return pd.concat(
+        [
+            pd.read_csv(partial_name, index_col=[0, 1])
+            for partial_name in find_partial_files(file_name)
+        ],
+        axis=0,
+    )
+
+
+if __name__ == "__main__":
+    ARGS = PARSER.parse_args()
+    if ARGS.merge:
+        COEFFICIENT_DATA = read_partial_results(COEFFICIENT_FILE_NAME)
+        COEFFICIENT_VAR_DATA = read_partial_results(COEFFICIENT_VAR_FILE_NAME)
+    else:
+        CORR_DATA, PAIR_COUNTS = read_correlation_data()
+        # Work units are (site, function) pairs, site-major, so
+        # most shards see all the functions for each of their sites.
+        WORK_UNITS = select_shard(
+            list(itertools.product(CORR_DATA, CORRELATION_FUNCTION_NAMES)),
+            ARGS.shard,
+        )
+        COEFFICIENT_DATA, COEFFICIENT_VAR_DATA = make_result_frames(
+            pd.MultiIndex.from_tuples(
+                WORK_UNITS, names=["Site", "Correlation Function"],
+            )
+        )
+
+        for column, tower_units in itertools.groupby(
+                WORK_UNITS, key=lambda unit: unit[0]
+        ):
+            tower_corr_names = [unit[1] for unit in tower_units]
+            tower_lags, tower_correlations, fitted_params = fit_tower(
+                column, CORR_DATA, PAIR_COUNTS, tower_corr_names,
+                COEFFICIENT_DATA, COEFFICIENT_VAR_DATA,
+            )
+            if tower_lags is None:
+                continue
+            if len(tower_corr_names) < len(CORRELATION_FUNCTION_NAMES):
+                print("Functions for", column, "split across shards.",
+                      "Skipping plots.")
+                continue
+            plot_tower_fits(
+                column, tower_lags, tower_correlations, fitted_params
+            )
+
+    COEFFICIENT_DATA.to_csv(
+        get_partial_file_name(COEFFICIENT_FILE_NAME, ARGS.shard)
+    )
+    COEFFICIENT_VAR_DATA.to_csv(
+        get_partial_file_name(COEFFICIENT_VAR_FILE_NAME, ARGS.shard)
+    )
@@ -0,0 +1,292 @@
+# ~*~ coding: utf8 ~*~
+"""Separable least-squares fits of the correlation functions.
+
+Once the timescales, widths, and modulation weights are fixed, the
+correlation functions are linear combinations of a few basis
+functions:
+
+    f(t) = sum_k gamma_k phi_k(t; theta).
+
+The coefficients gamma are the overall coefficient of each part and
+the residual and ec terms, and the products of the overall
+coefficients with the cosine weights (see
+:meth:`correlation_function_fits.PartForm.get_parameters`).  For each
+theta the best gamma is a weighted linear least-squares solve, so only
+theta is searched, with the Jacobian of Kaufman (1975) for the
+projected residuals (variable projection, Golub and Pereyra 2003).
+
+The basis functions are the columns of the ``*_curve_loop`` Jacobian
+for the linear parameters with every overall coefficient set to one
+and the cosine weights to zero.  The linear solve is unconstrained, so
+the result is clipped to the bounds and then polished with
+:func:`normal_equation_fits.fit_normal_equations`, which also gives the
+covariance of all the parameters.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+import scipy.linalg
+import scipy.optimize
+
+from correlation_function_fits import get_full_parameter_list
+from lag_grids import get_lag_grid
+from normal_equation_fits import DEFAULT_TOLERANCE, fit_normal_equations
+
+
+class VariableProjection(object):
+    """The fit of one correlation function, reduced to the nonlinear part.
+
+    Parameters
+    ----------
+    curve_and_deriv: callable
+        One of the generated ``*_curve_loop`` kernels.
+    forms: Tuple[PartForm, PartForm, PartForm]
+    lags, acf, pair_counts: np.ndarray[N]
+    """
+
+    def __init__(self, curve_and_deriv, forms, lags, acf, pair_counts):
+        self.curve_and_deriv = curve_and_deriv
+        parameter_list = get_full_parameter_list(*forms)
+        linear_list = get_full_parameter_list(*forms, linear=True)
+        self.n_parameters = len(parameter_list)
+        self.linear_index = np.array(
+            [parameter_list.index(param) for param in linear_list],
+            dtype=int,
+        )
+        self.nonlinear_index = np.array(
+            [
+                parameter_list.index(param)
+                for param in get_full_parameter_list(*forms, linear=False)
+            ],
+            dtype=int,
+        )
+        # The cosine weights are the ratios of their gamma to that of
+        # the overall coefficient of the part
+        self.ratio_index = np.array(
+            [
+                parameter_list.index(param)
+                for param in linear_list
+                if param[-1].isdigit()
+            ],
+            dtype=int,
+        )
+        self.ratio_linear_index = np.array(
+            [
+                linear_list.index(param)
+                for param in linear_list
+                if param[-1].isdigit()
+            ],
+            dtype=int,
+        )
+        self.ratio_amplitude_linear_index = np.array(
+            [
+                linear_list.index(param[:-1])
+                for param in linear_list
+                if param[-1].isdigit()
+            ],
+            dtype=int,
+        )
+        # The overall coefficients are one and the cosine weights zero
+        self.basis_parameters = np.zeros(self.n_parameters)
+        self.basis_parameters[self.linear_index] = 1
+        self.basis_parameters[self.ratio_index] = 0
+
+        self.lags = get_lag_grid(np.ascontiguousarray(lags, dtype=np.float64))
+        self.sqrt_weights = np.sqrt(np.asarray(pair_counts, dtype=np.float64))
+        self.weighted_acf = self.sqrt_weights * np.asarray(
+            acf, dtype=np.float64
+        )
+        self.n_kernel_calls = 0
+        self._nonlinear_params = None
+        self._solution = None
+
+    def get_full_parameters(self, nonlinear_params, linear_coefs):
+        """Put the parameters of the reduced problem back together.
+
+        Parameters
+        ----------
+        nonlinear_params: np.ndarray[N_nonlinear]
+        linear_coefs: np.ndarray[N_linear]
+            The gammas.
+
+        Returns
+        -------
+        np.ndarray[N_params]
+        """
+        parameters = np.empty(self.n_parameters)
+        parameters[self.nonlinear_index] = nonlinear_params
+        parameters[self.linear_index] = linear_coefs
+        amplitudes = linear_coefs[self.ratio_amplitude_linear_index]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            parameters[self.ratio_index] = np.where(
+                amplitudes != 0,
+                linear_coefs[self.ratio_linear_index] / amplitudes,
+                0,
+            )
+        return parameters
+
+    def solve_linear(self, nonlinear_params):
+        """Find the best linear coefficients for the nonlinear parameters.
+
+        Parameters
+        ----------
+        nonlinear_params: np.ndarray[N_nonlinear]
+
+        Returns
+        -------
+        linear_coefs: np.ndarray[N_linear]
+        weighted_basis: np.ndarray[N, N_linear]
+        basis_range: np.ndarray[N, rank]
+            An orthonormal basis for the range of weighted_basis.
+        """
+        nonlinear_params = np.array(nonlinear_params, dtype=np.float64)
+        if (
+                self._nonlinear_params is None or
+                not np.array_equal(nonlinear_params, self._nonlinear_params)
+        ):
+            parameters = self.basis_parameters.copy()
+            parameters[self.nonlinear_index] = nonlinear_params
+            deriv = self.curve_and_deriv(self.lags, *parameters)[1]
+            self.n_kernel_calls += 1
+            weighted_basis = (
+                self.sqrt_weights[:, np.newaxis] *
+                deriv[:, self.linear_index]
+            )
+            left, singular_values, right = scipy.linalg.svd(
+                weighted_basis, full_matrices=False
+            )
+            rank = np.count_nonzero(
+                singular_values > np.finfo(float).eps *
+                max(weighted_basis.shape) * singular_values[0]
+            )
+            linear_coefs = right[:rank].T.dot(
+                left[:, :rank].T.dot(self.weighted_acf) /
+                singular_values[:rank]
+            )
+            self._nonlinear_params = nonlinear_params
+            self._solution = linear_coefs, weighted_basis, left[:, :rank]
+        return self._solution
+
+    def residuals(self, nonlinear_params):
+        """Find the weighted residuals of the best linear fit.
+
+        Parameters
+        ----------
+        nonlinear_params: np.ndarray[N_nonlinear]
+
+        Returns
+        -------
+        np.ndarray[N]
+        """
+        linear_coefs, weighted_basis, _ = self.solve_linear(nonlinear_params)
+        return weighted_basis.dot(linear_coefs) - self.weighted_acf
+
+    def jacobian(self, nonlinear_params):
+        """Find Kaufman's Jacobian of the residuals.
+
+        The derivative of the weighted curve with respect to the
+        nonlinear parameters, projected onto the complement of the
+        range of the basis.
+
+        Parameters
+        ----------
+        nonlinear_params: np.ndarray[N_nonlinear]
+
+        Returns
+        -------
+        np.ndarray[N, N_nonlinear]
+        """
+        linear_coefs, _, basis_range = self.solve_linear(nonlinear_params)
+        deriv = self.curve_and_deriv(
+            self.lags,
+            *self.get_full_parameters(nonlinear_params, linear_coefs)
+        )[1]
+        self.n_kernel_calls += 1
+        weighted_deriv = (
+            self.sqrt_weights[:, np.newaxis] * deriv[:, self.nonlinear_index]
+        )
+        return weighted_deriv - basis_range.dot(
+            basis_range.T.dot(weighted_deriv)
+        )
+
+
+def fit_variable_projection(curve_and_deriv, normal_equations, forms, lags,
+                            acf, pair_counts, p0, bounds,
+                            ftol=DEFAULT_TOLERANCE, xtol=DEFAULT_TOLERANCE,
+                            gtol=DEFAULT_TOLERANCE, full_output=False):
+    """Fit a correlation function to a correlogram by variable projection.
+
+    Minimizes sum(pair_counts * (curve(lags) - acf) ** 2), like
+    :func:`normal_equation_fits.fit_normal_equations`.
+
+    Parameters
+    ----------
+    curve_and_deriv: callable
+        The ``*_curve_loop`` kernel for the function.
+    normal_equations: callable
+        The ``*_normal_loop`` kernel for the function.
+    forms: Tuple[PartForm, PartForm, PartForm]
+    lags, acf, pair_counts: np.ndarray[N]
+    p0: np.ndarray[N_params]
+        Only the nonlinear parameters are used as a starting point.
+    bounds: Tuple[np.ndarray[N_params], np.ndarray[N_params]]
+    ftol, xtol, gtol: float
+        As for :func:`scipy.optimize.least_squares`.
+    full_output: bool
+        Also return a dict with the number of kernel passes and the
+        reason each stage stopped.
+
+    Returns
+    -------
+    popt: np.ndarray[N_params]
+    pcov: np.ndarray[N_params, N_params]
+    infodict: dict
+        Only if full_output.
+
+    Raises
+    ------
+    ValueError
+        If p0 is outside the bounds.
+    RuntimeError
+        If either stage of the fit does not converge.
+    """
+    reduced_problem = VariableProjection(
+        curve_and_deriv, forms, lags, acf, pair_counts
+    )
+    lower_bounds, upper_bounds = (
+        np.broadcast_to(np.asarray(bound, dtype=np.float64), np.shape(p0))
+        for bound in bounds
+    )
+    nonlinear_index = reduced_problem.nonlinear_index
+    result = scipy.optimize.least_squares(
+        reduced_problem.residuals,
+        np.asarray(p0, dtype=np.float64)[nonlinear_index],
+        jac=reduced_problem.jacobian,
+        bounds=(
+            lower_bounds[nonlinear_index], upper_bounds[nonlinear_index]
+        ),
+        method="trf",
+        ftol=ftol,
+        xtol=xtol,
+        gtol=gtol,
+    )
+    if not result.success:
+        raise RuntimeError("Optimal parameters not found: " + result.message)
+    linear_coefs = reduced_problem.solve_linear(result.x)[0]
+    projected_params = np.clip(
+        reduced_problem.get_full_parameters(result.x, linear_coefs),
+        lower_bounds, upper_bounds,
+    )
+
+    opt_params, param_cov, polish_info = fit_normal_equations(
+        normal_equations, lags, acf, pair_counts, projected_params,
+        (lower_bounds, upper_bounds), ftol=ftol, xtol=xtol, gtol=gtol,
+        full_output=True,
+    )
+    if full_output:
+        return opt_params, param_cov, dict(
+            nfev=reduced_problem.n_kernel_calls + polish_info["nfev"],
+            message=result.message,
+            polish_message=polish_info["message"],
+        )
+    return opt_params, param_cov
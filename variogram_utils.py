@@ -0,0 +1,268 @@
+# ~*~ coding: utf8 ~*~
+"""Empirical variograms of gappy, regularly-spaced series.
+
+The classical (Matheron) estimator and the variance of the
+differences both depend only on per-lag sums of x[t], x[t + k] and
+their squares and products, so they come straight from
+:func:`correlation_utils.get_lag_sums` in O(N log N).
+
+The robust estimators need the distribution of |x[t + k] - x[t]| at
+each lag.  That is sketched by sorting the values into evenly spaced
+value bins: the histogram of bin-index differences at each lag is the
+two-dimensional autocorrelation of the value-bin-by-time indicator
+array, which one real 2-D FFT gives for all lags at once.  Treating
+values as spread uniformly within their bin makes the difference
+given a bin offset triangularly distributed, which removes most of
+the binning bias from the Cressie-Hawkins and median estimators.
+
+The estimators follow
+@article{MINGOTI2008,
+  title = {{A note on robust and non-robust variogram estimators}},
+  journal = {{Rem: Revista Escola de Minas}},
+  author={Mingoti, Sueli Aparecida AND Rosa, Gilmar},
+  volume = {61},
+  year = {2008},
+  pages = {87 - 95},
+  doi = {10.1590/S0370-44672008000100014},
+}
+"""
+from __future__ import print_function, division
+
+import collections
+
+import numpy as np
+import scipy.fft
+
+from correlation_utils import get_lag_sums
+
+N_VALUE_BINS = 64
+# Values outside these quantiles go in the end bins
+VALUE_RANGE_QUANTILES = (0.001, 0.999)
+N_QUADRATURE_POINTS = 16
+
+VariogramArrays = collections.namedtuple(
+    "VariogramArrays",
+    ["matheron", "cressie_hawkins", "median", "difference_variance",
+     "pair_counts"],
+)
+VariogramArrays.__doc__ = """Variogram estimates by lag bin.
+
+difference_variance is half the variance of x[t + k] - x[t] at each
+lag, the estimator from Haslett (1997).
+"""
+
+
+def _triangular_cdf(value):
+    """Find the CDF of the difference of two standard uniforms.
+
+    Parameters
+    ----------
+    value: np.ndarray
+
+    Returns
+    -------
+    np.ndarray
+    """
+    value = np.clip(value, -1, 1)
+    return np.where(
+        value < 0,
+        (1 + value) ** 2 / 2,
+        1 - (1 - value) ** 2 / 2,
+    )
+
+
+def _expected_sqrt_abs_difference(n_offsets):
+    """Find E[|m + s| ** 0.5] for triangular s on [-1, 1].
+
+    Parameters
+    ----------
+    n_offsets: int
+
+    Returns
+    -------
+    np.ndarray[n_offsets]
+        In units of the square root of the bin width.
+    """
+    nodes, weights = np.polynomial.legendre.leggauss(N_QUADRATURE_POINTS)
+    # Integrate each half of the triangle separately so the kink at
+    # zero does not spoil the quadrature.
+    half_nodes = (nodes + 1) / 2
+    half_weights = weights / 2
+    offsets = np.arange(n_offsets)[:, np.newaxis]
+    result = np.zeros(n_offsets)
+    for sign in (-1, 1):
+        spread = sign * half_nodes
+        density = 1 - half_nodes
+        result += np.sum(
+            half_weights * density *
+            np.sqrt(np.abs(offsets + spread)),
+            axis=1,
+        )
+    # Near m = 0, sqrt(|s|) has an integrable cusp at s = 0 that
+    # Gauss-Legendre handles poorly; use the exact value there.
+    # E[|s| ** 0.5] = 2 * int_0^1 s ** 0.5 (1 - s) ds = 8 / 15
+    result[0] = 8. / 15
+    return result
+
+
+def get_difference_histograms(data, have_data=None, max_lag=None,
+                              n_value_bins=N_VALUE_BINS):
+    """Count pairs at each lag by how many value bins apart they are.
+
+    Parameters
+    ----------
+    data: np.ndarray[N]
+        Regularly spaced.  Missing values may be NaN.
+    have_data: np.ndarray[N] of bool, optional
+    max_lag: int, optional
+    n_value_bins: int
+
+    Returns
+    -------
+    histograms: np.ndarray[max_lag + 1, n_value_bins]
+        Element [k, m] counts pairs at lag k whose values are m bins
+        apart, in either direction.
+    bin_width: float
+    """
+    data = np.asarray(data, dtype=np.float64)
+    mask = np.isfinite(data)
+    if have_data is not None:
+        mask &= have_data
+    n_times = len(data)
+    if max_lag is None:
+        max_lag = n_times - 1
+    n_lags = min(max_lag, n_times - 1) + 1
+    if not mask.any():
+        return np.zeros((n_lags, n_value_bins)), np.nan
+
+    low, high = np.quantile(data[mask], VALUE_RANGE_QUANTILES)
+    if high <= low:
+        high = low + 1
+    bin_width = (high - low) / n_value_bins
+    value_bin = np.clip(
+        np.floor((data - low) / bin_width), 0, n_value_bins - 1
+    )
+    indicators = np.zeros((n_value_bins, n_times))
+    times = np.nonzero(mask)[0]
+    indicators[value_bin[times].astype(int), times] = 1
+
+    bin_fft_len = scipy.fft.next_fast_len(2 * n_value_bins - 1)
+    time_fft_len = scipy.fft.next_fast_len(n_times + n_lags - 1, real=True)
+    spectrum = scipy.fft.rfft2(indicators, (bin_fft_len, time_fft_len))
+    del indicators
+    correlation = scipy.fft.irfft2(
+        spectrum.real ** 2 + spectrum.imag ** 2,
+        (bin_fft_len, time_fft_len),
+    )[:, :n_lags]
+    del spectrum
+    # Row m has pairs where the later value is m bins above the
+    # earlier one; row -m where it is m bins below.
+    histograms = np.round(correlation[:n_value_bins].T)
+    histograms[:, 1:] += np.round(
+        correlation[-1:-n_value_bins:-1].T
+    )
+    return histograms, bin_width
+
+
+def _median_abs_difference(histograms, bin_width):
+    """Find the median |difference| at each lag from the histograms.
+
+    Parameters
+    ----------
+    histograms: np.ndarray[N_lags, N_bins]
+    bin_width: float
+
+    Returns
+    -------
+    np.ndarray[N_lags]
+    """
+    n_value_bins = histograms.shape[1]
+    # Evaluate the CDF of |difference| at quarter-bin spacing
+    grid = np.linspace(0, n_value_bins, 4 * n_value_bins + 1)
+    offsets = np.arange(n_value_bins)[:, np.newaxis]
+    prob_below = (
+        _triangular_cdf(grid - offsets) - _triangular_cdf(-grid - offsets)
+    )
+    pair_counts = histograms.sum(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cdf = histograms.dot(prob_below) / pair_counts
+    above_half = np.argmax(cdf >= 0.5, axis=1)
+    above_half = np.maximum(above_half, 1)
+    rows = np.arange(len(cdf))
+    cdf_low = cdf[rows, above_half - 1]
+    cdf_high = cdf[rows, above_half]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fraction = np.clip((0.5 - cdf_low) / (cdf_high - cdf_low), 0, 1)
+    median = (
+        grid[above_half - 1] + fraction * (grid[1] - grid[0])
+    ) * bin_width
+    median[pair_counts[:, 0] == 0] = np.nan
+    return median
+
+
+def get_variograms(data, have_data=None, max_lag=None, lags_per_bin=1,
+                   n_value_bins=N_VALUE_BINS):
+    """Find empirical variograms for one series.
+
+    Parameters
+    ----------
+    data: np.ndarray[N]
+        Regularly spaced.  Missing values may be NaN.
+    have_data: np.ndarray[N] of bool, optional
+    max_lag: int, optional
+        Defaults to N - 1.
+    lags_per_bin: int
+        Combine this many successive lags into each lag bin.  The
+        default gives one estimate per lag, lined up with the ACF.
+    n_value_bins: int
+        Resolution of the histogram sketch for the robust estimators.
+
+    Returns
+    -------
+    VariogramArrays
+        Each is a float32 array with one value per lag bin, except
+        pair_counts, which is int32.
+    """
+    lag_sums = get_lag_sums(data, have_data, max_lag)
+    histograms, bin_width = get_difference_histograms(
+        data, have_data, max_lag, n_value_bins
+    )
+    n_lags = len(lag_sums.pair_counts)
+    n_lag_bins = -(-n_lags // lags_per_bin)
+    lag_bin = np.arange(n_lags) // lags_per_bin
+
+    def bin_lags(values):
+        """Sum values over each lag bin."""
+        return np.bincount(lag_bin, values, n_lag_bins)
+
+    pair_counts = bin_lags(lag_sums.pair_counts)
+    sum_squared_differences = bin_lags(
+        lag_sums.sum_squares_first + lag_sums.sum_squares_second -
+        2 * lag_sums.sum_products
+    )
+    sum_differences = bin_lags(lag_sums.sum_second - lag_sums.sum_first)
+    binned_histograms = np.stack(
+        [bin_lags(column) for column in histograms.T], axis=1
+    )
+    sum_sqrt_differences = binned_histograms.dot(
+        _expected_sqrt_abs_difference(n_value_bins)
+    ) * np.sqrt(bin_width)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        matheron = 0.5 * sum_squared_differences / pair_counts
+        cressie_hawkins = 0.5 * (sum_sqrt_differences / pair_counts) ** 4 / (
+            0.457 + 0.494 / pair_counts + 0.045 / pair_counts ** 2
+        )
+        difference_variance = 0.5 * (
+            sum_squared_differences - sum_differences ** 2 / pair_counts
+        ) / (pair_counts - 1)
+    median = 0.5 * _median_abs_difference(
+        binned_histograms, bin_width
+    ) ** 2 / 0.457
+    return VariogramArrays(
+        matheron.astype(np.float32),
+        cressie_hawkins.astype(np.float32),
+        median.astype(np.float32),
+        difference_variance.astype(np.float32),
+        pair_counts.astype(np.int32),
+    )